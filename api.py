@@ -0,0 +1,253 @@
+"""Versioned JSON API for users, posts and tags.
+
+    GET /api/v1/users?fields=first_name,last_name&limit=20
+    GET /api/v1/users/<id>/posts?after=<next_cursor>
+    GET /api/v1/posts/<id>?fields=title,tag_ids
+
+?fields picks the attributes returned (id always comes back) and only
+those columns are loaded. Lists are keyset paginated on id: pass a page's
+next_cursor back as ?after. Every response carries an ETag built from the
+rows' updated_at, before they're loaded; single resources also carry
+Last-Modified from updated_at. Either validator sent back in If-None-Match
+/ If-Modified-Since gets 304 Not Modified without loading the rows. Lists
+have no Last-Modified, because a deleted row moves no timestamp. Validators
+are as fine as the database's clock: a microsecond on PostgreSQL, a second
+on SQLite.
+
+    POST /api/v1/users/<id>/posts  {"posts": [{"title": ..., "content": ..., "tag_ids": [...]}]}
+
+creates a batch of posts in one transaction and honours Idempotency-Key
+(see idempotency.py), so a client can retry it safely.
+"""
+
+import hashlib
+from datetime import datetime, timezone
+
+from flask import Blueprint, abort, current_app, jsonify, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
+
+from idempotency import idempotent
+from models import db, decode_cursor, encode_cursor, User, Post, Tag, PostTag
+
+DEFAULT_CONFIG = {
+    'API_PAGE_SIZE': 50,
+    'API_MAX_PAGE_SIZE': 200,
+    'API_MAX_BATCH_SIZE': 500,
+}
+
+#Attributes each resource exposes; 'id' is always returned
+FIELDS = {
+    User: ('first_name', 'last_name', 'image_url', 'post_count', 'last_post_at', 'updated_at'),
+    Post: ('title', 'content', 'created_at', 'updated_at', 'user_id', 'tag_ids'),
+    Tag: ('name', 'post_count', 'last_post_at', 'updated_at'),
+}
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+@api.errorhandler(HTTPException)
+def handle_http_error(e):
+    """Report errors as JSON rather than HTML pages."""
+    resp = jsonify({'error': e.name, 'message': e.description})
+    resp.status_code = e.code
+    return resp
+
+
+def requested_fields(model):
+    """Return the fields named by ?fields, or all of them; 400 on unknown names."""
+    allowed = FIELDS[model]
+    if 'fields' not in request.args:
+        return allowed
+    fields = [name for name in request.args['fields'].split(',') if name and name != 'id']
+    unknown = set(fields) - set(allowed)
+    if unknown:
+        abort(400, f"Unknown fields for {model.__tablename__}: {', '.join(sorted(unknown))}")
+    return tuple(fields)
+
+
+def select_fields(model, fields):
+    """Query for model loading only the columns fields need."""
+    columns = [getattr(model, name) for name in fields if name != 'tag_ids']
+    query = model.query.options(db.load_only(model.id, model.updated_at, *columns))
+    if 'tag_ids' in fields:
+        query = query.options(db.selectinload(Post.posts_tags))
+    return query
+
+
+def serialize(obj, fields):
+    """Dict of obj's id and fields, with datetimes in ISO 8601."""
+    data = {'id': obj.id}
+    for name in fields:
+        value = getattr(obj, name)
+        data[name] = value.isoformat() if isinstance(value, datetime) else value
+    return data
+
+
+def etag_for(*state):
+    """ETag of this URL's response, given the state of the rows it's built from."""
+    return hashlib.sha1(repr((request.full_path, *state)).encode()).hexdigest()
+
+
+def conditional(etag, last_modified, render):
+    """304 if the client's copy is current, else JSON of render(); both carry the validators.
+
+    The validators come from cheap queries, so a 304 loads no rows and
+    serializes nothing. last_modified is a naive UTC datetime or None.
+    """
+    if last_modified is not None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        resp = jsonify(render())
+    else:
+        resp = current_app.response_class(status=304)
+    resp.set_etag(etag)
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    return resp
+
+
+def show_one(model, obj_id):
+    """One row by id; updated_at starts at the creation time, so it serves as Last-Modified."""
+    fields = requested_fields(model)
+    updated_at = db.session.query(model.updated_at).filter(model.id == obj_id).scalar()
+    if updated_at is None:
+        abort(404)
+
+    def render():
+        return serialize(select_fields(model, fields).get_or_404(obj_id), fields)
+    return conditional(etag_for(updated_at), updated_at, render)
+
+
+def list_page(model, *criteria):
+    """One keyset page of model rows matching criteria, in id order.
+
+    The ETag covers the page's row count, last id and newest updated_at, read
+    from the primary key index and the rows' updated_at: a row added, edited
+    or deleted in the page changes one of them.
+    """
+    fields = requested_fields(model)
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int)
+    if not 0 < limit <= current_app.config['API_MAX_PAGE_SIZE']:
+        abort(400, f"limit must be between 1 and {current_app.config['API_MAX_PAGE_SIZE']}")
+
+    if 'after' in request.args:
+        try:
+            (last_id,) = decode_cursor(request.args['after'], int)
+        except ValueError:
+            abort(400, "Invalid cursor")
+        criteria += (model.id > last_id,)
+
+    page = (db.select(model.id, model.updated_at).where(*criteria)
+            .order_by(model.id).limit(limit + 1).subquery())
+    state = db.session.execute(db.select(db.func.count(), db.func.max(page.c.id),
+                                         db.func.max(page.c.updated_at))).one()
+
+    def render():
+        rows = select_fields(model, fields).filter(*criteria).order_by(model.id).limit(limit + 1).all()
+        next_cursor = encode_cursor([rows[limit - 1].id]) if len(rows) > limit else None
+        return {'data': [serialize(obj, fields) for obj in rows[:limit]], 'next_cursor': next_cursor}
+    return conditional(etag_for(*state), None, render)
+
+
+@api.route('/users')
+def list_users():
+    """List users in id order."""
+    return list_page(User)
+
+
+@api.route('/users/<int:user_id>')
+def show_user(user_id):
+    """Show one user."""
+    return show_one(User, user_id)
+
+
+@api.route('/users/<int:user_id>/posts')
+def list_user_posts(user_id):
+    """List a user's posts in id order."""
+    if not db.session.query(User.query.filter(User.id == user_id).exists()).scalar():
+        abort(404)
+    return list_page(Post, Post.user_id == user_id)
+
+
+def batch_posts():
+    """Validated (title, content, tag_ids) for each post in the request body."""
+    data = request.get_json(silent=True)
+    items = data.get('posts') if isinstance(data, dict) else None
+    max_size = current_app.config['API_MAX_BATCH_SIZE']
+    if not isinstance(items, list) or not 0 < len(items) <= max_size:
+        abort(400, f'Expected {{"posts": [...]}} with 1 to {max_size} posts')
+
+    max_title = Post.title.type.length
+    posts = []
+    for i, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        title, content, tag_ids = item.get('title'), item.get('content'), item.get('tag_ids', [])
+        if not isinstance(title, str) or not 0 < len(title) <= max_title:
+            abort(400, f"posts[{i}].title must be 1 to {max_title} characters")
+        if not isinstance(content, str) or not content:
+            abort(400, f"posts[{i}].content is required")
+        if not isinstance(tag_ids, list) or not all(type(tag_id) is int for tag_id in tag_ids):
+            abort(400, f"posts[{i}].tag_ids must be a list of tag ids")
+        posts.append((title, content, list(dict.fromkeys(tag_ids))))
+    return posts
+
+
+@api.route('/users/<int:user_id>/posts', methods=['POST'])
+@idempotent
+def create_user_posts(user_id):
+    """Create a batch of the user's posts; answer 201 with them, shaped by ?fields.
+
+    On PostgreSQL the flush sends the posts and their tag links as one
+    batched INSERT each; the counters and tag timelines move once for the
+    whole batch.
+    """
+    fields = requested_fields(Post)
+    posts = batch_posts()
+    if not db.session.query(User.query.filter(User.id == user_id).exists()).scalar():
+        abort(404)
+    tag_ids = {tag_id for _, _, post_tag_ids in posts for tag_id in post_tag_ids}
+    known = {tag_id for (tag_id,) in db.session.query(Tag.id).filter(Tag.id.in_(tag_ids))} if tag_ids else set()
+    if tag_ids - known:
+        abort(400, f"Unknown tag ids: {', '.join(map(str, sorted(tag_ids - known)))}")
+
+    new_posts = [Post(title=title, content=content, user_id=user_id,
+                      posts_tags=[PostTag(tag_id=tag_id) for tag_id in post_tag_ids])
+                 for title, content, post_tag_ids in posts]
+    db.session.add_all(new_posts)
+    db.session.flush()
+    # Fills in the database defaults for all of them at once
+    select_fields(Post, fields).filter(Post.id.in_([post.id for post in new_posts])).all()
+
+    return jsonify({'data': [serialize(post, fields) for post in new_posts]}), 201
+
+
+@api.route('/posts')
+def list_posts():
+    """List posts in id order."""
+    return list_page(Post)
+
+
+@api.route('/posts/<int:post_id>')
+def show_post(post_id):
+    """Show one post."""
+    return show_one(Post, post_id)
+
+
+@api.route('/tags')
+def list_tags():
+    """List tags in id order."""
+    return list_page(Tag)
+
+
+@api.route('/tags/<int:tag_id>')
+def show_tag(tag_id):
+    """Show one tag."""
+    return show_one(Tag, tag_id)
+
+
+def init_api(app):
+    """Set API defaults and register the blueprint."""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    app.register_blueprint(api)
@@ -1,65 +1,194 @@
 """Blogly application."""
 
-from tabnanny import check
-from flask import Flask, request, render_template, redirect
-from flask_debugtoolbar import DebugToolbarExtension
-from models import db, connect_db, User, Post, Tag, PostTag
+import os
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = "oh-so-secret"
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+import click
+from flask import (Flask, Blueprint, request, render_template, redirect, abort, current_app, jsonify,
+                   url_for)
+from flask.cli import with_appcontext
+from models import (db, connect_db, rebuild_timeline, repair_post_counters, User, Post, Tag,
+                    DeletionJob, DEFAULT_IMAGE_URL)
+from instrumentation import init_instrumentation
+from pool import pool_stats
+from replicas import init_replicas, REPLICA_BIND
+from cache import init_page_cache, cached_page, depends_on
+from bulk import data_cli
+from deletion import init_deletions, purge_user, purge_tag, resume_deletions_command
+from api import init_api
+from avatars import init_avatars, save_avatar
+from idempotency import init_idempotency, purge_idempotency_keys_command
+from templating import init_templates, precompile_templates_command
+from compression import init_compression
+from migrations import init_migrations, upgrade, db_cli
 
-debug = DebugToolbarExtension(app)
+DEFAULT_CONFIG = {
+    'SECRET_KEY': "oh-so-secret",
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL', 'postgresql:///blogly'),
+    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    'SLOW_QUERY_THRESHOLD_MS': 100,
+    'DEBUG_TB_INTERCEPT_REDIRECTS': False,
+    'USERS_PER_PAGE': 50,
+    'SEARCH_PER_PAGE': 20,
+    'TAG_AUTOCOMPLETE_LIMIT': 10,
+    'TAGGED_PER_PAGE': 20,
+    'RELATED_POSTS': 5,
+    'FEED_PER_PAGE': 20,
+    'FEED_TIMELINE': True,
+}
 
-connect_db(app)
-db.create_all()
+bp = Blueprint('blogly', __name__)
+
+def create_app(config=None):
+    """Build the Blogly app; config overrides DEFAULT_CONFIG.
+    
+    Deployments can also point BLOGLY_SETTINGS at a Python config file,
+    e.g. to set DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_STATEMENT_TIMEOUT_MS,
+    JINJA_BYTECODE_CACHE_DIR or AVATAR_CACHE_DIR.
+    
+    Nothing here touches the database: the engine connects on first use and
+    the schema is created and migrated by `flask db upgrade`, not at startup.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(DEFAULT_CONFIG)
+    app.config.from_envvar('BLOGLY_SETTINGS', silent=True)
+    app.config.from_mapping(config or {})
+    
+    init_templates(app)
+    # First registered, so it runs after every other after_request hook
+    init_compression(app)
+    connect_db(app)
+    init_replicas(app)
+    init_instrumentation(app)
+    init_page_cache(app)
+    init_deletions(app)
+    init_idempotency(app)
+    init_migrations(app)
+    
+    # The toolbar is a development aid; don't pay for importing it otherwise
+    if app.debug:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+    
+    app.register_blueprint(bp)
+    init_api(app)
+    init_avatars(app)
+    app.cli.add_command(create_db_command)
+    app.cli.add_command(repair_counters_command)
+    app.cli.add_command(rebuild_timeline_command)
+    app.cli.add_command(data_cli)
+    app.cli.add_command(db_cli)
+    app.cli.add_command(resume_deletions_command)
+    app.cli.add_command(purge_idempotency_keys_command)
+    app.cli.add_command(precompile_templates_command)
+    
+    if app.config['POOL_STATS_ENDPOINT']:
+        app.add_url_rule('/_pool-stats', view_func=show_pool_stats)
+    
+    return app
+
+@click.command('create-db')
+@click.option('--drop', is_flag=True, help="Drop all tables first.")
+@with_appcontext
+def create_db_command(drop):
+    """Create the schema, or migrate an existing one; same as `flask db upgrade`."""
+    if drop:
+        db.drop_all()
+    applied = upgrade(echo=click.echo)
+    click.echo(f"Applied {len(applied)} migrations." if applied else "Schema is up to date.")
+
+@click.command('repair-counters')
+@with_appcontext
+def repair_counters_command():
+    """Recompute the post counters on users and tags."""
+    repair_post_counters()
+    db.session.commit()
+    click.echo("Repaired post counters.")
+
+@click.command('rebuild-timeline')
+@with_appcontext
+def rebuild_timeline_command():
+    """Refill the tag feeds' timeline table from posts_tags."""
+    rebuild_timeline()
+    db.session.commit()
+    click.echo("Rebuilt tag timelines.")
+
+def show_pool_stats():
+    """Report this worker's connection pool statistics as JSON."""
+    stats = {'pid': os.getpid(), 'pool': pool_stats(db.get_engine())}
+    if current_app.config['SQLALCHEMY_REPLICA_URI']:
+        stats['replica_pool'] = pool_stats(db.get_engine(bind=REPLICA_BIND))
+    return jsonify(stats)
+
+def queue_deletion(kind, target_id, total, next_url):
+    """Start a background deletion job.
+    
+    Clients asking for JSON get a 202 with the job's status URL; the HTML
+    delete forms are redirected to next_url, as an inline delete would be.
+    """
+    job = current_app.extensions['deletions'].submit(kind, target_id, total)
+    if request.accept_mimetypes.best_match(['application/json', 'text/html']) != 'application/json':
+        return redirect(next_url)
+    resp = jsonify(job.to_dict())
+    resp.status_code = 202
+    resp.headers['Location'] = f'/deletions/{job.id}'
+    return resp
+
+@bp.route('/deletions/<int:job_id>')
+def show_deletion(job_id):
+    """Report the progress of a background deletion job as JSON."""
+    job = DeletionJob.query.get_or_404(job_id)
+    return jsonify(job.to_dict())
 
 #Users routes
-@app.route('/')
+@bp.route('/')
 def index():
     """Redirect to page listing all users."""
     return redirect('/users')
 
-@app.route('/users')
+@bp.route('/users')
 def show_users():
-    """Page showing all users."""
-    users = User.query.order_by(User.last_name, User.first_name).all()
-    return render_template('users.html', users=users)
+    """Page showing one page of users, sorted by name."""
+    try:
+        users, next_cursor = User.keyset_page(after=request.args.get('after'),
+                                              per_page=current_app.config['USERS_PER_PAGE'])
+    except ValueError:
+        abort(400)
+    return render_template('users.html', users=users, next_cursor=next_cursor)
 
-@app.route('/users/new')
+@bp.route('/users/new')
 def show_new_user_form():
     """Render form to create new user."""
     return render_template('new_user_form.html')
 
-@app.route('/users/new', methods=['POST'])
+@bp.route('/users/new', methods=['POST'])
 def create_user():
     """Post route to create new user and add to database."""
     first_name = request.form['first-name']
     last_name = request.form['last-name']
     image_url = request.form['image-url'] or None
     
-    new_user = User(first_name = first_name, last_name = last_name, image_url = image_url)
+    new_user = User(first_name = first_name, last_name = last_name, image_url = image_url,
+                    avatar_key = save_avatar(image_url or DEFAULT_IMAGE_URL))
     db.session.add(new_user)
     db.session.commit()
     
     return redirect(f'/users/{new_user.id}')
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
+@cached_page
 def show_user_detail(user_id):
     """Show details about a single user."""
-    user = User.query.get_or_404(user_id)
+    user = User.query.options(db.selectinload(User.posts)).get_or_404(user_id)
+    depends_on(f"user:{user.id}")
     return render_template('user_detail.html', user=user)
 
-@app.route('/users/<int:user_id>/edit')
+@bp.route('/users/<int:user_id>/edit')
 def edit_user_detail(user_id):
     """Edit details about a single user."""
     user = User.query.get_or_404(user_id)
     return render_template('edit_user_form.html', user=user)
 
-@app.route('/users/<int:user_id>/edit', methods=['POST'])
+@bp.route('/users/<int:user_id>/edit', methods=['POST'])
 def update_user(user_id):
     """Update user in database and redirect to users detail page."""
     user = User.query.get_or_404(user_id)
@@ -68,6 +197,16 @@ def update_user(user_id):
     last_name = request.form['last-name']
     image_url = request.form['image-url'] or None
     
+    #Fetch the picture only when it changed, or when an earlier fetch failed
+    if image_url != user.image_url or not user.avatar_key:
+        avatar_key = None
+        if current_app.config['AVATAR_CACHE_DIR']:
+            #End the transaction so the fetch doesn't hold a pooled connection
+            db.session.close()
+            avatar_key = save_avatar(image_url or DEFAULT_IMAGE_URL)
+            user = User.query.get_or_404(user_id)
+        user.avatar_key = avatar_key
+    
     user.first_name = first_name
     user.last_name = last_name
     user.image_url = image_url
@@ -75,58 +214,115 @@ def update_user(user_id):
     db.session.add(user)
     db.session.commit()
     
-    return redirect(f'/users/{user.id}')
+    return redirect(f'/users/{user_id}')
 
-@app.route('/users/<int:user_id>/delete', methods=['POST'])
+@bp.route('/users/<int:user_id>/delete', methods=['POST'])
 def delete_user(user_id):
-    """Delete user from database."""
-    user = User.query.get_or_404(user_id)
-    db.session.delete(user)
+    """Delete user and their posts; users with many posts go in the background."""
+    user = User.query.options(db.load_only(User.post_count)).get_or_404(user_id)
+    if user.post_count > current_app.config['ASYNC_DELETE_THRESHOLD']:
+        return queue_deletion('user', user_id, user.post_count, '/users')
+    
+    purge_user(user_id)
     db.session.commit()
     
     return redirect('/users')
     
-@app.route('/users/<int:user_id>/posts/new')
+@bp.route('/users/<int:user_id>/posts/new')
 def new_post_form(user_id):
-    """Show form to add a new post."""
+    """Show form to add a new post; tags are picked through /tags/autocomplete."""
     user = User.query.get_or_404(user_id)
-    all_tags = Tag.query.all()
-    return render_template('new_post_form.html', user=user, tags=all_tags)
+    return render_template('new_post_form.html', user=user)
 
-@app.route('/users/<int:user_id>/posts/new', methods=['POST'])
+@bp.route('/users/<int:user_id>/posts/new', methods=['POST'])
 def handle_adding_new_post(user_id):
     """Handle add form; add post and redirect to the user detail page."""
     user = User.query.get_or_404(user_id)
     
     title = request.form['title']
     content = request.form['content']
-    checkbox_tags_list = request.form.getlist('tags-checkbox')
-    posts_tags_list = [PostTag(tag_id=tag_id) for tag_id in checkbox_tags_list]
+    checkbox_tags_list = request.form.getlist('tags-checkbox', type=int)
     
-    new_post = Post(title=title, content=content, user_id=user_id, posts_tags=posts_tags_list)
+    new_post = Post(title=title, content=content, user_id=user_id)
     db.session.add(new_post)
+    new_post.sync_tags(checkbox_tags_list)
     db.session.commit()
     
     return redirect(f'/users/{user.id}')
 
+#Feeds
+def render_feed(tag=None):
+    """Render one page of the global feed, or of tag's feed."""
+    try:
+        posts, next_cursor = Post.feed(tag_id=tag and tag.id, after=request.args.get('after'),
+                                       per_page=current_app.config['FEED_PER_PAGE'],
+                                       use_timeline=current_app.config['FEED_TIMELINE'])
+    except ValueError:
+        abort(400)
+    return render_template('feed.html', tag=tag, posts=posts, next_cursor=next_cursor)
+
+@bp.route('/feed')
+def show_feed():
+    """Newest posts from everyone."""
+    return render_feed()
+
+@bp.route('/tags/<int:tag_id>/feed')
+def show_tag_feed(tag_id):
+    """Newest posts with one tag."""
+    return render_feed(Tag.query.get_or_404(tag_id))
+
 #Posts routes
-@app.route('/posts/<int:post_id>')
+@bp.route('/posts/search')
+def search_posts():
+    """Show posts matching the search query, best match first."""
+    q = request.args.get('q', '').strip()
+    posts, next_cursor = [], None
+    
+    if q:
+        try:
+            posts, next_cursor = Post.search(q, after=request.args.get('after'),
+                                             per_page=current_app.config['SEARCH_PER_PAGE'])
+        except ValueError:
+            abort(400)
+    
+    return render_template('search_results.html', q=q, posts=posts, next_cursor=next_cursor)
+
+@bp.route('/posts/tagged')
+def show_tagged_posts():
+    """Show posts with all of the ?tag ids, or any of them with ?match=any."""
+    tag_ids = request.args.getlist('tag', type=int)
+    match = request.args.get('match', 'all')
+    try:
+        posts, next_cursor = Post.with_tags(tag_ids, match=match, after=request.args.get('after'),
+                                            per_page=current_app.config['TAGGED_PER_PAGE'])
+    except ValueError:
+        abort(400)
+    tags = Tag.query.filter(Tag.id.in_(tag_ids)).order_by(Tag.name).all() if tag_ids else []
+    
+    next_url = next_cursor and url_for('blogly.show_tagged_posts', tag=tag_ids, match=match,
+                                       after=next_cursor)
+    return render_template('tagged_posts.html', tags=tags, match=match, posts=posts, next_url=next_url)
+
+@bp.route('/posts/<int:post_id>')
+@cached_page
 def show_post(post_id):
-    """Show details for single post."""
-    post = Post.query.get_or_404(post_id)
+    """Show details for single post, and the posts sharing most of its tags."""
+    post = Post.query.options(db.joinedload(Post.users),
+                              db.selectinload(Post.tags)).get_or_404(post_id)
     tags = post.tags
-    return render_template('post_detail.html', post=post, tags=tags)
+    related = post.related(current_app.config['RELATED_POSTS']) if tags else []
+    depends_on(f"post:{post.id}", f"user:{post.user_id}", *(f"tag:{tag.id}" for tag in tags),
+               *(f"post:{other.id}" for other, _ in related))
+    return render_template('post_detail.html', post=post, tags=tags, related=related)
 
-@app.route('/posts/<int:post_id>/edit')
+@bp.route('/posts/<int:post_id>/edit')
 def show_edit_post_form(post_id):
-    """Show form to edit post."""
-    post = Post.query.get_or_404(post_id)
-    all_tags = Tag.query.all()
-    this_posts_tags = post.tags
+    """Show form to edit post, with only its current tags; more come from /tags/autocomplete."""
+    post = Post.query.options(db.selectinload(Post.tags)).get_or_404(post_id)
     
-    return render_template('edit_post.html', post=post, tags=all_tags, this_posts_tags=this_posts_tags)
+    return render_template('edit_post.html', post=post, tags=post.tags)
 
-@app.route('/posts/<int:post_id>/edit', methods=['POST'])
+@bp.route('/posts/<int:post_id>/edit', methods=['POST'])
 def update_post(post_id):
     """Show form to edit post."""
     post = Post.query.get_or_404(post_id)
@@ -134,16 +330,14 @@ def update_post(post_id):
     post.title = request.form['title']
     post.content = request.form['content']
     
-    checkbox_tags_list = request.form.getlist('tags-checkbox')
-    checked_tags_list =  Tag.query.filter(Tag.id.in_(checkbox_tags_list)).all()
-    post.tags = checked_tags_list
+    checkbox_tags_list = request.form.getlist('tags-checkbox', type=int)
+    post.sync_tags(checkbox_tags_list)
     
-    db.session.add(post)
     db.session.commit()
     
     return redirect(f'/posts/{post_id}')
 
-@app.route('/posts/<int:post_id>/delete',  methods=['POST'])
+@bp.route('/posts/<int:post_id>/delete',  methods=['POST'])
 def delete_post(post_id):
     """Delete a post."""
     post = Post.query.get_or_404(post_id)
@@ -155,27 +349,47 @@ def delete_post(post_id):
     return redirect(f'/users/{user_id}')
 
 #Tags routes
-@app.route('/tags')
+@bp.route('/tags')
+@cached_page
 def list_tags():
-    """Lists all tags, with links to the tag detail page."""
-    tags = Tag.query.all()
+    """Lists all tags, with links to the tag detail page.
+    
+    ?sort=popular lists the most-used tags first.
+    """
+    if request.args.get('sort') == 'popular':
+        tags = Tag.query.order_by(Tag.post_count.desc(), Tag.name).all()
+    else:
+        tags = Tag.query.all()
+    depends_on("tags")
     
     return render_template('all_tags.html', tags=tags)
 
-@app.route('/tags/<int:tag_id>')
+@bp.route('/tags/autocomplete')
+def autocomplete_tags():
+    """JSON list of tags whose names start with ?q, for the tag picker."""
+    q = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', current_app.config['TAG_AUTOCOMPLETE_LIMIT'], type=int),
+                current_app.config['TAG_AUTOCOMPLETE_LIMIT'])
+    tags = Tag.autocomplete(q, limit) if q and limit > 0 else []
+    return jsonify([{'id': tag.id, 'name': tag.name} for tag in tags])
+
+@bp.route('/tags/<int:tag_id>')
+@cached_page
 def show_tag_detail(tag_id):
     """Show detail about a tag. Have links to edit form and to delete."""
-    tag = Tag.query.get_or_404(tag_id)
+    tag = Tag.query.options(db.selectinload(Tag.posts)).get_or_404(tag_id)
     posts = tag.posts
+    depends_on(f"tag:{tag.id}", *(f"post:{post.id}" for post in posts),
+               *(f"user:{post.user_id}" for post in posts))
     
     return render_template('show_tag.html', tag=tag, posts=posts)
 
-@app.route('/tags/new')
+@bp.route('/tags/new')
 def  new_tag_form():
     """Form to create a new tag."""
     return render_template('new_tag_form.html')
 
-@app.route('/tags/new', methods=['POST'])
+@bp.route('/tags/new', methods=['POST'])
 def  create_new_tag():
     """Add new tag to database."""
     name = request.form['name']
@@ -186,14 +400,14 @@ def  create_new_tag():
     
     return redirect(f'/tags/{new_tag.id}')
 
-@app.route('/tags/<int:tag_id>/edit')
+@bp.route('/tags/<int:tag_id>/edit')
 def edit_tag_form(tag_id):
     """Form to edit tag"""
     tag = Tag.query.get_or_404(tag_id)
     
     return render_template('edit_tag_form.html', tag=tag)
 
-@app.route('/tags/<int:tag_id>/edit', methods=['POST'])
+@bp.route('/tags/<int:tag_id>/edit', methods=['POST'])
 def update_tag(tag_id):
     """Form to edit tag"""
     tag = Tag.query.get_or_404(tag_id)
@@ -203,14 +417,16 @@ def update_tag(tag_id):
     db.session.add(tag)
     db.session.commit()
     
-    return redirect(f'/tags/{tag.id}')
+    return redirect(f'/tags/{tag_id}')
 
-@app.route('/tags/<int:tag_id>/delete', methods=['POST'])
+@bp.route('/tags/<int:tag_id>/delete', methods=['POST'])
 def delete_tag(tag_id):
-    """Form to edit tag"""
-    tag = Tag.query.get_or_404(tag_id)
+    """Delete tag; tags on many posts go in the background."""
+    tag = Tag.query.options(db.load_only(Tag.post_count)).get_or_404(tag_id)
+    if tag.post_count > current_app.config['ASYNC_DELETE_THRESHOLD']:
+        return queue_deletion('tag', tag_id, tag.post_count, '/tags')
     
-    db.session.delete(tag)
+    purge_tag(tag_id)
     db.session.commit()
     
     return redirect(f'/tags')
\ No newline at end of file
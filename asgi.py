@@ -0,0 +1,289 @@
+"""Experimental async serving mode for the read-only pages.
+
+    uvicorn --factory asgi:create_asgi_app --workers 4
+    gunicorn -k uvicorn.workers.UvicornWorker 'asgi:create_asgi_app()'
+
+GET /users, /posts/<id>, /tags and /tags/<id> are served on the event loop:
+their queries go through SQLAlchemy's asyncio extension over the models in
+models.py, so one thread serves every request waiting on the database, and
+a connection is held only while a request's queries run. They share the
+sync views' templates, page cache, replica routing, request hooks and error
+handlers.
+
+Every other request, HEAD included, is handed to the Flask app on a pool of
+ASYNC_WSGI_THREADS threads and behaves exactly as in sync mode.
+
+It is not yet shown to serve these pages faster than sync mode: no
+benchmarks.concurrency results against PostgreSQL are recorded. Keep
+production on sync mode until they are.
+
+Needs an ASGI server and an async driver: ASYNC_DATABASE_URI defaults to
+SQLALCHEMY_DATABASE_URI with psycopg2 swapped for asyncpg (aiosqlite for
+SQLite), and the replica likewise.
+"""
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import render_template, request, request_started
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound
+
+from app import create_app
+from cache import MemoryCache
+from models import db, User, Post, Tag
+from pool import async_engine_options, enforce_foreign_keys
+from replicas import STICKY_COOKIE
+
+DEFAULT_CONFIG = {
+    'ASYNC_DATABASE_URI': None,
+    'ASYNC_REPLICA_URI': None,
+    'ASYNC_WSGI_THREADS': 16,
+}
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+
+def async_url(uri):
+    """uri with its driver swapped for the backend's asyncio driver."""
+    url = make_url(uri)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+#Async versions of the read views. Each returns (template, context, page
+#cache labels) and loads everything the template touches up front, since
+#an async session can't lazy-load.
+
+async def show_users(session, request, config):
+    """Page showing one page of users, sorted by name."""
+    per_page = config['USERS_PER_PAGE']
+    try:
+        query = User.keyset_page_select(request.args.get('after'), per_page)
+    except ValueError:
+        raise BadRequest()
+    users = (await session.execute(query)).scalars().all()
+    users, next_cursor = User.keyset_page_result(users, per_page)
+    return 'users.html', {'users': users, 'next_cursor': next_cursor}, set()
+
+
+async def show_post(session, request, config, post_id):
+    """Show details for single post, and the posts sharing most of its tags."""
+    post = await session.get(Post, post_id, options=[db.joinedload(Post.users),
+                                                     db.selectinload(Post.tags)])
+    if post is None:
+        raise NotFound()
+    tags = post.tags
+    related = (await session.execute(post.related_select(config['RELATED_POSTS']))).all() if tags else []
+    labels = {f"post:{post.id}", f"user:{post.user_id}", *(f"tag:{tag.id}" for tag in tags),
+              *(f"post:{other.id}" for other, _ in related)}
+    return 'post_detail.html', {'post': post, 'tags': tags, 'related': related}, labels
+
+
+async def list_tags(session, request, config):
+    """Lists all tags; ?sort=popular lists the most-used tags first."""
+    query = db.select(Tag)
+    if request.args.get('sort') == 'popular':
+        query = query.order_by(Tag.post_count.desc(), Tag.name)
+    tags = (await session.execute(query)).scalars().all()
+    return 'all_tags.html', {'tags': tags}, {"tags"}
+
+
+async def show_tag_detail(session, request, config, tag_id):
+    """Show detail about a tag."""
+    tag = await session.get(Tag, tag_id, options=[db.selectinload(Tag.posts)])
+    if tag is None:
+        raise NotFound()
+    posts = tag.posts
+    labels = {f"tag:{tag.id}", *(f"post:{post.id}" for post in posts),
+              *(f"user:{post.user_id}" for post in posts)}
+    return 'show_tag.html', {'tag': tag, 'posts': posts}, labels
+
+
+#Endpoint -> (async view, whether the sync view is @cached_page)
+ASYNC_VIEWS = {
+    'blogly.show_users': (show_users, False),
+    'blogly.show_post': (show_post, True),
+    'blogly.list_tags': (list_tags, True),
+    'blogly.show_tag_detail': (show_tag_detail, True),
+}
+
+
+def wsgi_environ(scope, body):
+    """WSGI environ for an ASGI HTTP request."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name, value = name.decode('latin1'), value.decode('latin1')
+        key = {'content-type': 'CONTENT_TYPE', 'content-length': 'CONTENT_LENGTH'}.get(
+            name, 'HTTP_' + name.upper().replace('-', '_'))
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(wsgi_app, environ):
+    """Run a WSGI app to completion; return (status code, headers, body)."""
+    response = []
+
+    def start_response(status, headers, exc_info=None):
+        response[:] = [int(status.split(' ', 1)[0]), headers]
+
+    chunks = wsgi_app(environ, start_response)
+    try:
+        body = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return response[0], response[1], body
+
+
+class AsyncBlogly:
+    """ASGI app serving ASYNC_VIEWS itself and everything else through flask_app."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        for key, value in DEFAULT_CONFIG.items():
+            flask_app.config.setdefault(key, value)
+        self.executor = ThreadPoolExecutor(flask_app.config['ASYNC_WSGI_THREADS'],
+                                           thread_name_prefix='blogly-wsgi')
+        self._engines = None
+
+    def engines(self):
+        """(primary, replica or None) async engines, created on first use."""
+        if self._engines is None:
+            config = self.flask_app.config
+            engines = []
+            for uri, sync_uri in ((config['ASYNC_DATABASE_URI'], config['SQLALCHEMY_DATABASE_URI']),
+                                  (config['ASYNC_REPLICA_URI'], config['SQLALCHEMY_REPLICA_URI'])):
+                if not (uri or sync_uri):
+                    engines.append(None)
+                    continue
+                url = make_url(uri) if uri else async_url(sync_uri)
+                engine = create_async_engine(url, **async_engine_options(config, url))
+                enforce_foreign_keys(engine.sync_engine)
+                engines.append(engine)
+            self._engines = tuple(engines)
+        return self._engines
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        environ = wsgi_environ(scope, bytes(body))
+
+        view = self.match(environ)
+        if view is None:
+            status, headers, body = await asyncio.get_running_loop().run_in_executor(
+                self.executor, call_wsgi, self.flask_app, environ)
+        else:
+            status, headers, body = await self.serve(environ, *view)
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                                for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in self._engines or ():
+                    if engine is not None:
+                        await engine.dispose()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def match(self, environ):
+        """(async view, cached, url kwargs) for a GET of an ASYNC_VIEWS route, else None.
+
+        HEAD goes to Flask, which answers it without a body.
+        """
+        if environ['REQUEST_METHOD'] != 'GET':
+            return None
+        try:
+            endpoint, kwargs = self.flask_app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            # Not found, redirects and the like: Flask answers those as usual
+            return None
+        if endpoint not in ASYNC_VIEWS:
+            return None
+        return (*ASYNC_VIEWS[endpoint], kwargs)
+
+    async def cache_call(self, cache, method, *args):
+        """Call a page cache method, off the event loop unless it's in-process."""
+        if isinstance(cache, MemoryCache):
+            return method(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    async def serve(self, environ, view, cached, kwargs):
+        """Run an async view the way Flask runs the sync one, request hooks and error handlers included.
+
+        The request context lives in this request's task, so it holds across awaits.
+        """
+        app = self.flask_app
+        with app.request_context(environ):
+            try:
+                app.try_trigger_before_first_request_functions()
+                request_started.send(app)
+                response = app.preprocess_request()
+                if response is None:
+                    response = await self.render(view, cached, kwargs)
+            except Exception as e:
+                response = app.handle_user_exception(e)
+            return call_wsgi(app.finalize_request(response), environ)
+
+    async def render(self, view, cached, kwargs):
+        """The response of an async view, through the page cache when the sync view uses it."""
+        app = self.flask_app
+        cache = app.extensions.get('page_cache') if cached and not request.args else None
+
+        if cache is not None:
+            body = await self.cache_call(cache, cache.get, request.path)
+            if body is not None:
+                return app.response_class(body, mimetype='text/html', headers={'X-Page-Cache': 'HIT'})
+            generation = cache.generation
+
+        primary, replica = self.engines()
+        engine = replica if replica is not None and STICKY_COOKIE not in request.cookies else primary
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            template, context, labels = await view(session, request, app.config, **kwargs)
+
+        body = render_template(template, **context).encode()
+        if cache is None:
+            return app.response_class(body, mimetype='text/html')
+        if labels:
+            await self.cache_call(cache, cache.set, request.path, body, frozenset(labels), generation)
+        return app.response_class(body, mimetype='text/html', headers={'X-Page-Cache': 'MISS'})
+
+
+def create_asgi_app(config=None):
+    """Build the Blogly app for an ASGI server; config overrides DEFAULT_CONFIG."""
+    return AsyncBlogly(create_app(config))
@@ -0,0 +1,291 @@
+"""Local thumbnails of user avatars.
+
+User.image_url can point anywhere, so a page embedding it loads only as
+fast as whatever host the user pasted. With AVATAR_CACHE_DIR set,
+create_user and update_user fetch the image once, when it's saved, and
+write a square thumbnail for each of AVATAR_SIZES named by the SHA-256 of
+the source image. Users with the same picture share files, and a name never
+changes meaning, so /avatars/ serves them with a long-lived immutable
+Cache-Control. User.avatar_key records the digest; pages fall back to the
+raw image_url while it's unset (caching is off or the fetch failed).
+
+The directory is an LRU cache capped at AVATAR_CACHE_MAX_BYTES: serving a
+file bumps its mtime and each store evicts the least recently served files.
+An evicted thumbnail is rebuilt from image_url on its next request.
+
+Thumbnails are resized with Pillow when it is installed; without it the
+source image is stored as-is. Only http(s) URLs on public addresses are
+fetched, unless AVATAR_ALLOW_PRIVATE_HOSTS is set. Each connection goes to
+an address checked when it's opened, so a host whose DNS answer changes
+after the check can't send the fetch to a private address.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import logging
+import os
+import re
+import socket
+import tempfile
+import urllib.request
+from urllib.parse import urlsplit
+
+from flask import Blueprint, abort, current_app, redirect, send_from_directory, url_for
+
+from models import db, User
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger('blogly.avatars')
+
+DEFAULT_CONFIG = {
+    'AVATAR_CACHE_DIR': None,
+    'AVATAR_SIZES': (256, 512),
+    'AVATAR_CACHE_MAX_BYTES': 256 * 1024 * 1024,
+    'AVATAR_MAX_BYTES': 5 * 1024 * 1024,
+    'AVATAR_FETCH_TIMEOUT': 5,
+    'AVATAR_MAX_AGE': 365 * 24 * 60 * 60,
+    'AVATAR_JPEG_QUALITY': 85,
+    'AVATAR_ALLOW_PRIVATE_HOSTS': False,
+}
+
+#Formats stored as fetched when Pillow isn't installed
+EXTENSIONS = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/gif': 'gif', 'image/webp': 'webp'}
+FILENAME = re.compile(r'([0-9a-f]{64})-(\d+)\.(jpg|png|gif|webp)')
+
+avatars = Blueprint('avatars', __name__)
+
+
+class AvatarError(Exception):
+    """An image that couldn't be fetched or decoded."""
+
+
+def check_url(url, allow_private=False):
+    """Raise AvatarError unless url is http(s) on a host with only public addresses."""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise AvatarError(f"Not an http(s) URL: {url!r}")
+    if not allow_private:
+        _resolve_public(parts.hostname, parts.port)
+
+
+def _resolve_public(host, port):
+    """Return getaddrinfo's TCP results for host; raise AvatarError if any address isn't public."""
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError, ValueError) as e:
+        raise AvatarError(f"Can't resolve {host}: {e}") from e
+    if not all(ipaddress.ip_address(info[4][0].split('%')[0]).is_global for info in infos):
+        raise AvatarError(f"{host} has a non-public address")
+    return infos
+
+
+def _create_public_connection(address, timeout, source_address=None):
+    """socket.create_connection to an address of host that was checked just now."""
+    host, port = address
+    error = None
+    for *_, sockaddr in _resolve_public(host, port):
+        try:
+            return socket.create_connection(sockaddr[:2], timeout, source_address)
+        except OSError as e:
+            error = e
+    raise error
+
+
+class _PublicConnection:
+    """Connect through _create_public_connection; Host and SNI still name the host."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_public_connection
+
+
+class _PublicHTTPConnection(_PublicConnection, http.client.HTTPConnection):
+    pass
+
+
+class _PublicHTTPSConnection(_PublicConnection, http.client.HTTPSConnection):
+    pass
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def do_open(self, http_class, req, **kwargs):
+        return super().do_open(_PublicHTTPConnection, req, **kwargs)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def do_open(self, http_class, req, **kwargs):
+        return super().do_open(_PublicHTTPSConnection, req, **kwargs)
+
+
+class _CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    """Apply check_url to every redirect, not just the first URL."""
+
+    def __init__(self, allow_private):
+        self.allow_private = allow_private
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url(newurl, self.allow_private)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch_image(url, config):
+    """Download the image at url; return (bytes, content type)."""
+    allow_private = config['AVATAR_ALLOW_PRIVATE_HOSTS']
+    check_url(url, allow_private)
+    handlers = [_CheckedRedirects(allow_private)]
+    if not allow_private:
+        # No proxy either: the address checked must be the one connected to
+        handlers += [urllib.request.ProxyHandler({}), _PublicHTTPHandler(), _PublicHTTPSHandler()]
+    opener = urllib.request.build_opener(*handlers)
+    request = urllib.request.Request(url, headers={'User-Agent': 'Blogly avatar fetcher'})
+    try:
+        with opener.open(request, timeout=config['AVATAR_FETCH_TIMEOUT']) as resp:
+            content_type = resp.headers.get_content_type()
+            data = resp.read(config['AVATAR_MAX_BYTES'] + 1)
+    except (OSError, ValueError) as e:
+        raise AvatarError(f"Can't fetch {url}: {e}") from e
+
+    if not content_type.startswith('image/'):
+        raise AvatarError(f"{url} is {content_type}, not an image")
+    if len(data) > config['AVATAR_MAX_BYTES']:
+        raise AvatarError(f"{url} is over {config['AVATAR_MAX_BYTES']} bytes")
+    return data, content_type
+
+
+def make_thumbnails(data, content_type, config):
+    """Return (extension, {size: bytes}) of square thumbnails of an image."""
+    sizes = config['AVATAR_SIZES']
+    if Image is None:
+        if content_type not in EXTENSIONS:
+            raise AvatarError(f"Can't store {content_type} without Pillow")
+        return EXTENSIONS[content_type], dict.fromkeys(sizes, data)
+
+    try:
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise AvatarError(f"Can't decode image: {e}") from e
+    thumbnails = {}
+    for size in sizes:
+        buf = io.BytesIO()
+        ImageOps.fit(image, (size, size), Image.LANCZOS).save(
+            buf, 'JPEG', quality=config['AVATAR_JPEG_QUALITY'], optimize=True)
+        thumbnails[size] = buf.getvalue()
+    return 'jpg', thumbnails
+
+
+def thumbnail_name(key, size):
+    digest, extension = key.split('.')
+    return f"{digest}-{size}.{extension}"
+
+
+def load_avatar(url, config):
+    """Fetch url and thumbnail it; return (avatar key, {size: bytes})."""
+    data, content_type = fetch_image(url, config)
+    extension, thumbnails = make_thumbnails(data, content_type, config)
+    return f"{hashlib.sha256(data).hexdigest()}.{extension}", thumbnails
+
+
+def store(directory, key, thumbnails):
+    """Write thumbnails under key, each atomically; refresh ones already there."""
+    os.makedirs(directory, exist_ok=True)
+    for size, data in thumbnails.items():
+        path = os.path.join(directory, thumbnail_name(key, size))
+        if os.path.exists(path):
+            os.utime(path)
+            continue
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+def prune(directory, max_bytes):
+    """Delete the least recently used thumbnails until directory holds max_bytes; return how many."""
+    files = [(entry.stat(), entry.path) for entry in os.scandir(directory)
+             if entry.is_file() and not entry.name.startswith('.')]
+    total = sum(stat.st_size for stat, _ in files)
+    removed = 0
+    for stat, path in sorted(files, key=lambda item: item[0].st_mtime):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= stat.st_size
+        removed += 1
+    return removed
+
+
+def save_avatar(url):
+    """Cache thumbnails of the image at url; return its avatar key, or None if it can't be.
+
+    Returns None without fetching anything unless AVATAR_CACHE_DIR is set.
+    """
+    config = current_app.config
+    directory = config['AVATAR_CACHE_DIR']
+    if not directory:
+        return None
+    try:
+        key, thumbnails = load_avatar(url, config)
+    except AvatarError as e:
+        logger.warning("Avatar not cached: %s", e)
+        return None
+    store(directory, key, thumbnails)
+    prune(directory, config['AVATAR_CACHE_MAX_BYTES'])
+    return key
+
+
+def avatar_url(user, size):
+    """URL of user's avatar thumbnail at size, or image_url if there is none."""
+    if user.avatar_key and current_app.config['AVATAR_CACHE_DIR']:
+        return url_for('avatars.show_avatar', filename=thumbnail_name(user.avatar_key, size))
+    return user.image_url
+
+
+@avatars.route('/avatars/<filename>')
+def show_avatar(filename):
+    """Serve a thumbnail, rebuilding it from its user's image_url if it was evicted."""
+    config = current_app.config
+    directory = config['AVATAR_CACHE_DIR']
+    match = FILENAME.fullmatch(filename)
+    if not directory or not match or int(match[2]) not in config['AVATAR_SIZES']:
+        abort(404)
+
+    try:
+        os.utime(os.path.join(directory, filename))
+    except FileNotFoundError:
+        key = f"{match[1]}.{match[3]}"
+        image_url = db.session.query(User.image_url).filter(User.avatar_key == key).limit(1).scalar()
+        if image_url is None:
+            abort(404)
+        # Don't hold a pooled connection through the fetch
+        db.session.close()
+        try:
+            new_key, thumbnails = load_avatar(image_url, config)
+        except AvatarError as e:
+            logger.warning("Avatar not rebuilt: %s", e)
+            return redirect(image_url)
+        # The image changed since it was saved; the user's next edit picks it up
+        if new_key != key:
+            return redirect(image_url)
+        store(directory, key, thumbnails)
+        prune(directory, config['AVATAR_CACHE_MAX_BYTES'])
+
+    resp = send_from_directory(directory, filename, max_age=config['AVATAR_MAX_AGE'])
+    resp.cache_control.immutable = True
+    return resp
+
+
+def init_avatars(app):
+    """Set avatar defaults, register /avatars/ and the avatar_url template helper."""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    app.register_blueprint(avatars)
+    app.add_template_global(avatar_url)
@@ -0,0 +1 @@
+"""Benchmarks for Blogly; run each with `python -m benchmarks.<name>`."""
@@ -0,0 +1,162 @@
+"""Compare concurrent-request throughput of the sync and async serving modes.
+
+Rebuilds the schema in --database-url (never point it at real data), fills
+it with benchmarks.datagen, then at each --concurrency level sends
+--requests GETs spread over the async read pages (/users, /posts/<id>,
+/tags, /tags/<id>) to:
+
+- sync: the Flask app on that many threads, like a threaded WSGI worker;
+- async: asgi.py's app as that many tasks on one event loop, like one
+  uvicorn worker.
+
+Both modes get the same DB_POOL_SIZE / DB_MAX_OVERFLOW pool and no page
+cache. Requests are made in-process, without an HTTP server, so the numbers
+compare the serving models rather than a server's HTTP parsing. Needs
+asyncpg (aiosqlite for a SQLite URL):
+
+    python -m benchmarks.concurrency --concurrency 1 8 32 128 --requests 2000
+
+Recorded so far, only against SQLite (benchmarks/concurrency-sqlite.json,
+1000 users and 10000 posts, 1000 requests per level, one machine): sync
+served 104, 90 and 81 req/s at concurrency 1, 8 and 32, async 94, 91 and
+90. The gap is within run-to-run noise; neither mode is clearly ahead.
+aiosqlite runs each query on a thread of its own, so SQLite says nothing
+about the PostgreSQL case async mode is meant for, and that case is still
+unmeasured. Record it with --output before putting async mode in
+production.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from asgi import call_wsgi, create_asgi_app, wsgi_environ
+from benchmarks.datagen import generate
+from benchmarks.routes import Fixtures, percentile
+from migrations import upgrade
+from models import db
+
+
+def request_paths(fixtures, count):
+    """count (path, query string) pairs cycling through the async read pages."""
+    makers = (lambda: ('/users', b''), lambda: (f'/posts/{fixtures.post_id()}', b''),
+              lambda: ('/tags', b''), lambda: (f'/tags/{fixtures.tag_id()}', b''))
+    return [makers[i % len(makers)]() for i in range(count)]
+
+
+def http_scope(path, query):
+    return {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': [],
+            'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 80)}
+
+
+def summarize(latencies, elapsed):
+    return {'requests_per_s': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3)}
+
+
+def run_sync(flask_app, paths, concurrency):
+    """Serve paths through the WSGI app on concurrency threads."""
+    latencies = []
+
+    def get(path_query):
+        start = perf_counter()
+        status, _, _ = call_wsgi(flask_app, wsgi_environ(http_scope(*path_query), b''))
+        latencies.append((perf_counter() - start) * 1000)
+        if status != 200:
+            raise RuntimeError(f"GET {path_query[0]} returned {status}")
+
+    started = perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(get, paths))
+    return summarize(latencies, perf_counter() - started)
+
+
+async def run_async(asgi_app, paths, concurrency):
+    """Serve paths through the ASGI app with concurrency tasks on this loop."""
+    latencies = []
+    pending = iter(paths)
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def worker():
+        for path, query in pending:
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            start = perf_counter()
+            await asgi_app(http_scope(path, query), receive, send)
+            latencies.append((perf_counter() - start) * 1000)
+            if sent[0]['status'] != 200:
+                raise RuntimeError(f"GET {path} returned {sent[0]['status']}")
+
+    started = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, perf_counter() - started)
+
+
+async def run_all_async(asgi_app, fixtures, levels, requests, warmup):
+    try:
+        await run_async(asgi_app, request_paths(fixtures, warmup), 1)
+        return {level: await run_async(asgi_app, request_paths(fixtures, requests), level)
+                for level in levels}
+    finally:
+        for engine in asgi_app.engines():
+            if engine is not None:
+                await engine.dispose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default='postgresql:///blogly_bench')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts-per-user', type=int, default=10)
+    parser.add_argument('--tags', type=int, default=50)
+    parser.add_argument('--tags-per-post', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--requests', type=int, default=2000, help="Requests per concurrency level.")
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--output', help="Also write the results here as JSON.")
+    args = parser.parse_args(argv)
+
+    asgi_app = create_asgi_app({'SQLALCHEMY_DATABASE_URI': args.database_url, 'PAGE_CACHE': None,
+                                'SLOW_QUERY_THRESHOLD_MS': float('inf'),
+                                'ASYNC_WSGI_THREADS': max(args.concurrency)})
+    flask_app = asgi_app.flask_app
+
+    with flask_app.app_context():
+        db.drop_all()
+        upgrade()
+        started = perf_counter()
+        counts = generate(users=args.users, posts_per_user=args.posts_per_user,
+                          tags=args.tags, tags_per_post=args.tags_per_post)
+        print(f"Generated {counts} in {perf_counter() - started:.1f}s", file=sys.stderr)
+
+    fixtures = Fixtures(counts)
+    run_sync(flask_app, request_paths(fixtures, args.warmup), 1)
+    results = {'sync': {level: run_sync(flask_app, request_paths(fixtures, args.requests), level)
+                        for level in args.concurrency},
+               'async': asyncio.run(run_all_async(asgi_app, fixtures, args.concurrency,
+                                                  args.requests, args.warmup))}
+
+    for level in args.concurrency:
+        sync, async_ = results['sync'][level], results['async'][level]
+        print(f"concurrency {level:>4}   sync {sync['requests_per_s']:>8.1f} req/s "
+              f"p95 {sync['p95_ms']:8.2f}ms   async {async_['requests_per_s']:>8.1f} req/s "
+              f"p95 {async_['p95_ms']:8.2f}ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'database': flask_app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+                       'counts': counts, **results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""Synthetic Blogly data for benchmarks.
+
+Rows are generated lazily and loaded through bulk.import_records (COPY on
+PostgreSQL), so large data sets don't need to fit in memory.
+"""
+
+import random
+from datetime import datetime, timedelta
+
+from bulk import import_records
+from models import db, rebuild_timeline, repair_post_counters, User, Post, Tag, PostTag
+
+WORDS = ('travel coding recipes garden music python flask postgres index query '
+         'cache latency river mountain coffee bread paint camera bicycle winter').split()
+START = datetime(2020, 1, 1)
+
+
+def generate(users=100, posts_per_user=10, tags=50, tags_per_post=3, seed=0, batch_size=5000):
+    """Fill an empty database and return the number of rows per table.
+
+    Ids are assigned explicitly from 1; posts are spread a minute apart.
+    """
+    rng = random.Random(seed)
+    post_count = users * posts_per_user
+    tags_per_post = min(tags_per_post, tags)
+
+    def user_rows():
+        for user_id in range(1, users + 1):
+            yield {'id': user_id, 'first_name': f"First{user_id}",
+                   'last_name': f"Last{rng.randrange(users)}",
+                   'image_url': f"https://example.com/avatars/{user_id}.png"}
+
+    def tag_rows():
+        for tag_id in range(1, tags + 1):
+            yield {'id': tag_id, 'name': f"tag{tag_id}"}
+
+    def post_rows():
+        for post_id in range(1, post_count + 1):
+            yield {'id': post_id, 'title': f"Post {post_id} {rng.choice(WORDS)}",
+                   'content': ' '.join(rng.choices(WORDS, k=40)),
+                   'created_at': START + timedelta(minutes=post_id),
+                   'user_id': (post_id - 1) // posts_per_user + 1}
+
+    def post_tag_rows():
+        for post_id in range(1, post_count + 1):
+            for tag_id in rng.sample(range(1, tags + 1), tags_per_post):
+                yield {'post_id': post_id, 'tag_id': tag_id}
+
+    counts = {
+        'users': import_records(User.__table__, user_rows(), batch_size),
+        'tags': import_records(Tag.__table__, tag_rows(), batch_size),
+        'posts': import_records(Post.__table__, post_rows(), batch_size),
+        'posts_tags': import_records(PostTag.__table__, post_tag_rows(), batch_size),
+    }
+    repair_post_counters()
+    rebuild_timeline()
+    db.session.commit()
+    return counts
@@ -0,0 +1,102 @@
+"""Compare feed latency with and without the tag_timeline table.
+
+Rebuilds the schema in --database-url (never point it at real data), fills
+it with benchmarks.datagen, then times the global feed and the feeds of the
+most-used tags, on the first page and --depth pages in, once with
+FEED_TIMELINE on and once off:
+
+    python -m benchmarks.feeds --users 2000 --posts-per-user 50 --tags 20
+"""
+
+import argparse
+import json
+import sys
+from time import perf_counter
+
+from app import create_app
+from benchmarks.datagen import generate
+from benchmarks.routes import percentile
+from migrations import upgrade
+from models import db, Post, Tag
+
+
+def cursor_at(tag_id, depth, per_page):
+    """The ?after cursor for page depth + 1 of a feed, or None if it's shorter."""
+    cursor = None
+    for _ in range(depth):
+        _, cursor = Post.feed(tag_id=tag_id, after=cursor, per_page=per_page)
+        if cursor is None:
+            return None
+    return cursor
+
+
+def time_feed(client, url, runs):
+    """Return (p50, p95) ms and statements per request for GETs of url."""
+    samples, queries = [], 0
+    for _ in range(runs):
+        start = perf_counter()
+        resp = client.get(url)
+        samples.append((perf_counter() - start) * 1000)
+        if resp.status_code != 200:
+            raise RuntimeError(f"GET {url} returned {resp.status_code}")
+        queries = int(resp.headers.get('X-DB-Query-Count', 0))
+    return round(percentile(samples, 50), 3), round(percentile(samples, 95), 3), queries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default='postgresql:///blogly_bench')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--posts-per-user', type=int, default=40)
+    parser.add_argument('--tags', type=int, default=20)
+    parser.add_argument('--tags-per-post', type=int, default=3)
+    parser.add_argument('--feed-tags', type=int, default=3, help="How many of the most-used tags to time.")
+    parser.add_argument('--depth', type=int, default=20, help="Page number of the deep-page samples.")
+    parser.add_argument('--runs', type=int, default=30)
+    parser.add_argument('--output', help="Also write the results here as JSON.")
+    args = parser.parse_args(argv)
+
+    config = {'SQLALCHEMY_DATABASE_URI': args.database_url, 'PAGE_CACHE': None,
+              'SLOW_QUERY_THRESHOLD_MS': float('inf')}
+    apps = {'timeline': create_app({**config, 'FEED_TIMELINE': True}),
+            'join': create_app({**config, 'FEED_TIMELINE': False})}
+    per_page = apps['timeline'].config['FEED_PER_PAGE']
+
+    with apps['timeline'].app_context():
+        db.drop_all()
+        upgrade()
+        started = perf_counter()
+        counts = generate(users=args.users, posts_per_user=args.posts_per_user,
+                          tags=args.tags, tags_per_post=args.tags_per_post)
+        print(f"Generated {counts} in {perf_counter() - started:.1f}s", file=sys.stderr)
+
+        urls = {'global': '/feed'}
+        deep = cursor_at(None, args.depth, per_page)
+        if deep:
+            urls[f'global page {args.depth + 1}'] = f'/feed?after={deep}'
+        for (tag_id,) in db.session.query(Tag.id).order_by(Tag.post_count.desc()).limit(args.feed_tags):
+            urls[f'tag {tag_id}'] = f'/tags/{tag_id}/feed'
+            deep = cursor_at(tag_id, args.depth, per_page)
+            if deep:
+                urls[f'tag {tag_id} page {args.depth + 1}'] = f'/tags/{tag_id}/feed?after={deep}'
+
+    results = {}
+    for name, url in urls.items():
+        results[name] = {}
+        for mode, app in apps.items():
+            with app.test_client() as client, app.app_context():
+                client.get(url)
+                p50, p95, queries = time_feed(client, url, args.runs)
+            results[name][mode] = {'p50_ms': p50, 'p95_ms': p95, 'queries': queries}
+        timeline, join = results[name]['timeline'], results[name]['join']
+        print(f"{name:<22} timeline p50 {timeline['p50_ms']:8.2f} p95 {timeline['p95_ms']:8.2f} ms   "
+              f"join p50 {join['p50_ms']:8.2f} p95 {join['p95_ms']:8.2f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'counts': counts, 'feeds': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
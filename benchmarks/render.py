@@ -0,0 +1,103 @@
+"""Benchmark rendering users.html and show_tag.html at large row counts.
+
+Renders with stand-in rows, so no database is needed, and reports:
+
+- template load time from source and from a warm bytecode cache;
+- render time percentiles at each row count;
+- body size raw, gzipped and brotli-compressed, with the time to compress.
+
+    python -m benchmarks.render --rows 100 1000 10000 --runs 20
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+from time import perf_counter
+from types import SimpleNamespace
+
+from app import create_app
+from benchmarks.routes import percentile
+from compression import compressors
+from templating import precompile_templates
+
+TEMPLATES = ('users.html', 'show_tag.html')
+
+
+def context_for(template, rows):
+    """Template variables for template with rows listed."""
+    if template == 'users.html':
+        users = [SimpleNamespace(id=i, full_name=f"First{i} Last{i}", post_count=i % 50)
+                 for i in range(rows)]
+        return {'users': users, 'next_cursor': 'eyJuZXh0IjogMX0='}
+    posts = [SimpleNamespace(id=i, title=f"Post number {i}") for i in range(rows)]
+    return {'tag': SimpleNamespace(id=1, name="benchmark", post_count=rows), 'posts': posts}
+
+
+def load_times(template, cache_dir, runs):
+    """Median ms to load template into a fresh environment, from source and from bytecode."""
+    timings = {}
+    for label, config in (('source', {}), ('bytecode', {'JINJA_BYTECODE_CACHE_DIR': cache_dir})):
+        samples = []
+        for _ in range(runs):
+            app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', **config})
+            start = perf_counter()
+            app.jinja_env.get_template(template)
+            samples.append((perf_counter() - start) * 1000)
+        timings[f'load_{label}_ms'] = round(percentile(samples, 50), 3)
+    return timings
+
+
+def render_stats(app, template, rows, runs):
+    """Render percentiles and compressed sizes for one row count."""
+    compiled = app.jinja_env.get_template(template)
+    context = context_for(template, rows)
+    samples = []
+    with app.test_request_context():
+        for _ in range(runs):
+            start = perf_counter()
+            body = compiled.render(**context).encode()
+            samples.append((perf_counter() - start) * 1000)
+
+    stats = {'rows': rows, 'render_p50_ms': round(percentile(samples, 50), 3),
+             'render_p95_ms': round(percentile(samples, 95), 3), 'bytes': len(body)}
+    for name, compress in compressors(app.config).items():
+        start = perf_counter()
+        stats[f'{name}_bytes'] = len(compress(body))
+        stats[f'{name}_ms'] = round((perf_counter() - start) * 1000, 3)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--output', help="Also write the results here as JSON.")
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'JINJA_BYTECODE_CACHE_DIR': cache_dir})
+        precompile_templates(app)
+
+        for template in TEMPLATES:
+            results[template] = {**load_times(template, cache_dir, args.runs),
+                                 'renders': [render_stats(app, template, rows, args.runs)
+                                             for rows in args.rows]}
+            loads = results[template]
+            print(f"{template}: load {loads['load_source_ms']:.2f}ms from source, "
+                  f"{loads['load_bytecode_ms']:.2f}ms from bytecode")
+            for stats in loads['renders']:
+                sizes = '  '.join(f"{name} {stats[f'{name}_bytes']:>9,}B in {stats[f'{name}_ms']:.2f}ms"
+                                  for name in ('gzip', 'br') if f'{name}_bytes' in stats)
+                print(f"  {stats['rows']:>7} rows  p50 {stats['render_p50_ms']:8.2f}ms  "
+                      f"p95 {stats['render_p95_ms']:8.2f}ms  {stats['bytes']:>10,}B  {sizes}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
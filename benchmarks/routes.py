@@ -0,0 +1,260 @@
+"""Benchmark every route in app.py against generated data.
+
+Rebuilds the schema in --database-url (never point it at real data), fills
+it with benchmarks.datagen, then drives each route through the Flask test
+client and reports p50/p95/p99 latency, SQL statements per request and peak
+Python memory:
+
+    python -m benchmarks.routes --users 1000 --posts-per-user 20 --output results.json
+    python -m benchmarks.routes --baseline benchmarks/baseline-postgresql.json --tolerance 0.25
+
+With --baseline, exits non-zero if any route's p95 grew by more than the
+tolerance plus --slack-ms, or it issues more statements than the baseline
+recorded, or the baseline was recorded against another database or data
+size.
+
+benchmarks/baseline-sqlite.json was recorded with the defaults against a
+SQLite file (--database-url sqlite:////tmp/bench.db) on one machine. Its
+statement counts hold anywhere; its timings only compare on similar
+hardware, where the slowest routes vary by up to a third between runs, so
+pass a --tolerance of 0.4 or so. There is no PostgreSQL baseline yet:
+record one with --output benchmarks/baseline-postgresql.json.
+"""
+
+import argparse
+import itertools
+import json
+import math
+import random
+import sys
+import tracemalloc
+from time import perf_counter
+
+from sqlalchemy.engine import make_url
+
+from app import create_app
+from benchmarks.datagen import generate
+from migrations import upgrade
+from models import db, User, Post, Tag, DeletionJob
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+class Fixtures:
+    """Ids to request, plus fresh rows for routes that delete or create."""
+
+    def __init__(self, counts, seed=0):
+        self.rng = random.Random(seed)
+        self.counts = counts
+        self.serial = itertools.count()
+
+    def user_id(self):
+        return self.rng.randint(1, self.counts['users'])
+
+    def post_id(self):
+        return self.rng.randint(1, self.counts['posts'])
+
+    def tag_id(self):
+        return self.rng.randint(1, self.counts['tags'])
+
+    def tag_ids(self, k=3):
+        return [self.tag_id() for _ in range(k)]
+
+    def fresh(self, model, **fields):
+        obj = model(**fields)
+        db.session.add(obj)
+        db.session.commit()
+        return obj.id
+
+    def fresh_user(self):
+        return self.fresh(User, first_name="Fresh", last_name=f"User{next(self.serial)}")
+
+    def fresh_post(self):
+        return self.fresh(Post, title="Fresh", content="Fresh content", user_id=self.user_id())
+
+    def fresh_tag(self):
+        return self.fresh(Tag, name=f"fresh{next(self.serial)}")
+
+    def fresh_deletion(self):
+        return self.fresh(DeletionJob, kind='user', target_id=0, state='done', total=0)
+
+
+def user_form(fx):
+    return {'first-name': "Bench", 'last-name': f"User{next(fx.serial)}",
+            'image-url': "https://example.com/bench.png"}
+
+
+def post_form(fx):
+    return {'title': "Bench post", 'content': "Benchmark content", 'tags-checkbox': fx.tag_ids()}
+
+
+# name -> (method, prepare) where prepare(fixtures) returns (url, form data)
+ROUTES = {
+    'index': ('GET', lambda fx: ('/', None)),
+    'show_deletion': ('GET', lambda fx: (f'/deletions/{fx.fresh_deletion()}', None)),
+    'show_users': ('GET', lambda fx: ('/users', None)),
+    'show_new_user_form': ('GET', lambda fx: ('/users/new', None)),
+    'create_user': ('POST', lambda fx: ('/users/new', user_form(fx))),
+    'show_user_detail': ('GET', lambda fx: (f'/users/{fx.user_id()}', None)),
+    'edit_user_detail': ('GET', lambda fx: (f'/users/{fx.user_id()}/edit', None)),
+    'update_user': ('POST', lambda fx: (f'/users/{fx.user_id()}/edit', user_form(fx))),
+    'delete_user': ('POST', lambda fx: (f'/users/{fx.fresh_user()}/delete', None)),
+    'new_post_form': ('GET', lambda fx: (f'/users/{fx.user_id()}/posts/new', None)),
+    'handle_adding_new_post': ('POST', lambda fx: (f'/users/{fx.user_id()}/posts/new', post_form(fx))),
+    'show_feed': ('GET', lambda fx: ('/feed', None)),
+    'show_tag_feed': ('GET', lambda fx: (f'/tags/{fx.tag_id()}/feed', None)),
+    'search_posts': ('GET', lambda fx: ('/posts/search?q=coffee+bread', None)),
+    'show_tagged_posts': ('GET', lambda fx: ('/posts/tagged?' + '&'.join(
+        f'tag={tag_id}' for tag_id in fx.tag_ids(2)), None)),
+    'show_tagged_posts_any': ('GET', lambda fx: ('/posts/tagged?match=any&' + '&'.join(
+        f'tag={tag_id}' for tag_id in fx.tag_ids(2)), None)),
+    'show_post': ('GET', lambda fx: (f'/posts/{fx.post_id()}', None)),
+    'show_edit_post_form': ('GET', lambda fx: (f'/posts/{fx.post_id()}/edit', None)),
+    'update_post': ('POST', lambda fx: (f'/posts/{fx.post_id()}/edit', post_form(fx))),
+    'delete_post': ('POST', lambda fx: (f'/posts/{fx.fresh_post()}/delete', None)),
+    'list_tags': ('GET', lambda fx: ('/tags', None)),
+    'autocomplete_tags': ('GET', lambda fx: (f'/tags/autocomplete?q=tag{fx.rng.randint(1, 9)}', None)),
+    'show_tag_detail': ('GET', lambda fx: (f'/tags/{fx.tag_id()}', None)),
+    'new_tag_form': ('GET', lambda fx: ('/tags/new', None)),
+    'create_new_tag': ('POST', lambda fx: ('/tags/new', {'name': f"bench{next(fx.serial)}"})),
+    'edit_tag_form': ('GET', lambda fx: (f'/tags/{fx.tag_id()}/edit', None)),
+    'update_tag': ('POST', lambda fx: (f'/tags/{fx.fresh_tag()}/edit', {'name': f"bench{next(fx.serial)}"})),
+    'delete_tag': ('POST', lambda fx: (f'/tags/{fx.fresh_tag()}/delete', None)),
+}
+
+
+def run_route(client, fixtures, method, prepare, iterations, memory_iterations, warmup=3):
+    """Time iterations requests, then measure peak memory over a few more.
+
+    The first `warmup` requests compile templates and fill statement caches
+    and aren't counted.
+    """
+    for _ in range(warmup):
+        url, data = prepare(fixtures)
+        client.open(url, method=method, data=data)
+
+    latencies, queries = [], []
+    for _ in range(iterations):
+        url, data = prepare(fixtures)
+        db.session.remove()
+        start = perf_counter()
+        resp = client.open(url, method=method, data=data)
+        latencies.append((perf_counter() - start) * 1000)
+        if resp.status_code >= 400:
+            raise RuntimeError(f"{method} {url} returned {resp.status_code}")
+        queries.append(int(resp.headers.get('X-DB-Query-Count', 0)))
+
+    tracemalloc.start()
+    try:
+        for _ in range(memory_iterations):
+            url, data = prepare(fixtures)
+            db.session.remove()
+            tracemalloc.reset_peak()
+            client.open(url, method=method, data=data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'queries_per_request': max(queries),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+#Config that must match for timings to be comparable
+COMPARABLE = ('database', 'users', 'posts_per_user', 'tags', 'tags_per_post', 'page_cache')
+
+
+def find_regressions(results, baseline, tolerance, slack_ms=0.0):
+    """Return messages for routes slower or chattier than baseline.
+
+    A p95 regresses when it exceeds the baseline's by the tolerance plus
+    slack_ms, which keeps scheduler noise on sub-millisecond routes out.
+    """
+    mismatched = [key for key in COMPARABLE if results['config'].get(key) != baseline['config'].get(key)]
+    if mismatched:
+        return [f"baseline {key} is {baseline['config'].get(key)!r}, this run's {results['config'].get(key)!r}"
+                for key in mismatched]
+    problems = []
+    for name, base in baseline['routes'].items():
+        current = results['routes'].get(name)
+        if current is None:
+            continue
+        if current['p95_ms'] > base['p95_ms'] * (1 + tolerance) + slack_ms:
+            problems.append(f"{name}: p95 {current['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if current['queries_per_request'] > base['queries_per_request']:
+            problems.append(f"{name}: {current['queries_per_request']} queries vs baseline "
+                            f"{base['queries_per_request']}")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default='postgresql:///blogly_bench')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts-per-user', type=int, default=10)
+    parser.add_argument('--tags', type=int, default=100)
+    parser.add_argument('--tags-per-post', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--memory-iterations', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--routes', nargs='*', default=sorted(ROUTES), choices=sorted(ROUTES))
+    parser.add_argument('--page-cache', action='store_true', help="Leave the page cache on.")
+    parser.add_argument('--output', help="Write results JSON here (e.g. a new baseline).")
+    parser.add_argument('--baseline', help="Compare against this results JSON.")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed p95 growth over the baseline, as a fraction.")
+    parser.add_argument('--slack-ms', type=float, default=2.0,
+                        help="Allowed p95 growth over the baseline on top of the tolerance, in ms.")
+    args = parser.parse_args(argv)
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database_url,
+                      'PAGE_CACHE': 'memory' if args.page_cache else None,
+                      'SLOW_QUERY_THRESHOLD_MS': float('inf')})
+
+    with app.app_context():
+        db.drop_all()
+        upgrade()
+        started = perf_counter()
+        counts = generate(users=args.users, posts_per_user=args.posts_per_user,
+                          tags=args.tags, tags_per_post=args.tags_per_post)
+        print(f"Generated {counts} in {perf_counter() - started:.1f}s", file=sys.stderr)
+
+    fixtures = Fixtures(counts)
+    results = {'config': {'database': make_url(args.database_url).get_backend_name(),
+                          **{key: getattr(args, key) for key in
+                             ('users', 'posts_per_user', 'tags', 'tags_per_post', 'iterations', 'page_cache')}},
+               'routes': {}}
+
+    with app.test_client() as client, app.app_context():
+        for name in args.routes:
+            method, prepare = ROUTES[name]
+            results['routes'][name] = stats = run_route(client, fixtures, method, prepare,
+                                                        args.iterations, args.memory_iterations,
+                                                        args.warmup)
+            print(f"{name:<24} p50 {stats['p50_ms']:8.2f}  p95 {stats['p95_ms']:8.2f}  "
+                  f"p99 {stats['p99_ms']:8.2f} ms  {stats['queries_per_request']:3d} queries  "
+                  f"{stats['peak_kb']:9.1f} KiB")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = find_regressions(results, json.load(f), args.tolerance, args.slack_ms)
+        if problems:
+            print("Regressions against baseline:", *problems, sep='\n  ', file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
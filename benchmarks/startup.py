@@ -0,0 +1,62 @@
+"""Measure cold-start time: importing the app, building it, first request.
+
+Each run is a fresh interpreter so imports are not cached:
+
+    python -m benchmarks.startup --runs 10 --path /users
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Runs in the child interpreter and prints one JSON line of timings in ms
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1]})
+created = time.perf_counter()
+resp = app.test_client().get(sys.argv[2])
+responded = time.perf_counter()
+print(json.dumps({
+    'status': resp.status_code,
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (responded - created) * 1000,
+    'total_ms': (responded - start) * 1000,
+}))
+'''
+
+PHASES = ('import_ms', 'create_app_ms', 'first_request_ms', 'total_ms')
+
+
+def run_once(database_url, path):
+    """Start a fresh interpreter and return its timings."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', CHILD, database_url, path],
+                         cwd=root, check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--path', default='/users', help="Route for the first request.")
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL', 'postgresql:///blogly'))
+    args = parser.parse_args(argv)
+
+    runs = [run_once(args.database_url, args.path) for _ in range(args.runs)]
+    statuses = {run['status'] for run in runs}
+
+    print(f"{args.runs} cold starts, GET {args.path} -> {sorted(statuses)}")
+    for phase in PHASES:
+        values = [run[phase] for run in runs]
+        print(f"  {phase:<18} median {statistics.median(values):8.1f}  min {min(values):8.1f}  max {max(values):8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Streaming bulk import and export for Blogly tables.
+
+    flask data export posts --format csv --output posts.csv
+    flask data import posts --format csv --input posts.csv
+
+Exports stream rows through a server-side cursor in yield_per batches;
+imports read and write in batches of --batch-size rows, using COPY on
+PostgreSQL and executemany elsewhere. Memory stays bounded by the batch
+size either way. Rows per second go to stderr so stdout can carry data.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from itertools import islice
+from time import perf_counter
+
+import click
+from flask.cli import AppGroup
+
+from cache import clear_all
+from models import db, rebuild_timeline, repair_post_counters, User, Post, Tag, PostTag
+
+TABLES = {model.__tablename__: model.__table__ for model in (User, Post, Tag, PostTag)}
+FORMATS = ('ndjson', 'csv')
+COPY_NULL = '\\N'
+
+data_cli = AppGroup('data', help="Bulk import and export of table data.")
+
+
+def _dump_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _column_parser(column):
+    """Return a function turning a text/JSON value into column's Python type."""
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        python_type = None
+    empty = None if column.nullable else ''
+
+    def parse(value):
+        if value is None or value == '':
+            return empty
+        if python_type is datetime and isinstance(value, str):
+            return datetime.fromisoformat(value)
+        if python_type is int:
+            return int(value)
+        return value
+
+    return parse
+
+
+def export_rows(table, batch_size):
+    """Yield dict rows of table in primary key order through a server-side cursor."""
+    query = db.select(table).order_by(*table.primary_key.columns)
+    result = db.session.execute(query.execution_options(stream_results=True))
+    for row in result.yield_per(batch_size).mappings():
+        yield {key: _dump_value(value) for key, value in row.items()}
+
+
+def read_records(stream, fmt):
+    """Yield dict records from an NDJSON or CSV text stream."""
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _batches(records, size):
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _copy_batch(table, columns, rows):
+    """COPY rows into table on the session's PostgreSQL connection."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([COPY_NULL if row[name] is None else _dump_value(row[name]) for name in columns])
+    buf.seek(0)
+
+    column_list = ', '.join(f'"{name}"' for name in columns)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f'COPY {table.name} ({column_list}) FROM STDIN '
+                           f"WITH (FORMAT csv, NULL '{COPY_NULL}')", buf)
+    finally:
+        cursor.close()
+
+
+def _reset_sequence(table):
+    """Move a PostgreSQL serial id sequence past ids imported explicitly."""
+    if 'id' in table.c:
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {table.name}), 0) + 1, false)"))
+
+
+def import_records(table, records, batch_size):
+    """Insert records into table in batches; return the number of rows.
+
+    The caller commits.
+    """
+    use_copy = db.engine.dialect.name == 'postgresql'
+    parsers = None
+    count = 0
+
+    for batch in _batches(records, batch_size):
+        if parsers is None:
+            unknown = set(batch[0]) - set(table.c.keys())
+            if unknown:
+                raise click.BadParameter(f"Unknown columns for {table.name}: {sorted(unknown)}")
+            parsers = {name: _column_parser(table.c[name]) for name in batch[0]}
+
+        rows = [{name: parse(record.get(name)) for name, parse in parsers.items()} for record in batch]
+        if use_copy:
+            _copy_batch(table, list(parsers), rows)
+        else:
+            db.session.execute(table.insert(), rows)
+        count += len(rows)
+
+    if use_copy:
+        _reset_sequence(table)
+    return count
+
+
+def _report(verb, count, table, started):
+    elapsed = perf_counter() - started
+    rate = count / elapsed if elapsed else float('inf')
+    click.echo(f"{verb} {count} {table} rows in {elapsed:.2f}s ({rate:,.0f} rows/s)", err=True)
+
+
+@data_cli.command('export')
+@click.argument('table', type=click.Choice(sorted(TABLES)))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='ndjson')
+@click.option('--output', type=click.File('w'), default='-')
+@click.option('--batch-size', type=int, default=5000, show_default=True)
+def export_command(table, fmt, output, batch_size):
+    """Write every row of TABLE as NDJSON or CSV."""
+    started = perf_counter()
+    columns = TABLES[table].c.keys()
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(output, fieldnames=columns)
+        writer.writeheader()
+
+    count = 0
+    for row in export_rows(TABLES[table], batch_size):
+        if writer:
+            writer.writerow(row)
+        else:
+            output.write(json.dumps(row) + '\n')
+        count += 1
+
+    _report("Exported", count, table, started)
+
+
+@data_cli.command('import')
+@click.argument('table', type=click.Choice(sorted(TABLES)))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='ndjson')
+@click.option('--input', 'input_', type=click.File('r'), default='-')
+@click.option('--batch-size', type=int, default=5000, show_default=True)
+@click.option('--skip-counters', is_flag=True,
+              help="Don't recompute post counters and tag timelines afterwards "
+                   "(run `flask repair-counters` and `flask rebuild-timeline` later).")
+def import_command(table, fmt, input_, batch_size, skip_counters):
+    """Insert NDJSON or CSV rows into TABLE in one transaction."""
+    started = perf_counter()
+    count = import_records(TABLES[table], read_records(input_, fmt), batch_size)
+
+    # Rows went in below the ORM, so bring derived data back in line
+    if table in ('posts', 'posts_tags') and not skip_counters:
+        repair_post_counters()
+        rebuild_timeline()
+    db.session.commit()
+    clear_all()
+
+    _report("Imported", count, table, started)
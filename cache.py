@@ -0,0 +1,242 @@
+"""Rendered-page cache for Blogly.
+
+Views wrapped in @cached_page store their HTML under the request path along
+with the labels of the rows they rendered (see depends_on). Models name the
+labels a change to them affects through a cache_labels() method; after each
+commit the cache drops every page carrying one of those labels. Bulk
+writes that don't pass a cache_labels execution option clear the cache.
+
+PAGE_CACHE picks the backend: 'memory' (default, per process, LRU bounded
+by PAGE_CACHE_MAX_BYTES), 'redis' (shared by all workers, needs the redis
+package and PAGE_CACHE_REDIS_URL; bound its memory with the server's
+maxmemory and an LRU eviction policy) or None to disable caching. Entries
+also expire after PAGE_CACHE_TTL seconds, which bounds staleness when
+reads come from a lagging replica.
+"""
+
+import functools
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict
+
+from flask import Response, current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+ALL = '*'
+
+# Every cache in the process: all apps share db, so any commit may affect any of them
+_caches = weakref.WeakSet()
+
+DEFAULT_CONFIG = {
+    'PAGE_CACHE': 'memory',
+    'PAGE_CACHE_MAX_BYTES': 16 * 1024 * 1024,
+    'PAGE_CACHE_TTL': 300,
+    'PAGE_CACHE_REDIS_URL': 'redis://localhost:6379/0',
+}
+
+
+class MemoryCache:
+    """In-process LRU cache bounded by the total size of stored pages."""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._by_label = defaultdict(set)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached body for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            body, labels, expires = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    def set(self, key, body, labels, generation):
+        """Store body unless something was invalidated since `generation`."""
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._remove(key)
+            self._entries[key] = (body, labels, time.monotonic() + self.ttl)
+            self._size += len(body)
+            for label in labels:
+                self._by_label[label].add(key)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, labels):
+        """Drop every page carrying one of labels; ALL drops everything."""
+        with self._lock:
+            self.generation += 1
+            if ALL in labels:
+                self._entries.clear()
+                self._by_label.clear()
+                self._size = 0
+                return
+            for label in labels:
+                for key in self._by_label.pop(label, ()):
+                    self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        body, labels, _ = entry
+        self._size -= len(body)
+        for label in labels:
+            keys = self._by_label.get(label)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_label[label]
+
+
+class RedisCache:
+    """Cache shared through a Redis-compatible server."""
+
+    PREFIX = 'blogly:page:'
+
+    def __init__(self, url, ttl):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("PAGE_CACHE = 'redis' needs the redis package") from e
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    @property
+    def generation(self):
+        return int(self._redis.get(self.PREFIX + 'generation') or 0)
+
+    def get(self, key):
+        return self._redis.get(self.PREFIX + 'key:' + key)
+
+    def set(self, key, body, labels, generation):
+        if generation != self.generation:
+            return
+        pipe = self._redis.pipeline()
+        pipe.set(self.PREFIX + 'key:' + key, body, ex=self.ttl)
+        for label in labels:
+            pipe.sadd(self.PREFIX + 'label:' + label, key)
+            pipe.expire(self.PREFIX + 'label:' + label, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, labels):
+        self._redis.incr(self.PREFIX + 'generation')
+        if ALL in labels:
+            names = list(self._redis.scan_iter(self.PREFIX + 'key:*'))
+            names += list(self._redis.scan_iter(self.PREFIX + 'label:*'))
+        else:
+            names = []
+            for label in labels:
+                set_name = self.PREFIX + 'label:' + label
+                names += [self.PREFIX + 'key:' + key.decode() for key in self._redis.smembers(set_name)]
+                names.append(set_name)
+        if names:
+            self._redis.delete(*names)
+
+
+def depends_on(*labels):
+    """Record labels of rows the page being rendered shows."""
+    if 'page_cache_labels' in g:
+        g.page_cache_labels.update(labels)
+
+
+def cached_page(view):
+    """Serve view from the page cache, storing its 200 responses."""
+
+    @functools.wraps(view)
+    def wrapper(**kwargs):
+        cache = current_app.extensions.get('page_cache')
+        if cache is None or request.method != 'GET' or request.args:
+            return view(**kwargs)
+
+        body = cache.get(request.path)
+        if body is not None:
+            resp = Response(body, mimetype='text/html')
+            resp.headers['X-Page-Cache'] = 'HIT'
+            return resp
+
+        generation = cache.generation
+        g.page_cache_labels = set()
+        resp = current_app.make_response(view(**kwargs))
+        if resp.status_code == 200 and g.page_cache_labels:
+            cache.set(request.path, resp.get_data(), frozenset(g.page_cache_labels), generation)
+        resp.headers['X-Page-Cache'] = 'MISS'
+        return resp
+
+    return wrapper
+
+
+def clear_all():
+    """Drop every page from this process's caches, e.g. after writes below the ORM."""
+    for cache in list(_caches):
+        cache.invalidate({ALL})
+
+
+def _queue(session, labels):
+    session.info.setdefault('page_cache_labels', set()).update(labels)
+
+
+def _labels_after_flush(session, flush_context):
+    for obj in session.new | session.deleted:
+        if hasattr(obj, 'cache_labels'):
+            _queue(session, obj.cache_labels())
+    for obj in session.dirty:
+        if hasattr(obj, 'cache_labels') and session.is_modified(obj):
+            _queue(session, obj.cache_labels())
+
+
+def _labels_for_bulk_write(orm_execute_state):
+    state = orm_execute_state
+    if state.is_insert or state.is_update or state.is_delete:
+        _queue(state.session, state.execution_options.get('cache_labels', (ALL,)))
+
+
+def _invalidate_after_commit(session):
+    labels = session.info.pop('page_cache_labels', None)
+    if labels:
+        for cache in list(_caches):
+            cache.invalidate(labels)
+
+
+def _discard_after_rollback(session):
+    session.info.pop('page_cache_labels', None)
+
+
+def init_page_cache(app):
+    """Create the configured cache backend and hook invalidation into commits."""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+    backend = app.config['PAGE_CACHE']
+    if backend == 'memory':
+        app.extensions['page_cache'] = MemoryCache(app.config['PAGE_CACHE_MAX_BYTES'],
+                                                   app.config['PAGE_CACHE_TTL'])
+    elif backend == 'redis':
+        app.extensions['page_cache'] = RedisCache(app.config['PAGE_CACHE_REDIS_URL'],
+                                                  app.config['PAGE_CACHE_TTL'])
+    elif backend:
+        raise ValueError(f"Unknown PAGE_CACHE backend: {backend!r}")
+    else:
+        return
+
+    _caches.add(app.extensions['page_cache'])
+    if not event.contains(Session, 'after_commit', _invalidate_after_commit):
+        event.listen(Session, 'after_flush', _labels_after_flush)
+        event.listen(Session, 'do_orm_execute', _labels_for_bulk_write)
+        event.listen(Session, 'after_commit', _invalidate_after_commit)
+        event.listen(Session, 'after_rollback', _discard_after_rollback)
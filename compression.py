@@ -0,0 +1,72 @@
+"""gzip/brotli compression of responses.
+
+Text responses of at least COMPRESS_MIN_SIZE bytes are compressed with the
+first of COMPRESS_ALGORITHMS the client accepts. Brotli comes from the
+brotli package in requirements.txt; an install without it logs a warning
+and serves gzip only. Smaller bodies aren't worth the CPU, and streamed or
+already-encoded responses are left alone. A strong ETag becomes weak,
+since the bytes on the wire differ by encoding.
+"""
+
+import gzip
+import logging
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger('blogly.compression')
+
+DEFAULT_CONFIG = {
+    'COMPRESS_ALGORITHMS': ('br', 'gzip'),
+    'COMPRESS_MIN_SIZE': 1024,
+    'COMPRESS_GZIP_LEVEL': 6,
+    'COMPRESS_BROTLI_QUALITY': 4,
+    'COMPRESS_MIMETYPES': ('text/html', 'text/css', 'text/plain', 'application/json',
+                           'application/javascript'),
+}
+
+
+def compressors(config):
+    """Map each usable configured encoding to a function compressing bytes."""
+    available = {
+        'gzip': lambda data: gzip.compress(data, compresslevel=config['COMPRESS_GZIP_LEVEL'], mtime=0),
+    }
+    if brotli is not None:
+        available['br'] = lambda data: brotli.compress(data, quality=config['COMPRESS_BROTLI_QUALITY'])
+    return {name: available[name] for name in config['COMPRESS_ALGORITHMS'] if name in available}
+
+
+def init_compression(app):
+    """Compress eligible responses according to the COMPRESS_* settings."""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+    if 'br' in app.config['COMPRESS_ALGORITHMS'] and brotli is None:
+        logger.warning("brotli isn't installed; responses are compressed with gzip only")
+    encoders = compressors(app.config)
+    if not encoders:
+        return
+    min_size = app.config['COMPRESS_MIN_SIZE']
+    mimetypes = set(app.config['COMPRESS_MIMETYPES'])
+
+    @app.after_request
+    def compress(response):
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers or response.mimetype not in mimetypes):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = next((name for name in encoders if request.accept_encodings[name]), None)
+        if encoding is None or response.content_length is None or response.content_length < min_size:
+            return response
+
+        response.set_data(encoders[encoding](response.get_data()))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,178 @@
+"""Deleting users and tags with many posts.
+
+Posts and tag links go by ON DELETE CASCADE (the relationships use
+passive_deletes), so nothing is loaded into the session. The database
+cascade skips the session events behind the post counters and the page
+cache, so purge_user and purge_tag move the counters and pass cache labels
+themselves.
+
+A user or tag with more than ASYNC_DELETE_THRESHOLD posts is deleted by a
+background job instead, ASYNC_DELETE_CHUNK_SIZE posts per transaction, so
+no request or lock waits on the whole fan-out. Jobs are rows in
+deletion_jobs, so /deletions/<id> reports progress from any worker; jobs
+left behind by a worker that died are finished by `flask resume-deletions`.
+"""
+
+import concurrent.futures
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models import db, _posts_removed, _touch_posts, User, Post, Tag, PostTag, TagTimelineEntry, DeletionJob
+
+logger = logging.getLogger('blogly.deletion')
+
+DEFAULT_CONFIG = {
+    'ASYNC_DELETE_THRESHOLD': 1000,
+    'ASYNC_DELETE_CHUNK_SIZE': 500,
+    'ASYNC_DELETE_WORKERS': 1,
+}
+
+ACTIVE_STATES = ('queued', 'running')
+
+
+def _execute(statement, labels):
+    # Default 'evaluate' sync: rows already in the session are marked deleted
+    db.session.execute(statement, execution_options={'cache_labels': labels})
+
+
+def purge_user(user_id, limit=None):
+    """Delete up to limit of the user's posts, and the user once the rest fit.
+
+    Returns (posts deleted, whether the user is gone). With no limit
+    everything goes in one pass. The caller commits.
+    """
+    query = db.session.query(Post.id, PostTag.tag_id).outerjoin(PostTag, PostTag.post_id == Post.id)
+    if limit is None:
+        query = query.filter(Post.user_id == user_id)
+    else:
+        chunk = db.select(Post.id).where(Post.user_id == user_id).order_by(Post.id).limit(limit)
+        query = query.filter(Post.id.in_(chunk.scalar_subquery()))
+    rows = query.all()
+    post_ids = {post_id for post_id, _ in rows}
+    tag_counts = Counter(tag_id for _, tag_id in rows if tag_id is not None)
+    labels = {f"user:{user_id}", "tags", *(f"post:{post_id}" for post_id in post_ids),
+              *(f"tag:{tag_id}" for tag_id in tag_counts)}
+
+    done = limit is None or len(post_ids) < limit
+    if done:
+        _execute(db.delete(User).where(User.id == user_id), labels)
+    else:
+        _execute(db.delete(Post).where(Post.id.in_(post_ids)), labels)
+        _execute(_posts_removed(User, {user_id: len(post_ids)}), labels)
+    if tag_counts:
+        _execute(_posts_removed(Tag, tag_counts), labels)
+    return len(post_ids), done
+
+
+def purge_tag(tag_id, limit=None):
+    """Untag up to limit posts, and delete the tag once the rest fit.
+
+    Returns (links deleted, whether the tag is gone). The caller commits.
+    """
+    query = (db.session.query(PostTag.post_id).filter(PostTag.tag_id == tag_id)
+             .order_by(PostTag.post_id).limit(limit))
+    post_ids = [post_id for (post_id,) in query]
+    labels = {f"tag:{tag_id}", "tags", *(f"post:{post_id}" for post_id in post_ids)}
+
+    done = limit is None or len(post_ids) < limit
+    # Losing a tag changes the posts' tag_ids, which the API serves under updated_at
+    if post_ids:
+        _execute(_touch_posts(post_ids), labels)
+    if done:
+        _execute(db.delete(Tag).where(Tag.id == tag_id), labels)
+    else:
+        _execute(db.delete(PostTag).where(PostTag.tag_id == tag_id, PostTag.post_id.in_(post_ids)),
+                 labels)
+        _execute(_posts_removed(Tag, {tag_id: len(post_ids)}), labels)
+        _execute(db.delete(TagTimelineEntry).where(TagTimelineEntry.tag_id == tag_id,
+                                                   TagTimelineEntry.post_id.in_(post_ids)), labels)
+    return len(post_ids), done
+
+
+PURGES = {'user': purge_user, 'tag': purge_tag}
+
+
+def run_job(job_id, chunk_size):
+    """Work through a job one chunk per transaction until its target is gone."""
+    job = db.session.get(DeletionJob, job_id)
+    purge = PURGES[job.kind]
+    job.state = 'running'
+    db.session.commit()
+
+    try:
+        done = False
+        while not done:
+            deleted, done = purge(job.target_id, chunk_size)
+            job.deleted = DeletionJob.deleted + deleted
+            if done:
+                job.state = 'done'
+            db.session.commit()
+    except Exception as e:
+        logger.exception("Deletion job %s failed", job_id)
+        db.session.rollback()
+        job.state = 'failed'
+        job.error = f"{type(e).__name__}: {e}"
+        db.session.commit()
+
+
+class DeletionRunner:
+    """Runs deletion jobs on a small thread pool in this worker."""
+
+    def __init__(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=app.config['ASYNC_DELETE_WORKERS'],
+                                           thread_name_prefix='blogly-delete')
+        self.pending = set()
+
+    def submit(self, kind, target_id, total):
+        """Queue deletion of a user or tag; return its job.
+
+        An unfinished job for the same row is returned rather than started twice.
+        """
+        job = DeletionJob.query.filter(DeletionJob.kind == kind, DeletionJob.target_id == target_id,
+                                       DeletionJob.state.in_(ACTIVE_STATES)).first()
+        if job is not None:
+            return job
+
+        job = DeletionJob(kind=kind, target_id=target_id, total=total)
+        db.session.add(job)
+        db.session.commit()
+
+        future = self.executor.submit(self._run, job.id)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return job
+
+    def join(self, timeout=None):
+        """Wait for the jobs submitted so far to finish."""
+        concurrent.futures.wait(list(self.pending), timeout=timeout)
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            try:
+                run_job(job_id, self.app.config['ASYNC_DELETE_CHUNK_SIZE'])
+            finally:
+                db.session.remove()
+
+
+def init_deletions(app):
+    """Set deletion defaults and start the app's job runner."""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    app.extensions['deletions'] = DeletionRunner(app)
+
+
+@click.command('resume-deletions')
+@with_appcontext
+def resume_deletions_command():
+    """Finish deletion jobs left unfinished by a stopped worker."""
+    job_ids = [job_id for (job_id,) in db.session.query(DeletionJob.id)
+               .filter(DeletionJob.state.in_(ACTIVE_STATES)).order_by(DeletionJob.id)]
+    for job_id in job_ids:
+        run_job(job_id, current_app.config['ASYNC_DELETE_CHUNK_SIZE'])
+        click.echo(f"Finished deletion job {job_id}.")
@@ -0,0 +1,130 @@
+"""Idempotency-Key support for JSON write endpoints.
+
+A client that retries a write sends the same Idempotency-Key header as the
+first attempt. Views wrapped in @idempotent claim the key in
+idempotency_keys within the transaction that does their writes, and store
+their response there before it commits, so a retry gets the stored response
+back (marked Idempotent-Replayed: true) and writes nothing. A concurrent
+retry waits on the key's row until the first attempt commits or rolls back.
+Failed requests roll their claim back with everything else, so the same
+key can be retried.
+
+A key is bound to a fingerprint of the method, URL and body; sending it
+with a different request is a 422. Keys expire after IDEMPOTENCY_KEY_TTL
+seconds; run `flask purge-idempotency-keys` periodically to delete them.
+"""
+
+import functools
+import hashlib
+from datetime import datetime, timedelta
+
+import click
+from flask import abort, current_app, make_response, request
+from flask.cli import with_appcontext
+
+from models import db, insert_ignoring_conflicts, IdempotencyKey
+
+DEFAULT_CONFIG = {
+    'IDEMPOTENCY_KEY_TTL': 24 * 60 * 60,
+}
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = IdempotencyKey.key.type.length
+
+# No cached page shows the keys table
+NO_CACHE_LABELS = {'cache_labels': ()}
+
+
+def request_fingerprint():
+    """SHA-256 of the current request's method, URL and body."""
+    digest = hashlib.sha256()
+    for part in (request.method.encode(), request.full_path.encode(), request.get_data()):
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def claim(key, fingerprint):
+    """Claim key for this request; return the stored key if another request holds it.
+
+    The caller commits or rolls back.
+    """
+    now = datetime.utcnow()
+    db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.key == key,
+                                                       IdempotencyKey.expires_at <= now),
+                       execution_options=NO_CACHE_LABELS)
+    expires_at = now + timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])
+    result = db.session.execute(insert_ignoring_conflicts(IdempotencyKey).values(
+        key=key, fingerprint=fingerprint, expires_at=expires_at), execution_options=NO_CACHE_LABELS)
+    if result.rowcount:
+        return None
+    return IdempotencyKey.query.get(key)
+
+
+def replay(stored, fingerprint):
+    """The response stored under a key, if it was sent with the same request."""
+    if stored.fingerprint != fingerprint:
+        abort(422, f"This {HEADER} was already used with a different request")
+    if stored.status_code is None:
+        abort(409, f"A request with this {HEADER} is still in progress")
+    resp = current_app.response_class(stored.body, status=stored.status_code, mimetype='application/json')
+    resp.headers['Idempotent-Replayed'] = 'true'
+    return resp
+
+
+def idempotent(view):
+    """Make a JSON view safe to retry under an Idempotency-Key header.
+
+    The view writes without committing; the wrapper commits, together with
+    the stored response when a key was sent, or rolls back if the view
+    raises.
+    """
+    @functools.wraps(view)
+    def wrapper(**kwargs):
+        key = request.headers.get(HEADER)
+        if key is not None:
+            if not 0 < len(key) <= MAX_KEY_LENGTH:
+                abort(400, f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters")
+            fingerprint = request_fingerprint()
+            stored = claim(key, fingerprint)
+            if stored is not None:
+                db.session.rollback()
+                return replay(stored, fingerprint)
+
+        try:
+            resp = make_response(view(**kwargs))
+        except Exception:
+            db.session.rollback()
+            raise
+
+        if key is not None:
+            db.session.execute(db.update(IdempotencyKey).where(IdempotencyKey.key == key).values(
+                status_code=resp.status_code, body=resp.get_data(as_text=True)),
+                execution_options=NO_CACHE_LABELS)
+        db.session.commit()
+        return resp
+
+    return wrapper
+
+
+def purge_expired_keys():
+    """Delete expired idempotency keys; return how many. The caller commits."""
+    result = db.session.execute(
+        db.delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.utcnow()),
+        execution_options={**NO_CACHE_LABELS, 'synchronize_session': False})
+    return result.rowcount
+
+
+def init_idempotency(app):
+    """Set idempotency defaults."""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+
+@click.command('purge-idempotency-keys')
+@with_appcontext
+def purge_idempotency_keys_command():
+    """Delete idempotency keys past their TTL."""
+    count = purge_expired_keys()
+    db.session.commit()
+    click.echo(f"Deleted {count} expired idempotency keys.")
@@ -0,0 +1,115 @@
+"""Per-request SQL instrumentation for Blogly.
+
+Times every statement through the engine's cursor execute events, adds the
+request's statement count and database time to the response, and logs any
+statement slower than SLOW_QUERY_THRESHOLD_MS, in a request or not: CLI
+commands, deletion jobs and migrations are logged too. Slow statements are
+logged without their parameters, which can hold users' data; those follow
+at DEBUG.
+"""
+
+import heapq
+import logging
+from time import perf_counter
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('blogly.sql')
+
+DEFAULT_CONFIG = {
+    'SQL_INSTRUMENTATION': True,
+    'SLOW_QUERY_THRESHOLD_MS': 100,
+    'SQL_SLOWEST_STATEMENTS': 3,
+}
+
+
+class RequestStats:
+    """Statement count, total time and slowest statements for one request."""
+
+    def __init__(self, keep_slowest):
+        self.count = 0
+        self.total_ms = 0.0
+        self.keep_slowest = keep_slowest
+        self.slowest = []
+
+    def record(self, statement, duration_ms):
+        """Add one executed statement."""
+        self.count += 1
+        self.total_ms += duration_ms
+        # Min-heap of (duration, seq, statement) holding the N slowest
+        entry = (duration_ms, self.count, statement)
+        if len(self.slowest) < self.keep_slowest:
+            heapq.heappush(self.slowest, entry)
+        elif self.slowest and duration_ms > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def slowest_statements(self):
+        """Return [(duration_ms, statement)], slowest first."""
+        return [(ms, stmt) for ms, _, stmt in sorted(self.slowest, reverse=True)]
+
+    def server_timing(self):
+        """Format the stats as a Server-Timing header value."""
+        entries = [f'db;desc="{self.count} queries";dur={self.total_ms:.2f}']
+        entries += [f'db-slow-{i};dur={ms:.2f}'
+                    for i, (ms, _) in enumerate(self.slowest_statements(), start=1)]
+        return ', '.join(entries)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # On the execution context, not the connection: after_cursor_execute
+    # doesn't fire for a statement that raises, and nothing would clean up
+    if context is not None:
+        context._blogly_start = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_blogly_start', None)
+    if start is None:
+        return
+    duration_ms = (perf_counter() - start) * 1000
+
+    if has_app_context():
+        if not current_app.config.get('SQL_INSTRUMENTATION'):
+            return
+        threshold_ms = current_app.config['SLOW_QUERY_THRESHOLD_MS']
+        stats = g.get('sql_stats')
+        if stats is not None:
+            stats.record(statement, duration_ms)
+    else:
+        threshold_ms = DEFAULT_CONFIG['SLOW_QUERY_THRESHOLD_MS']
+
+    logger.debug("%.2fms %s", duration_ms, statement)
+    if duration_ms >= threshold_ms:
+        logger.warning("Slow query (%.2fms): %s", duration_ms, statement)
+        logger.debug("Slow query parameters: %r", parameters)
+
+
+def init_instrumentation(app):
+    """Install the statement timers and per-request hooks on app."""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+    if not app.config['SQL_INSTRUMENTATION']:
+        return
+
+    # Listen on the Engine class so every bind of the app is timed
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_sql_stats():
+        g.sql_stats = RequestStats(app.config['SQL_SLOWEST_STATEMENTS'])
+
+    @app.after_request
+    def add_sql_stats_headers(response):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return response
+
+        response.headers['X-DB-Query-Count'] = str(stats.count)
+        response.headers['X-DB-Time-Ms'] = f'{stats.total_ms:.2f}'
+        response.headers.add('Server-Timing', stats.server_timing())
+        return response
@@ -0,0 +1,477 @@
+"""Schema migrations for the models in models.py.
+
+    flask db upgrade     # apply pending migrations
+    flask db check       # compare the models with the live schema
+
+An empty database gets the whole schema from the models and is stamped
+with every migration. A database without schema_migrations but with the
+Blogly tables was made by an older `flask create-db`, at any commit since
+the baseline: every step of a migration checks the live schema first and
+skips what is already there, which also lets an interrupted upgrade be
+rerun. Applied migrations are recorded in schema_migrations.
+
+Steps are written to run against a live database:
+
+- columns are added nullable and without a default, a catalog-only change,
+  then backfilled MIGRATION_BATCH_SIZE rows per transaction by primary key
+  range, and made NOT NULL through a validated CHECK constraint, so the
+  final ALTER doesn't scan the table under an exclusive lock;
+- indexes are built with CREATE INDEX CONCURRENTLY, outside any
+  transaction, so writes go on during the build; an invalid index left by
+  a failed build is dropped and built again, and one defined differently
+  from the models is built anew under a temporary name, then swapped in;
+- DDL needing an exclusive lock waits at most MIGRATION_LOCK_TIMEOUT_MS for
+  it, so it never queues traffic behind a long query, and is retried.
+
+Those are the PostgreSQL statements. SQLite has no concurrent builds and
+can't change a column's nullability or default in place, so there the
+same steps run as plain DDL and migrated columns stay nullable.
+
+Migrations use their own connections, without DB_STATEMENT_TIMEOUT_MS.
+"""
+
+import logging
+import re
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import create_engine, exc
+from sqlalchemy.pool import NullPool
+from sqlalchemy.schema import CreateIndex
+
+from models import (db, _count_posts, _latest_post_at, _timeline_added, SEARCH_VECTOR_COLUMN,
+                    SEARCH_VECTOR_TRIGGER, SEARCH_VECTOR_INDEX, User, Post, Tag, PostTag, TagTimelineEntry,
+                    DeletionJob, IdempotencyKey, SchemaMigration)
+from pool import enforce_foreign_keys
+
+logger = logging.getLogger('blogly.migrations')
+
+DEFAULT_CONFIG = {
+    'MIGRATION_BATCH_SIZE': 1000,
+    'MIGRATION_LOCK_TIMEOUT_MS': 5000,
+    'MIGRATION_LOCK_RETRIES': 5,
+}
+
+#Created by DDL outside the ORM metadata on PostgreSQL, see models.py
+UNMAPPED_COLUMNS = {'posts': {'search_vector'}}
+UNMAPPED_INDEXES = {'posts': {'ix_posts_search_vector': SEARCH_VECTOR_INDEX}}
+
+#The part of a CREATE INDEX statement naming the index and its table
+INDEX_HEAD = re.compile(r'^CREATE (UNIQUE )?INDEX (\S+) ON (\S+) ')
+
+#SQLSTATE of a lock_timeout expiring
+LOCK_NOT_AVAILABLE = '55P03'
+
+db_cli = AppGroup('db', help="Schema migrations.")
+
+
+class Migrator:
+    """Idempotent schema changes against one database, see the module docstring."""
+
+    def __init__(self, engine, config, echo=logger.info):
+        self.engine = engine
+        self.dialect = engine.dialect
+        self.postgresql = engine.dialect.name == 'postgresql'
+        self.batch_size = config['MIGRATION_BATCH_SIZE']
+        self.lock_timeout_ms = config['MIGRATION_LOCK_TIMEOUT_MS']
+        self.lock_retries = config['MIGRATION_LOCK_RETRIES']
+        self.echo = echo
+
+    def column_names(self, table_name):
+        return {column['name'] for column in db.inspect(self.engine).get_columns(table_name)}
+
+    def indexes(self, table_name):
+        """{name: (whether it's valid, its definition)} of table's indexes, leaving out those of constraints."""
+        with self.engine.connect() as conn:
+            if self.postgresql:
+                rows = conn.execute(db.text(
+                    "SELECT i.relname, x.indisvalid, pg_get_indexdef(x.indexrelid) FROM pg_index x "
+                    "JOIN pg_class i ON i.oid = x.indexrelid JOIN pg_class t ON t.oid = x.indrelid "
+                    "WHERE t.relname = :table AND pg_table_is_visible(t.oid) AND x.indexrelid NOT IN "
+                    "(SELECT conindid FROM pg_constraint WHERE contype IN ('p', 'u', 'x'))"),
+                    {'table': table_name})
+            else:
+                # Indexes SQLite makes for constraints have no sql
+                rows = conn.execute(db.text(
+                    "SELECT name, 1, sql FROM sqlite_master "
+                    "WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL"),
+                    {'table': table_name})
+            return {name: (bool(valid), definition) for name, valid, definition in rows}
+
+    def definition(self, statement):
+        """The canonical definition of the index a CREATE INDEX statement builds, to compare with indexes()."""
+        if not self.postgresql:
+            # SQLite keeps the statement as it was run
+            return _canonical(statement)
+        # Have PostgreSQL spell it out: build it on an empty copy of the table, then roll back
+        table_name = INDEX_HEAD.match(statement.strip()).group(3)
+        with self.engine.connect() as conn:
+            trans = conn.begin()
+            try:
+                conn.exec_driver_sql(f"CREATE TEMPORARY TABLE blogly_index_definition (LIKE {table_name})")
+                conn.exec_driver_sql(INDEX_HEAD.sub(r'CREATE \1INDEX blogly_index_definition_ix '
+                                                    r'ON blogly_index_definition ', statement.strip()))
+                return _canonical(conn.execute(db.text(
+                    "SELECT pg_get_indexdef('blogly_index_definition_ix'::regclass)")).scalar())
+            finally:
+                trans.rollback()
+
+    def ddl(self, run):
+        """Call run(connection) in a transaction, retrying if a lock wait times out."""
+        for attempt in range(self.lock_retries + 1):
+            try:
+                with self.engine.begin() as conn:
+                    if self.postgresql:
+                        conn.exec_driver_sql(f"SET LOCAL lock_timeout = {int(self.lock_timeout_ms)}")
+                    run(conn)
+                return
+            except exc.OperationalError as e:
+                if getattr(e.orig, 'pgcode', None) != LOCK_NOT_AVAILABLE or attempt == self.lock_retries:
+                    raise
+                self.echo(f"  Lock wait timed out, retrying: {e.orig}")
+                time.sleep(2 ** attempt)
+
+    def execute(self, *statements):
+        """Run DDL statements in one transaction, as ddl does."""
+        def run(conn):
+            for statement in statements:
+                conn.exec_driver_sql(statement)
+        self.ddl(run)
+
+    def create_table(self, table):
+        """Create table, and its indexes, unless it exists; it's empty, so nothing else is needed."""
+        if not db.inspect(self.engine).has_table(table.name):
+            self.echo(f"  Creating table {table.name}")
+            self.ddl(table.create)
+
+    def add_column(self, column):
+        """Add column, nullable, unless it exists; on PostgreSQL new rows get its server default."""
+        table = column.table
+        if column.name in self.column_names(table.name):
+            return
+        self.echo(f"  Adding column {table.name}.{column.name}")
+        preparer = self.dialect.identifier_preparer
+        name, quoted_column = preparer.format_table(table), preparer.format_column(column)
+        statements = [f"ALTER TABLE {name} ADD COLUMN {quoted_column} "
+                      f"{column.type.compile(dialect=self.dialect)}"]
+        # Set after the ADD so existing rows stay NULL for the backfill
+        default = self.dialect.ddl_compiler(self.dialect, None).get_column_default_string(column)
+        if default is not None and self.postgresql:
+            statements.append(f"ALTER TABLE {name} ALTER COLUMN {quoted_column} SET DEFAULT {default}")
+        self.execute(*statements)
+
+    def batches(self, table):
+        """Yield (first, last) primary keys of successive batch_size runs of table's rows."""
+        key, = table.primary_key.columns
+        last = None
+        while True:
+            query = db.select(key).order_by(key).limit(self.batch_size)
+            if last is not None:
+                query = query.where(key > last)
+            with self.engine.connect() as conn:
+                keys = conn.execute(query).scalars().all()
+            if not keys:
+                return
+            yield keys[0], keys[-1]
+            last = keys[-1]
+
+    def backfill(self, table, values, pending):
+        """Set values on the rows matching pending, one transaction per batch; return how many.
+
+        Columns with an onupdate, like updated_at, keep their values; they
+        must exist by now, as SQLAlchemy sets them on every update.
+        """
+        key, = table.primary_key.columns
+        live = self.column_names(table.name)
+        values = {**{column.name: column for column in table.columns
+                     if column.onupdate is not None and column.name in live}, **values}
+        total = 0
+        for first, last in self.batches(table):
+            with self.engine.begin() as conn:
+                total += conn.execute(db.update(table).where(key.between(first, last), pending)
+                                      .values(values)).rowcount
+        if total:
+            self.echo(f"  Backfilled {total} {table.name} rows")
+        return total
+
+    def set_not_null(self, column):
+        """Make column NOT NULL on PostgreSQL; every row must have a value by now."""
+        if not self.postgresql:
+            return
+        table = column.table
+        live = {c['name']: c for c in db.inspect(self.engine).get_columns(table.name)}
+        if not live[column.name]['nullable']:
+            return
+        self.echo(f"  Making {table.name}.{column.name} NOT NULL")
+        preparer = self.dialect.identifier_preparer
+        name, quoted_column = preparer.format_table(table), preparer.format_column(column)
+        check = f"{table.name}_{column.name}_not_null"
+        # NOT VALID holds the exclusive lock only briefly; VALIDATE scans without
+        # blocking writes, and SET NOT NULL then trusts the check instead of scanning
+        self.execute(f"ALTER TABLE {name} DROP CONSTRAINT IF EXISTS {check}",
+                     f"ALTER TABLE {name} ADD CONSTRAINT {check} CHECK ({quoted_column} IS NOT NULL) NOT VALID")
+        self.execute(f"ALTER TABLE {name} VALIDATE CONSTRAINT {check}")
+        self.execute(f"ALTER TABLE {name} ALTER COLUMN {quoted_column} SET NOT NULL",
+                     f"ALTER TABLE {name} DROP CONSTRAINT {check}")
+
+    def create_index(self, index):
+        """Build one of the models' indexes, unless it exists."""
+        self.build_index(index.name, index.table.name, str(CreateIndex(index).compile(dialect=self.dialect)))
+
+    def build_index(self, name, table_name, statement):
+        """Run a CREATE INDEX statement for name, concurrently on PostgreSQL, unless it exists as defined.
+
+        An invalid index is dropped and built again. One defined differently is
+        replaced; on PostgreSQL the new one is built under a temporary name and
+        renamed once the old one is dropped, so queries keep an index throughout.
+        """
+        valid, definition = self.indexes(table_name).get(name, (None, None))
+        if valid and _canonical(definition) == self.definition(statement):
+            return
+        if valid:
+            self.echo(f"  Rebuilding index {name}, which differs from the models")
+        else:
+            self.echo(f"  Building index {name}")
+        if not self.postgresql:
+            self.execute(*([f"DROP INDEX {name}"] if valid is not None else []), statement)
+            return
+        temporary = f"{name}_rebuild"
+        # CONCURRENTLY can't run in a transaction block
+        with self.engine.execution_options(isolation_level='AUTOCOMMIT').connect() as conn:
+            # Left by an interrupted rebuild
+            conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {temporary}")
+            if valid is False:
+                conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY {name}")
+            if not valid:
+                conn.exec_driver_sql(INDEX_HEAD.sub(r'CREATE \1INDEX CONCURRENTLY \2 ON \3 ', statement.strip()))
+                return
+            conn.exec_driver_sql(INDEX_HEAD.sub(rf'CREATE \1INDEX CONCURRENTLY {temporary} ON \3 ',
+                                                statement.strip()))
+            conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY {name}")
+        self.execute(f"ALTER INDEX {temporary} RENAME TO {name}")
+
+
+def _canonical(definition):
+    """A CREATE INDEX statement without its index and table names, so live and model indexes compare."""
+    return INDEX_HEAD.sub(r'CREATE \1INDEX ON ', ' '.join(definition.split()))
+
+def _index(name):
+    return next(index for table in db.Model.metadata.tables.values()
+                for index in table.indexes if index.name == name)
+
+#Migrations, oldest first. Each brings a database made by create-db at any
+#earlier commit up to the next version of the models. updated_at comes
+#before the other m.backfill calls: SQLAlchemy sets it on any update of a
+#table whose model has it. search_vector's backfill runs before it, so it's
+#plain SQL.
+
+def search_vector(m):
+    """The search_vector column, the trigger keeping it current and its GIN index, on PostgreSQL.
+
+    The column is added empty, a catalog-only change, and backfilled in
+    batches by setting each post's title to itself, which fires the trigger.
+    posts.updated_at may not exist yet, so that's a plain UPDATE rather than
+    m.backfill.
+    A generated search_vector, made by create-db before the trigger, is
+    left as it is.
+    """
+    if not m.postgresql:
+        return
+    posts = Post.__table__
+    live = {column['name']: column for column in db.inspect(m.engine).get_columns('posts')}
+    if 'search_vector' not in live:
+        m.echo("  Adding column posts.search_vector")
+        m.execute(f"ALTER TABLE posts ADD COLUMN {SEARCH_VECTOR_COLUMN}")
+    if 'computed' not in live.get('search_vector', {}):
+        m.execute(SEARCH_VECTOR_TRIGGER)
+        total = 0
+        for first, last in m.batches(posts):
+            with m.engine.begin() as conn:
+                total += conn.execute(db.text(
+                    "UPDATE posts SET title = title "
+                    "WHERE id BETWEEN :first AND :last AND search_vector IS NULL"),
+                    {'first': first, 'last': last}).rowcount
+        if total:
+            m.echo(f"  Backfilled {total} posts rows")
+    m.build_index('ix_posts_search_vector', 'posts', SEARCH_VECTOR_INDEX)
+
+def updated_at(m):
+    """updated_at on users, posts and tags; existing posts start at created_at."""
+    for model in (User, Post, Tag):
+        table = model.__table__
+        m.add_column(table.c.updated_at)
+        m.backfill(table, {'updated_at': table.c.created_at if model is Post else db.func.current_timestamp()},
+                   table.c.updated_at.is_(None))
+        m.set_not_null(table.c.updated_at)
+
+def post_counters(m):
+    """post_count and last_post_at on users and tags, and the indexes reading them.
+
+    Posts written meanwhile by app code that predates the counters aren't
+    counted; run `flask repair-counters` once the new code is deployed.
+    """
+    for model in (User, Tag):
+        table = model.__table__
+        m.add_column(table.c.post_count)
+        m.add_column(table.c.last_post_at)
+        m.backfill(table, {'post_count': _count_posts(model), 'last_post_at': _latest_post_at(model)},
+                   table.c.post_count.is_(None))
+        m.set_not_null(table.c.post_count)
+    m.create_index(_index('ix_tags_post_count'))
+    m.create_index(_index('ix_users_last_name_first_name_id'))
+
+def post_listing_indexes(m):
+    """Indexes behind the feeds, user pages and tag listings."""
+    for name in ('ix_posts_created_at_id', 'ix_posts_user_id_created_at',
+                 'ix_posts_tags_tag_id_post_id', 'ix_tags_name_prefix'):
+        m.create_index(_index(name))
+
+def deletion_jobs(m):
+    """The background deletion jobs table."""
+    m.create_table(DeletionJob.__table__)
+
+def tag_timeline(m):
+    """The tag feed's timeline table, filled from posts_tags a batch of posts at a time.
+
+    Entries already there are skipped, so a rerun finishes an interrupted
+    fill. Tags linked meanwhile by app code that predates the timeline are
+    missed; run `flask rebuild-timeline` once the new code is deployed.
+    """
+    m.create_table(TagTimelineEntry.__table__)
+    for first, last in m.batches(Post.__table__):
+        with m.engine.begin() as conn:
+            conn.execute(_timeline_added(PostTag.post_id.between(first, last)))
+    m.echo("  Filled tag_timeline")
+
+def idempotency_keys(m):
+    """The Idempotency-Key table."""
+    m.create_table(IdempotencyKey.__table__)
+
+def avatar_key(m):
+    """users.avatar_key, left null until each user's next edit, and its index."""
+    m.add_column(User.__table__.c.avatar_key)
+    m.create_index(_index('ix_users_avatar_key'))
+
+MIGRATIONS = [
+    ('0001_search_vector', search_vector),
+    ('0002_updated_at', updated_at),
+    ('0003_post_counters', post_counters),
+    ('0004_post_listing_indexes', post_listing_indexes),
+    ('0005_deletion_jobs', deletion_jobs),
+    ('0006_tag_timeline', tag_timeline),
+    ('0007_idempotency_keys', idempotency_keys),
+    ('0008_avatar_key', avatar_key),
+]
+
+
+def _migration_engine():
+    url = db.engine.url
+    # In UTC like the app's sessions, see pool.py, but without their statement timeout
+    connect_args = {'options': '-c timezone=UTC'} if url.get_backend_name() == 'postgresql' else {}
+    return enforce_foreign_keys(create_engine(url, poolclass=NullPool, connect_args=connect_args))
+
+def _applied(engine):
+    with engine.connect() as conn:
+        return set(conn.execute(db.select(SchemaMigration.version)).scalars())
+
+def upgrade(echo=logger.info):
+    """Bring the database up to the models; return the versions applied."""
+    engine = _migration_engine()
+    try:
+        if not set(db.inspect(engine).get_table_names()) & set(db.Model.metadata.tables):
+            echo("Creating schema")
+            db.Model.metadata.create_all(engine)
+            with engine.begin() as conn:
+                conn.execute(db.insert(SchemaMigration.__table__),
+                             [{'version': version} for version, _ in MIGRATIONS])
+            return [version for version, _ in MIGRATIONS]
+
+        SchemaMigration.__table__.create(engine, checkfirst=True)
+        applied = _applied(engine)
+        m = Migrator(engine, db.get_app().config, echo)
+        new = []
+        for version, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            echo(f"Applying {version}")
+            migrate(m)
+            with engine.begin() as conn:
+                conn.execute(db.insert(SchemaMigration.__table__).values(version=version))
+            new.append(version)
+        return new
+    finally:
+        engine.dispose()
+
+def check_schema():
+    """Return how the live schema differs from the models, one message each; [] if it doesn't."""
+    engine = _migration_engine()
+    try:
+        m = Migrator(engine, db.get_app().config)
+        inspector = db.inspect(engine)
+        live_tables = set(inspector.get_table_names())
+        problems = [f"Unexpected table {name}" for name in sorted(live_tables - set(db.Model.metadata.tables))]
+
+        for table in db.Model.metadata.sorted_tables:
+            if table.name not in live_tables:
+                problems.append(f"Missing table {table.name}")
+                continue
+            live = {column['name']: column for column in inspector.get_columns(table.name)}
+            unmapped_columns = UNMAPPED_COLUMNS.get(table.name, set()) if m.postgresql else set()
+            for column in table.columns:
+                if column.name not in live:
+                    problems.append(f"Missing column {table.name}.{column.name}")
+                # SQLite can't change nullability in place; migrated columns stay nullable there
+                elif m.postgresql and live[column.name]['nullable'] != column.nullable:
+                    problems.append(f"Column {table.name}.{column.name} is "
+                                    f"{'' if live[column.name]['nullable'] else 'NOT '}NULL in the database")
+            for name in sorted(unmapped_columns - set(live)):
+                problems.append(f"Missing column {table.name}.{name}")
+            for name in sorted(set(live) - set(table.columns.keys()) - unmapped_columns):
+                problems.append(f"Unexpected column {table.name}.{name}")
+
+            indexes = m.indexes(table.name)
+            expected = {index.name: str(CreateIndex(index).compile(dialect=m.dialect)) for index in table.indexes}
+            if m.postgresql:
+                expected.update(UNMAPPED_INDEXES.get(table.name, {}))
+            for name, statement in sorted(expected.items()):
+                if name not in indexes:
+                    problems.append(f"Missing index {name}")
+                elif not indexes[name][0]:
+                    problems.append(f"Index {name} is invalid; rerun `flask db upgrade` to rebuild it")
+                elif _canonical(indexes[name][1]) != m.definition(statement):
+                    problems.append(f"Index {name} differs from the models: {indexes[name][1]}")
+            for name in sorted(set(indexes) - set(expected)):
+                problems.append(f"Unexpected index {name}")
+
+        if SchemaMigration.__tablename__ in live_tables:
+            applied = _applied(engine)
+            problems.extend(f"Migration {version} not applied" for version, _ in MIGRATIONS
+                            if version not in applied)
+        return problems
+    finally:
+        engine.dispose()
+
+
+def init_migrations(app):
+    """Set migration defaults."""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+
+@db_cli.command('upgrade')
+def upgrade_command():
+    """Apply pending schema migrations."""
+    applied = upgrade(echo=click.echo)
+    click.echo(f"Applied {len(applied)} migrations." if applied else "Schema is up to date.")
+
+
+@db_cli.command('check')
+def check_command():
+    """Compare the models with the live schema; exit 1 if they differ."""
+    problems = check_schema()
+    for problem in problems:
+        click.echo(problem)
+    if problems:
+        raise click.exceptions.Exit(1)
+    click.echo("Schema matches the models.")
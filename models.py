@@ -1,83 +1,681 @@
 """Models for Blogly."""
+import base64
+import json
+from datetime import datetime
+from collections import Counter
 from unicodedata import name
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql, sqlite
+import pool
+import search
+from replicas import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 def connect_db(app):
+    for key, value in pool.DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', pool.engine_options(app.config))
+    
     db.app = app
     db.init_app(app)
+
+def encode_cursor(values):
+    """Encode the sort key of the last row on a page as an opaque cursor."""
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+def decode_cursor(cursor, *types):
+    """Decode a cursor made by encode_cursor into one value of each of types; raise ValueError if malformed.
+    
+    float takes any JSON number and datetime an ISO 8601 string.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError("wrong length")
+        return [_cursor_value(value, kind) for value, kind in zip(values, types)]
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+def _cursor_value(value, kind):
+    if kind is datetime:
+        return datetime.fromisoformat(value)
+    if kind is float and type(value) in (int, float):
+        return float(value)
+    #type(), not isinstance: JSON true isn't an id
+    if type(value) is not kind:
+        raise ValueError(f"expected {kind.__name__}")
+    return value
+
+def insert_ignoring_conflicts(model):
+    """Return an INSERT into model's table that skips rows already present.
     
+    Emits INSERT ... ON CONFLICT DO NOTHING on PostgreSQL and SQLite.
+    """
+    dialect = db.engine.dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    return insert(model.__table__).on_conflict_do_nothing()
+    
+DEFAULT_IMAGE_URL = "https://images.unsplash.com/photo-1533738363-b7f9aef128ce?ixlib=rb-1.2.1&ixid=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=format&fit=crop&w=735&q=80"
+
 class User(db.Model):
     """Users model"""
     
     __tablename__ = 'users'
     
+    #Covers the /users listing: sorted by name, keyset paginated on id
+    __table_args__ = (
+        db.Index('ix_users_last_name_first_name_id', 'last_name', 'first_name', 'id',
+                 postgresql_include=['post_count']),
+        #Finds the source of an evicted avatar thumbnail
+        db.Index('ix_users_avatar_key', 'avatar_key'),
+    )
+    
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
     first_name = db.Column(db.String(50), nullable = False)
     last_name = db.Column(db.String(50), nullable = False)
-    image_url = db.Column(db.Text, nullable = False, 
-                        default = "https://images.unsplash.com/photo-1533738363-b7f9aef128ce?ixlib=rb-1.2.1&ixid=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=format&fit=crop&w=735&q=80")
+    image_url = db.Column(db.Text, nullable = False, default = DEFAULT_IMAGE_URL)
+    #Digest and extension of the local thumbnails of image_url, see avatars.py
+    avatar_key = db.Column(db.String(80))
     
-    posts = db.relationship("Post", backref="users", cascade="all, delete-orphan")
+    #Maintained on flush, see _count_flushed_posts and repair_post_counters
+    post_count = db.Column(db.Integer, nullable = False, default = 0, server_default = '0')
+    last_post_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, nullable = False, default=db.func.current_timestamp(),
+                           onupdate=db.func.current_timestamp(),
+                           server_default=db.func.current_timestamp())
+    
+    #Posts go by ON DELETE CASCADE; see deletion.py for deleting prolific users
+    posts = db.relationship("Post", backref="users", cascade="all, delete-orphan", passive_deletes=True)
     
     def __repr__(self):
         """Representation of User Instance"""
         u = self
         return f"<User id={u.id} first_name={u.first_name} last_name={u.last_name} image_url={u.image_url}>"
     
+    def cache_labels(self):
+        """Labels of cached pages a change to this user makes stale."""
+        return {f"user:{self.id}"}
+    
     @property
     def full_name(self):
         """Show first and last names concatenated together."""
         return f"{self.first_name} {self.last_name}"
     
+    @classmethod
+    def keyset_page(cls, after=None, per_page=50):
+        """Return (users, next_cursor) for one page of the name-sorted listing.
+        
+        Only the columns the listing renders are loaded, so the page is served
+        from ix_users_last_name_first_name_id. `after` is the cursor returned
+        with the previous page; next_cursor is None on the last page.
+        """
+        users = db.session.execute(cls.keyset_page_select(after, per_page)).scalars().all()
+        return cls.keyset_page_result(users, per_page)
+    
+    @classmethod
+    def keyset_page_select(cls, after, per_page):
+        """The SELECT behind keyset_page, also run by the async routes."""
+        query = db.select(cls).options(db.load_only(cls.first_name, cls.last_name, cls.post_count))
+        
+        if after:
+            last_name, first_name, user_id = decode_cursor(after, str, str, int)
+            query = query.where(
+                db.tuple_(cls.last_name, cls.first_name, cls.id) > (last_name, first_name, user_id))
+        
+        return query.order_by(cls.last_name, cls.first_name, cls.id).limit(per_page + 1)
+    
+    @staticmethod
+    def keyset_page_result(users, per_page):
+        """(users, next_cursor) from the rows keyset_page_select returned."""
+        if len(users) <= per_page:
+            return users, None
+        
+        users = users[:per_page]
+        last = users[-1]
+        return users, encode_cursor([last.last_name, last.first_name, last.id])
+    
 class Post(db.Model):
     """Posts model"""
     
     __tablename__ = 'posts'
     
+    #The global feed walks the first; user pages the second
+    __table_args__ = (
+        db.Index('ix_posts_created_at_id', 'created_at', 'id'),
+        db.Index('ix_posts_user_id_created_at', 'user_id', 'created_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
     title = db.Column(db.String(40), nullable = False)
     content = db.Column(db.Text, nullable = False)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp(), nullable = False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"), nullable=False)
+    #Also moved when the post's tags change, so it covers tag_ids
+    updated_at = db.Column(db.DateTime, nullable = False, default=db.func.current_timestamp(),
+                           onupdate=db.func.current_timestamp(),
+                           server_default=db.func.current_timestamp())
     
     #Relationship to PostTag
-    posts_tags = db.relationship("PostTag", backref="posts", cascade="all, delete-orphan")
+    posts_tags = db.relationship("PostTag", backref="posts", cascade="all, delete-orphan",
+                                 passive_deletes=True)
     
-    #Through relationship to Tag
-    tags = db.relationship("Tag", secondary="posts_tags", backref="posts")
+    #Through relationship to Tag, read-only: write through PostTag or sync_tags
+    #so the tag counters stay right
+    tags = db.relationship("Tag", secondary="posts_tags",
+                           backref=db.backref("posts", viewonly=True), viewonly=True)
     
     def __repr__(self):
         """Representation of Post Instance"""
         p = self
         return f"<Post id={p.id} title={p.title} created_at={p.created_at} user_id={p.user_id}>"
     
+    def cache_labels(self):
+        """Labels of cached pages a change to this post makes stale."""
+        return {f"post:{self.id}", f"user:{self.user_id}"}
+    
+    @property
+    def tag_ids(self):
+        """Ids of the post's tags, from the posts_tags links."""
+        return [link.tag_id for link in self.posts_tags]
+    
+    def search_text(self):
+        """Text indexed for full-text search."""
+        return f"{self.title} {self.content}"
+    
+    @classmethod
+    def search(cls, q, after=None, per_page=20):
+        """Return (posts, next_cursor) for posts matching q, best match first.
+        
+        On PostgreSQL this uses the search_vector column and its GIN index,
+        ranked by ts_rank_cd; elsewhere it uses the in-process index from
+        search.py. Results are keyset paginated on (rank, id).
+        """
+        if db.engine.dialect.name != 'postgresql':
+            return cls._search_fallback(q, after, per_page)
+        
+        tsquery = db.func.websearch_to_tsquery('english', q)
+        vector = db.literal_column('posts.search_vector')
+        rank = db.func.ts_rank_cd(vector, tsquery)
+        
+        query = (db.session.query(cls, rank)
+                 .options(db.load_only(cls.title, cls.created_at))
+                 .filter(vector.op('@@')(tsquery)))
+        if after:
+            last_rank, last_id = decode_cursor(after, float, int)
+            # ts_rank_cd returns real; compare as real so the cursor round-trips exactly
+            query = query.filter(db.tuple_(rank, cls.id) < db.tuple_(db.cast(last_rank, db.REAL), last_id))
+        
+        rows = query.order_by(rank.desc(), cls.id.desc()).limit(per_page + 1).all()
+        return cls._ranked_page(rows, per_page)
+    
+    @classmethod
+    def _search_fallback(cls, q, after, per_page):
+        index = search.index_for(db.session.bind.url)
+        with index.lock:
+            if index.stale:
+                index.rebuild((post_id, f"{title} {content}") for post_id, title, content
+                              in db.session.query(cls.id, cls.title, cls.content))
+            ranked = index.search(q, after=decode_cursor(after, float, int) if after else None,
+                                  limit=per_page + 1)
+        
+        posts = {post.id: post for post in cls.query.options(db.load_only(cls.title, cls.created_at))
+                 .filter(cls.id.in_([post_id for _, post_id in ranked]))}
+        rows = [(posts[post_id], rank) for rank, post_id in ranked if post_id in posts]
+        return cls._ranked_page(rows, per_page)
+    
+    @staticmethod
+    def _ranked_page(rows, per_page):
+        if len(rows) <= per_page:
+            return [post for post, _ in rows], None
+        rows = rows[:per_page]
+        last_post, last_rank = rows[-1]
+        return [post for post, _ in rows], encode_cursor([last_rank, last_post.id])
+    
+    @classmethod
+    def with_tags(cls, tag_ids, match='all', after=None, per_page=20):
+        """Return (posts, next_cursor) for posts having all, or any, of tag_ids.
+        
+        One GROUP BY over posts_tags, served by ix_posts_tags_tag_id_post_id,
+        joined to posts. With match='any', posts having more of the tags come
+        first. Keyset paginated on (matched tags, id), both descending.
+        """
+        if match not in ('all', 'any'):
+            raise ValueError(f"match must be 'all' or 'any', not {match!r}")
+        tag_ids = set(tag_ids)
+        if not tag_ids:
+            return [], None
+        
+        matched = db.func.count().label('matched')
+        grouped = (db.select(PostTag.post_id, matched)
+                   .where(PostTag.tag_id.in_(tag_ids)).group_by(PostTag.post_id))
+        if match == 'all':
+            grouped = grouped.having(db.func.count() == len(tag_ids))
+        grouped = grouped.subquery()
+        
+        query = (db.session.query(cls, grouped.c.matched)
+                 .options(db.load_only(cls.title, cls.created_at))
+                 .join(grouped, grouped.c.post_id == cls.id))
+        if after:
+            last_matched, last_id = decode_cursor(after, int, int)
+            query = query.filter(db.tuple_(grouped.c.matched, cls.id) < db.tuple_(last_matched, last_id))
+        
+        rows = query.order_by(grouped.c.matched.desc(), cls.id.desc()).limit(per_page + 1).all()
+        return cls._ranked_page(rows, per_page)
+    
+    def related(self, limit=5):
+        """Return up to limit [(post, shared tag count)] for other posts sharing tags with this one.
+        
+        One self-join and GROUP BY over posts_tags: the post's links by primary
+        key, other posts' by ix_posts_tags_tag_id_post_id. Most shared first.
+        """
+        return db.session.execute(self.related_select(limit)).all()
+    
+    def related_select(self, limit=5):
+        """The SELECT behind related, also run by the async routes."""
+        mine = db.aliased(PostTag)
+        theirs = db.aliased(PostTag)
+        shared = db.func.count().label('shared')
+        ranked = (db.select(theirs.post_id, shared)
+                  .join(mine, mine.tag_id == theirs.tag_id)
+                  .where(mine.post_id == self.id, theirs.post_id != self.id)
+                  .group_by(theirs.post_id)
+                  .order_by(shared.desc(), theirs.post_id.desc())
+                  .limit(limit).subquery())
+        
+        return (db.select(Post, ranked.c.shared)
+                .options(db.load_only(Post.title))
+                .join(ranked, ranked.c.post_id == Post.id)
+                .order_by(ranked.c.shared.desc(), Post.id.desc()))
+    
+    @classmethod
+    def feed(cls, tag_id=None, after=None, per_page=20, use_timeline=True):
+        """Return (posts, next_cursor) for the newest posts, optionally of one tag.
+        
+        The global feed walks ix_posts_created_at_id. A tag's feed walks its
+        tag_timeline rows in order, or with use_timeline=False joins
+        posts_tags to posts and sorts the tag's posts. Keyset paginated on
+        (created_at, id), both descending.
+        """
+        query = cls.query.options(db.load_only(cls.title, cls.created_at, cls.user_id),
+                                  db.joinedload(cls.users).load_only(User.first_name, User.last_name))
+        created_at, post_id = cls.created_at, cls.id
+        if tag_id is not None and use_timeline:
+            created_at, post_id = TagTimelineEntry.created_at, TagTimelineEntry.post_id
+            query = (query.join(TagTimelineEntry, TagTimelineEntry.post_id == cls.id)
+                     .filter(TagTimelineEntry.tag_id == tag_id))
+        elif tag_id is not None:
+            query = query.join(PostTag, PostTag.post_id == cls.id).filter(PostTag.tag_id == tag_id)
+        
+        if after:
+            last_created_at, last_id = decode_cursor(after, datetime, int)
+            query = query.filter(db.tuple_(created_at, post_id) < db.tuple_(last_created_at, last_id))
+        
+        posts = query.order_by(created_at.desc(), post_id.desc()).limit(per_page + 1).all()
+        if len(posts) <= per_page:
+            return posts, None
+        posts = posts[:per_page]
+        return posts, encode_cursor([posts[-1].created_at.isoformat(), posts[-1].id])
+    
+    def sync_tags(self, tag_ids):
+        """Make the post's tags exactly tag_ids without loading any Tag rows.
+        
+        Reads the post's current tag ids, then applies the delta with one
+        bulk DELETE and one INSERT ... SELECT ... ON CONFLICT DO NOTHING (which
+        skips ids that don't belong to an existing tag), and moves the
+        counters of the affected tags. A change moves updated_at. The post is
+        flushed first so it has an id; the caller commits.
+        """
+        tag_ids = set(tag_ids)
+        is_new = self.id is None
+        
+        current = set()
+        if not is_new:
+            with db.session.no_autoflush:
+                current = {tag_id for (tag_id,) in
+                           db.session.query(PostTag.tag_id).filter(PostTag.post_id == self.id)}
+        added = tag_ids - current
+        removed = current - tag_ids
+        
+        # Set before the flush so it rides on any UPDATE of the post's own columns
+        if (added or removed) and not is_new:
+            self.updated_at = db.func.current_timestamp()
+        db.session.flush()
+        if not (added or removed):
+            return
+        
+        options = {'synchronize_session': False,
+                   'cache_labels': {f"post:{self.id}", "tags", *(f"tag:{tag_id}" for tag_id in added | removed)}}
+        
+        if removed:
+            db.session.execute(db.delete(PostTag).where(PostTag.post_id == self.id,
+                                                        PostTag.tag_id.in_(removed)),
+                               execution_options=options)
+            db.session.execute(_posts_removed(Tag, dict.fromkeys(removed, 1)), execution_options=options)
+            db.session.execute(db.delete(TagTimelineEntry).where(TagTimelineEntry.post_id == self.id,
+                                                                 TagTimelineEntry.tag_id.in_(removed)),
+                               execution_options=options)
+        
+        if added:
+            db.session.execute(insert_ignoring_conflicts(PostTag).from_select(
+                ['post_id', 'tag_id'],
+                db.select(db.literal(self.id), Tag.id).where(Tag.id.in_(added))),
+                execution_options=options)
+            db.session.execute(_posts_added(Tag, dict.fromkeys(added, 1), [self.id]),
+                               execution_options=options)
+            db.session.execute(_timeline_added(PostTag.post_id == self.id, PostTag.tag_id.in_(added)),
+                               execution_options=options)
+        
+        db.session.expire(self, ['posts_tags', 'tags'])
+    
+search.track(Post)
+
+#tsvector column, kept current by a trigger, and GIN index behind Post.search
+#(PostgreSQL 11+), outside the ORM metadata; migrations.py adds them to
+#existing databases
+SEARCH_VECTOR_COLUMN = "search_vector tsvector"
+SEARCH_VECTOR_TRIGGER = (
+    "CREATE OR REPLACE FUNCTION posts_search_vector() RETURNS trigger AS $$ BEGIN "
+    "NEW.search_vector := to_tsvector('english', NEW.title || ' ' || NEW.content); "
+    "RETURN NEW; END $$ LANGUAGE plpgsql; "
+    "DROP TRIGGER IF EXISTS posts_search_vector ON posts; "
+    "CREATE TRIGGER posts_search_vector BEFORE INSERT OR UPDATE OF title, content ON posts "
+    "FOR EACH ROW EXECUTE FUNCTION posts_search_vector()")
+SEARCH_VECTOR_INDEX = "CREATE INDEX ix_posts_search_vector ON posts USING GIN (search_vector)"
+event.listen(Post.__table__, 'after_create', db.DDL(
+    f"ALTER TABLE posts ADD COLUMN {SEARCH_VECTOR_COLUMN}; {SEARCH_VECTOR_TRIGGER}; {SEARCH_VECTOR_INDEX}"
+).execute_if(dialect='postgresql'))
+    
 class Tag(db.Model):
     """Tags model"""
     
     __tablename__ = 'tags'
     
+    __table_args__ = (
+        db.Index('ix_tags_post_count', 'post_count'),
+    )
+    
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
     name = db.Column(db.String(30), nullable = False, unique=True)
     
-    #Relationship to PostTag
-    posts_tags = db.relationship("PostTag", backref="tags", cascade="all, delete-orphan")
+    #Maintained on flush and by Post.sync_tags, see repair_post_counters
+    post_count = db.Column(db.Integer, nullable = False, default = 0, server_default = '0')
+    last_post_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, nullable = False, default=db.func.current_timestamp(),
+                           onupdate=db.func.current_timestamp(),
+                           server_default=db.func.current_timestamp())
+    
+    #Relationship to PostTag; links go by ON DELETE CASCADE
+    posts_tags = db.relationship("PostTag", backref="tags", cascade="all, delete-orphan",
+                                 passive_deletes=True)
     
     def __repr__(self):
         """Representation of Tag Instance"""
         t = self
         return f"<Tag id={t.id} name={t.name}>"
     
+    def cache_labels(self):
+        """Labels of cached pages a change to this tag makes stale."""
+        return {f"tag:{self.id}", "tags"}
+    
+    @classmethod
+    def autocomplete(cls, prefix, limit=10):
+        """Return up to limit tags whose names start with prefix, ignoring case.
+        
+        Served by ix_tags_name_prefix; LIKE wildcards in prefix match literally.
+        """
+        escaped = prefix.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        name = db.func.lower(cls.name)
+        return (cls.query.options(db.load_only(cls.name))
+                .filter(name.like(escaped + '%', escape='\\'))
+                .order_by(name, cls.id).limit(limit).all())
+    
+#Case-insensitive prefix search for Tag.autocomplete; text_pattern_ops lets
+#PostgreSQL use it for LIKE 'prefix%' whatever the database collation
+db.Index('ix_tags_name_prefix', db.func.lower(Tag.name).label('name_lower'),
+         postgresql_ops={'name_lower': 'text_pattern_ops'})
+    
 class PostTag(db.Model):
     """Mapping of a posts to tags."""
     
     __tablename__ = 'posts_tags'
     
+    #The primary key serves lookups by post; this one serves them by tag
+    __table_args__ = (
+        db.Index('ix_posts_tags_tag_id_post_id', 'tag_id', 'post_id'),
+    )
+    
     post_id = db.Column(db.Integer, db.ForeignKey("posts.id", ondelete="cascade"), primary_key=True)
     tag_id = db.Column(db.Integer, db.ForeignKey("tags.id", ondelete="cascade"), primary_key=True)
     
     def __repr__(self):
         """Representation of PostTag Instance"""
         pt = self
-        return f"<PostTag post_id={pt.post_id} tag_id={pt.tag_id}>"
\ No newline at end of file
+        return f"<PostTag post_id={pt.post_id} tag_id={pt.tag_id}>"
+    
+    def cache_labels(self):
+        """Labels of cached pages a change to this mapping makes stale."""
+        return {f"post:{self.post_id}", f"tag:{self.tag_id}", "tags"}
+
+class TagTimelineEntry(db.Model):
+    """A post on a tag's feed: posts_tags with the post's created_at, in feed order.
+    
+    Kept in step with posts_tags by Post.sync_tags and the flush hooks below;
+    rebuild_timeline refills it after writes below the ORM.
+    """
+    
+    __tablename__ = 'tag_timeline'
+    
+    #Serves the FK cascade from posts; the primary key serves the feed
+    __table_args__ = (
+        db.Index('ix_tag_timeline_post_id', 'post_id'),
+    )
+    
+    tag_id = db.Column(db.Integer, db.ForeignKey("tags.id", ondelete="cascade"), primary_key=True)
+    created_at = db.Column(db.DateTime, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.id", ondelete="cascade"), primary_key=True)
+    
+    def __repr__(self):
+        """Representation of TagTimelineEntry Instance"""
+        e = self
+        return f"<TagTimelineEntry tag_id={e.tag_id} created_at={e.created_at} post_id={e.post_id}>"
+
+def _timeline_added(*link_filter):
+    """INSERT ... SELECT of the tag_timeline rows for the posts_tags links matching link_filter."""
+    return insert_ignoring_conflicts(TagTimelineEntry).from_select(
+        ['tag_id', 'created_at', 'post_id'],
+        db.select(PostTag.tag_id, Post.created_at, Post.id)
+        .join(Post, Post.id == PostTag.post_id).where(*link_filter))
+
+def rebuild_timeline():
+    """Refill tag_timeline from posts_tags; the caller commits."""
+    db.session.execute(db.delete(TagTimelineEntry), execution_options={'synchronize_session': False})
+    db.session.execute(_timeline_added())
+
+class DeletionJob(db.Model):
+    """Background deletion of a user or tag with many posts, see deletion.py."""
+    
+    __tablename__ = 'deletion_jobs'
+    
+    id = db.Column(db.Integer, primary_key = True, autoincrement = True)
+    kind = db.Column(db.String(10), nullable = False)
+    target_id = db.Column(db.Integer, nullable = False)
+    state = db.Column(db.String(10), nullable = False, default = 'queued')
+    total = db.Column(db.Integer, nullable = False)
+    deleted = db.Column(db.Integer, nullable = False, default = 0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp(), nullable = False)
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(),
+                           onupdate=db.func.current_timestamp(), nullable = False)
+    
+    def __repr__(self):
+        """Representation of DeletionJob Instance"""
+        j = self
+        return f"<DeletionJob id={j.id} kind={j.kind} target_id={j.target_id} state={j.state}>"
+    
+    def to_dict(self):
+        """Status of the job as reported by /deletions/<id>."""
+        return {'id': self.id, 'kind': self.kind, 'target_id': self.target_id,
+                'state': self.state, 'total': self.total, 'deleted': self.deleted,
+                'error': self.error, 'created_at': self.created_at.isoformat(),
+                'updated_at': self.updated_at.isoformat()}
+
+class IdempotencyKey(db.Model):
+    """An Idempotency-Key a client sent, with the response to replay, see idempotency.py."""
+    
+    __tablename__ = 'idempotency_keys'
+    
+    #Serves the cleanup of expired keys
+    __table_args__ = (
+        db.Index('ix_idempotency_keys_expires_at', 'expires_at'),
+    )
+    
+    key = db.Column(db.String(255), primary_key = True)
+    fingerprint = db.Column(db.String(64), nullable = False)
+    #Both null until the request that claimed the key commits
+    status_code = db.Column(db.Integer)
+    body = db.Column(db.Text)
+    expires_at = db.Column(db.DateTime, nullable = False)
+    
+    def __repr__(self):
+        """Representation of IdempotencyKey Instance"""
+        k = self
+        return f"<IdempotencyKey key={k.key} status_code={k.status_code} expires_at={k.expires_at}>"
+
+class SchemaMigration(db.Model):
+    """A schema migration applied to this database, see migrations.py."""
+    
+    __tablename__ = 'schema_migrations'
+    
+    version = db.Column(db.String(100), primary_key = True)
+    applied_at = db.Column(db.DateTime, default=db.func.current_timestamp(), nullable = False)
+    
+    def __repr__(self):
+        """Representation of SchemaMigration Instance"""
+        m = self
+        return f"<SchemaMigration version={m.version} applied_at={m.applied_at}>"
+
+#Post counters on users and tags. Each flush moves them with at most two
+#UPDATEs per table, computed in SQL so the new values never depend on what
+#the session has loaded.
+
+def _latest_post_at(model, post_ids=None):
+    """Correlated subquery: newest post of the users/tags row, optionally among post_ids."""
+    query = db.select(db.func.max(Post.created_at))
+    if model is User:
+        query = query.where(Post.user_id == User.id)
+    else:
+        query = query.join(PostTag, PostTag.post_id == Post.id).where(PostTag.tag_id == Tag.id)
+    if post_ids is not None:
+        query = query.where(Post.id.in_(post_ids))
+    return query.scalar_subquery()
+
+def _count_posts(model):
+    """Correlated subquery: number of posts of the users/tags row."""
+    if model is User:
+        return db.select(db.func.count()).where(Post.user_id == User.id).scalar_subquery()
+    return db.select(db.func.count()).where(PostTag.tag_id == Tag.id).scalar_subquery()
+
+def _touch_posts(post_ids):
+    """UPDATE moving updated_at of posts post_ids, e.g. when their tags change."""
+    return db.update(Post.__table__).where(Post.id.in_(post_ids)).values(
+        updated_at=db.func.current_timestamp())
+
+def _posts_added(model, counts, post_ids):
+    """UPDATE counting new posts post_ids; counts maps model row id -> number added."""
+    newest = _latest_post_at(model, post_ids)
+    return (db.update(model.__table__).where(model.id.in_(counts)).values(
+        post_count=model.post_count + db.case(counts, value=model.id, else_=0),
+        last_post_at=db.case((model.last_post_at.is_(None), newest),
+                             (model.last_post_at < newest, newest),
+                             else_=model.last_post_at)))
+
+def _posts_removed(model, counts):
+    """UPDATE uncounting posts already gone; counts maps model row id -> number removed."""
+    return (db.update(model.__table__).where(model.id.in_(counts)).values(
+        post_count=model.post_count - db.case(counts, value=model.id, else_=0),
+        last_post_at=_latest_post_at(model)))
+
+@event.listens_for(Session, 'before_flush')
+def _load_cascaded_links(session, flush_context, instances):
+    """Make links the database is about to cascade-delete count.
+    
+    With passive_deletes, deleting a post or user doesn't load its children.
+    A post's few tag links are loaded and deleted through the session; a
+    user's are only counted per tag, with one GROUP BY.
+    """
+    posts = [obj.id for obj in session.deleted
+             if isinstance(obj, Post) and 'posts_tags' in db.inspect(obj).unloaded]
+    users = [obj.id for obj in session.deleted
+             if isinstance(obj, User) and 'posts' in db.inspect(obj).unloaded]
+    
+    if posts:
+        for link in session.query(PostTag).filter(PostTag.post_id.in_(posts)):
+            session.delete(link)
+    # Left over if an earlier flush failed
+    session.info.pop('cascaded_tag_counts', None)
+    if users:
+        session.info['cascaded_tag_counts'] = Counter(dict(
+            session.query(PostTag.tag_id, db.func.count())
+            .join(Post, Post.id == PostTag.post_id)
+            .filter(Post.user_id.in_(users))
+            .group_by(PostTag.tag_id)))
+
+@event.listens_for(Session, 'after_flush')
+def _count_flushed_posts(session, flush_context):
+    new_posts = [obj for obj in session.new if isinstance(obj, Post)]
+    new_links = [obj for obj in session.new if isinstance(obj, PostTag)]
+    gone_posts = [obj for obj in session.deleted if isinstance(obj, Post)]
+    gone_links = [obj for obj in session.deleted if isinstance(obj, PostTag)]
+    
+    # Rows deleted in this flush need no counters
+    gone_users = {obj.id for obj in session.deleted if isinstance(obj, User)}
+    gone_tags = {obj.id for obj in session.deleted if isinstance(obj, Tag)}
+    
+    statements = []
+    if new_posts:
+        statements.append(_posts_added(User, Counter(post.user_id for post in new_posts),
+                                       [post.id for post in new_posts]))
+    if new_links:
+        statements.append(_posts_added(Tag, Counter(link.tag_id for link in new_links),
+                                       [link.post_id for link in new_links]))
+    removed_from_users = Counter(post.user_id for post in gone_posts if post.user_id not in gone_users)
+    if removed_from_users:
+        statements.append(_posts_removed(User, removed_from_users))
+    removed_from_tags = Counter(link.tag_id for link in gone_links)
+    removed_from_tags.update(session.info.pop('cascaded_tag_counts', {}))
+    for tag_id in gone_tags:
+        removed_from_tags.pop(tag_id, None)
+    if removed_from_tags:
+        statements.append(_posts_removed(Tag, removed_from_tags))
+    
+    if new_links:
+        statements.append(_timeline_added(db.tuple_(PostTag.post_id, PostTag.tag_id).in_(
+            [(link.post_id, link.tag_id) for link in new_links])))
+    # Links of deleted posts and tags go with them by ON DELETE CASCADE
+    gone_post_ids = {post.id for post in gone_posts}
+    unlinked = [(link.post_id, link.tag_id) for link in gone_links
+                if link.post_id not in gone_post_ids and link.tag_id not in gone_tags]
+    if unlinked:
+        statements.append(db.delete(TagTimelineEntry).where(
+            db.tuple_(TagTimelineEntry.post_id, TagTimelineEntry.tag_id).in_(unlinked)))
+    #A post's tag_ids are part of it, as for Post.sync_tags; new posts are fresh already
+    new_post_ids = {post.id for post in new_posts}
+    retagged = ({link.post_id for link in new_links} - new_post_ids) | {post_id for post_id, _ in unlinked}
+    if retagged:
+        statements.append(_touch_posts(retagged))
+    
+    connection = session.connection()
+    for statement in statements:
+        connection.execute(statement)
+
+def repair_post_counters():
+    """Recompute every user's and tag's post counters from the posts tables.
+    
+    One set-based UPDATE per table with correlated subqueries; the caller
+    commits.
+    """
+    for model in (User, Tag):
+        db.session.execute(db.update(model.__table__).values(
+            post_count=_count_posts(model), last_post_at=_latest_post_at(model)))
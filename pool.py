@@ -0,0 +1,154 @@
+"""Connection pool configuration and metrics for Blogly.
+
+connect_db builds SQLALCHEMY_ENGINE_OPTIONS from the DB_* config keys below,
+using MeteredQueuePool so each worker can report how long requests waited
+for a connection.
+
+PostgreSQL sessions run in UTC, so the naive timestamp columns filled by
+current_timestamp hold UTC, as they do on SQLite.
+"""
+
+import threading
+from time import perf_counter
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+DEFAULT_CONFIG = {
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+    'DB_STATEMENT_TIMEOUT_MS': None,
+    'POOL_STATS_ENDPOINT': False,
+}
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records how long each checkout took.
+
+    The time covers waiting for a free connection and, when the pool has
+    room to grow, opening a new one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._metrics_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited_ms = (perf_counter() - start) * 1000
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.wait_ms_total += waited_ms
+                self.wait_ms_max = max(self.wait_ms_max, waited_ms)
+
+
+def engine_options(config):
+    """Return SQLALCHEMY_ENGINE_OPTIONS for the DB_* settings in config."""
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+
+    # An in-memory SQLite database lives in a single connection; leave it alone
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+
+    options = {
+        'poolclass': MeteredQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+
+    timeout = config['DB_STATEMENT_TIMEOUT_MS']
+    if url.get_backend_name() == 'postgresql':
+        settings = {'timezone': 'UTC', **({'statement_timeout': int(timeout)} if timeout else {})}
+        options['connect_args'] = {'options': ' '.join(f'-c {name}={value}' for name, value in settings.items())}
+    # Pooled connections move between threads (deletion jobs, the ASGI app's
+    # WSGI threads); the pool hands each to one thread at a time
+    if url.get_backend_name() == 'sqlite':
+        options['connect_args'] = {'check_same_thread': False}
+
+    return options
+
+
+def enforce_foreign_keys(engine):
+    """Have SQLite enforce foreign keys on engine's connections, as other databases always do; return engine.
+
+    Deletes rely on the foreign keys' ON DELETE CASCADE, see deletion.py.
+    Pass an async engine's sync_engine.
+    """
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _sqlite_foreign_keys)
+    return engine
+
+
+def _sqlite_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def async_engine_options(config, url):
+    """Return create_async_engine options for url and the DB_* settings in config.
+
+    Async engines use SQLAlchemy's asyncio-aware queue pool, and asyncpg
+    takes the statement timeout as a server setting.
+    """
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+    options = {
+        'poolclass': AsyncAdaptedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    timeout = config['DB_STATEMENT_TIMEOUT_MS']
+    if url.get_backend_name() == 'postgresql':
+        settings = {'timezone': 'UTC', **({'statement_timeout': str(int(timeout))} if timeout else {})}
+        options['connect_args'] = {'server_settings': settings}
+    return options
+
+
+def pool_stats(engine):
+    """Return a dict of live statistics for engine's connection pool."""
+    pool = engine.pool
+    stats = {'pool_class': type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            # QueuePool counts overflow from -pool_size; report only the excess
+            'overflow': max(pool.overflow(), 0),
+        })
+
+    if isinstance(pool, MeteredQueuePool):
+        with pool._metrics_lock:
+            checkouts = pool.checkouts
+            stats.update({
+                'checkouts': checkouts,
+                'timeouts': pool.timeouts,
+                'wait_ms_total': round(pool.wait_ms_total, 3),
+                'wait_ms_avg': round(pool.wait_ms_total / checkouts, 3) if checkouts else 0.0,
+                'wait_ms_max': round(pool.wait_ms_max, 3),
+            })
+
+    return stats
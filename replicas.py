@@ -0,0 +1,76 @@
+"""Read-replica routing for Blogly.
+
+When SQLALCHEMY_REPLICA_URI is set, the replica is added as the 'replica'
+bind and GET/HEAD requests read from it. Everything else, and every flush,
+goes to the primary. After a write request the client gets a short-lived
+cookie that keeps its reads on the primary, so the redirect that follows a
+POST sees the row it just wrote even if the replica is lagging.
+"""
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+
+from pool import enforce_foreign_keys
+
+REPLICA_BIND = 'replica'
+STICKY_COOKIE = 'read_primary'
+READ_METHODS = ('GET', 'HEAD')
+
+DEFAULT_CONFIG = {
+    'SQLALCHEMY_REPLICA_URI': None,
+    'REPLICA_STICKY_SECONDS': 5,
+}
+
+
+def reads_from_replica():
+    """Return True if the current request should read from the replica."""
+    return has_request_context() and g.get('read_from_replica', False)
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends reads to the replica during read-only requests."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self._flushing and reads_from_replica():
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension whose sessions are RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        return enforce_foreign_keys(super().create_engine(sa_url, engine_opts))
+
+
+def init_replicas(app):
+    """Register the replica bind and the per-request routing hooks on app."""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+    replica_uri = app.config['SQLALCHEMY_REPLICA_URI']
+    if not replica_uri:
+        return
+
+    app.config['SQLALCHEMY_BINDS'] = {**(app.config.get('SQLALCHEMY_BINDS') or {}),
+                                      REPLICA_BIND: replica_uri}
+
+    @app.before_request
+    def route_reads():
+        g.read_from_replica = (request.method in READ_METHODS
+                               and STICKY_COOKIE not in request.cookies)
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method not in READ_METHODS:
+            response.set_cookie(STICKY_COOKIE, '1', httponly=True, samesite='Lax',
+                                max_age=app.config['REPLICA_STICKY_SECONDS'])
+        return response
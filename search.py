@@ -0,0 +1,159 @@
+"""In-process full-text index used when the database isn't PostgreSQL.
+
+On PostgreSQL, Post.search runs against the trigger-maintained search_vector
+column and its GIN index. SQLite test runs have no tsvector, so Post.search falls
+back to an InvertedIndex per database, kept current from session events:
+documents flushed by committed transactions are reindexed, and any bulk
+write to a tracked table marks the index stale so it is rebuilt on the next
+search.
+"""
+
+import math
+import re
+import threading
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+TOKEN_RE = re.compile(r'\w+')
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+_tracked_tables = set()
+
+
+def tokenize(text):
+    """Split text into lowercase word tokens."""
+    return TOKEN_RE.findall(text.lower())
+
+
+class InvertedIndex:
+    """Term -> {doc_id: term frequency} postings with tf-idf ranking."""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.doc_terms = {}
+        self.stale = True
+        self.lock = threading.RLock()
+
+    def add(self, doc_id, text):
+        """Index text under doc_id, replacing any earlier version."""
+        with self.lock:
+            self.remove(doc_id)
+            counts = defaultdict(int)
+            for token in tokenize(text):
+                counts[token] += 1
+            for term, count in counts.items():
+                self.postings[term][doc_id] = count
+            self.doc_terms[doc_id] = set(counts)
+
+    def remove(self, doc_id):
+        """Drop doc_id from the index."""
+        with self.lock:
+            for term in self.doc_terms.pop(doc_id, ()):
+                docs = self.postings[term]
+                docs.pop(doc_id, None)
+                if not docs:
+                    del self.postings[term]
+
+    def rebuild(self, rows):
+        """Replace the whole index with (doc_id, text) rows."""
+        with self.lock:
+            self.postings.clear()
+            self.doc_terms.clear()
+            for doc_id, text in rows:
+                self.add(doc_id, text)
+            self.stale = False
+
+    def search(self, query, after=None, limit=20):
+        """Return [(rank, doc_id)] for docs containing every query term.
+
+        Sorted by rank then id, both descending; `after` is the (rank, id) of
+        the last result of the previous page.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        with self.lock:
+            postings = [self.postings.get(term, {}) for term in terms]
+            if not all(postings):
+                return []
+            doc_count = len(self.doc_terms)
+            matches = set.intersection(*(set(docs) for docs in postings))
+            results = []
+            for doc_id in matches:
+                rank = sum(docs[doc_id] * math.log(1 + doc_count / len(docs)) for docs in postings)
+                results.append((rank, doc_id))
+
+        results.sort(reverse=True)
+        if after is not None:
+            results = [result for result in results if result < tuple(after)]
+        return results[:limit]
+
+
+def index_for(url):
+    """Return the fallback index for the database at url."""
+    with _indexes_lock:
+        return _indexes.setdefault(str(url), InvertedIndex())
+
+
+def track(model):
+    """Keep fallback indexes current for model, which has search_text()."""
+    _tracked_tables.add(model.__table__)
+    if not event.contains(Session, 'after_commit', _apply_after_commit):
+        event.listen(Session, 'after_flush', _queue_after_flush)
+        event.listen(Session, 'do_orm_execute', _stale_after_bulk_write)
+        event.listen(Session, 'after_commit', _apply_after_commit)
+        event.listen(Session, 'after_rollback', _discard_after_rollback)
+
+
+def _pending(session):
+    return session.info.setdefault('search_pending', {'docs': {}, 'stale': False})
+
+
+def _uses_fallback(session):
+    return session.bind is not None and session.bind.dialect.name != 'postgresql'
+
+
+def _queue_after_flush(session, flush_context):
+    if not _uses_fallback(session):
+        return
+    for obj in session.new | session.dirty:
+        if getattr(obj, '__table__', None) in _tracked_tables:
+            _pending(session)['docs'][obj.id] = obj.search_text()
+    for obj in session.deleted:
+        if getattr(obj, '__table__', None) in _tracked_tables:
+            _pending(session)['docs'][obj.id] = None
+
+
+def _stale_after_bulk_write(orm_execute_state):
+    state = orm_execute_state
+    if not (state.is_insert or state.is_update or state.is_delete) or not _uses_fallback(state.session):
+        return
+    tables = {mapper.local_table for mapper in state.all_mappers}
+    table = getattr(state.statement, 'table', None)
+    if table is not None:
+        tables.add(table)
+    if tables & _tracked_tables:
+        _pending(state.session)['stale'] = True
+
+
+def _apply_after_commit(session):
+    pending = session.info.pop('search_pending', None)
+    if not pending or session.bind is None:
+        return
+    index = index_for(session.bind.url)
+    with index.lock:
+        if pending['stale']:
+            index.stale = True
+        for doc_id, text in pending['docs'].items():
+            if text is None:
+                index.remove(doc_id)
+            else:
+                index.add(doc_id, text)
+
+
+def _discard_after_rollback(session):
+    session.info.pop('search_pending', None)
@@ -1,11 +1,15 @@
 """Seed file to make sample data for db."""
 
 from models import User, Post, Tag, PostTag, db
-from app import app
+from app import create_app
+from migrations import upgrade
 
-# Create all tables
+app = create_app()
+app.app_context().push()
+
+# Create the schema
 db.drop_all()
-db.create_all()
+upgrade()
 
 User.query.delete()
 Post.query.delete()
@@ -1,20 +1,49 @@
-from unittest import TestCase
+import asyncio
+import base64
+import gzip
+import importlib.util
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, mock, skipUnless
 
-from app import app
-from models import db, User, Post, Tag, PostTag
+import brotli
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
 
-# Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly_test'
-app.config['SQLALCHEMY_ECHO'] = False
+from app import create_app
+from asgi import create_asgi_app
+from avatars import prune, save_avatar, thumbnail_name
+from cache import MemoryCache
+from instrumentation import RequestStats
+from migrations import MIGRATIONS, Migrator, check_schema, search_vector, upgrade
+from models import db, encode_cursor, User, Post, Tag, PostTag, IdempotencyKey, SchemaMigration, TagTimelineEntry
+from pool import engine_options, MeteredQueuePool
 
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+# Use test database and make Flask errors be real errors, rather than HTML
+# pages with error info. The debug toolbar only loads in debug mode.
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': 'postgresql:///blogly_test',
+    'TESTING': True,
+})
 
 db.drop_all()
-db.create_all()
+upgrade()
+
+#The asyncio driver the async mode tests need for the test database
+ASYNC_DRIVER = {'postgresql': 'asyncpg', 'sqlite': 'aiosqlite'}[
+    make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()]
+
+#A 1x1 PNG served by the stand-in image host
+PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
 
 class UserViewsTestCase(TestCase):
     """Tests for views for Users."""
@@ -60,6 +89,89 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Test User', html)
             
+    def test_list_users_paginated(self):
+        """Test that the users listing is split into keyset pages."""
+        db.session.add_all([User(first_name="Page", last_name=f"User{i}") for i in range(3)])
+        db.session.commit()
+        
+        with app.test_client() as client:
+            app.config['USERS_PER_PAGE'] = 2
+            try:
+                resp = client.get('/users')
+                html = resp.get_data(as_text=True)
+                self.assertIn('Test User', html)
+                self.assertIn('Page User0', html)
+                self.assertNotIn('Page User1', html)
+                self.assertIn('Next page', html)
+                
+                _, next_cursor = User.keyset_page(per_page=2)
+                resp = client.get('/users', query_string={'after': next_cursor})
+                html = resp.get_data(as_text=True)
+                self.assertIn('Page User1', html)
+                self.assertIn('Page User2', html)
+                self.assertNotIn('Test User', html)
+                self.assertNotIn('Next page', html)
+            finally:
+                app.config['USERS_PER_PAGE'] = 50
+                
+    def test_sql_stats_headers(self):
+        """Test that responses report the request's SQL statements and time."""
+        with app.test_client() as client:
+            resp = client.get(f"/users/{self.user_id}")
+            
+            self.assertEqual(resp.headers['X-DB-Query-Count'], '2')
+            self.assertGreaterEqual(float(resp.headers['X-DB-Time-Ms']), 0)
+            self.assertIn('db;desc="2 queries";dur=', resp.headers['Server-Timing'])
+            
+    def test_slow_query_logged(self):
+        """Test that statements over the threshold are logged."""
+        with app.test_client() as client:
+            app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+            try:
+                with self.assertLogs('blogly.sql', level='WARNING') as logs:
+                    client.get('/tags')
+            finally:
+                app.config['SLOW_QUERY_THRESHOLD_MS'] = 100
+            
+            self.assertIn('Slow query', logs.output[0])
+            
+    def test_slow_query_logged_outside_request(self):
+        """Test that slow statements outside a request, as in CLI commands, are logged without parameters."""
+        app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+        try:
+            with app.app_context(), self.assertLogs('blogly.sql', level='WARNING') as logs:
+                db.session.execute(db.select(User.id).where(User.last_name == 'Secret-Name'))
+                db.session.rollback()
+        finally:
+            app.config['SLOW_QUERY_THRESHOLD_MS'] = 100
+        
+        self.assertIn('Slow query', logs.output[0])
+        self.assertNotIn('Secret-Name', '\n'.join(logs.output))
+        
+    def test_failed_statement_leaves_no_timer(self):
+        """Test that a statement that raises doesn't skew the timing of the next one."""
+        with app.test_request_context(), db.engine.connect() as conn:
+            g.sql_stats = RequestStats(3)
+            trans = conn.begin()
+            with self.assertRaises(IntegrityError):
+                conn.execute(Tag.__table__.insert(), {'name': 'test_tag'})
+            trans.rollback()
+            time.sleep(0.05)
+            conn.exec_driver_sql("SELECT 1")
+            
+            self.assertEqual(g.sql_stats.count, 1)
+            self.assertLess(g.sql_stats.total_ms, 50)
+        
+    def test_list_users_bad_cursor(self):
+        """Test that a malformed or wrongly typed cursor is rejected."""
+        with app.test_client() as client:
+            resp = client.get('/users?after=not-a-cursor')
+            self.assertEqual(resp.status_code, 400)
+            
+            for values in (["x", {}], ["Last", "First"], ["Last", "First", "1"], ["Last", "First", True]):
+                resp = client.get('/users', query_string={'after': encode_cursor(values)})
+                self.assertEqual(resp.status_code, 400, values)
+            
     def test_show_user(self):
         """Test showing a user."""
         with app.test_client() as client:
@@ -120,6 +232,18 @@ class UserViewsTestCase(TestCase):
             self.assertIn(f'<h1>{self.user.full_name}</h1>', html)
             self.assertIn("Test Title 2", html)
             
+    def test_search_posts(self):
+        """Test searching posts by title and content."""
+        with app.test_client() as client:
+            resp = client.get('/posts/search?q=content')
+            html = resp.get_data(as_text=True)
+            
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'<a href="/posts/{self.post.id}">Test Title</a>', html)
+            
+            resp = client.get('/posts/search?q=nothingmatches')
+            self.assertIn('No posts match', resp.get_data(as_text=True))
+            
     def test_edit_post_form(self):
         """Test showing the form to edit a post."""
         with app.test_client() as client:
@@ -128,6 +252,18 @@ class UserViewsTestCase(TestCase):
             
             self.assertEqual(resp.status_code, 200)
             self.assertIn(f'{self.post.title}', html)
+            self.assertIn(f'id="checkbox_{self.tag.id}"', html)
+            
+    def test_tag_autocomplete(self):
+        """Test the tag prefix search behind the tag picker."""
+        db.session.add_all([Tag(name="Testing"), Tag(name="other")])
+        db.session.commit()
+        with app.test_client() as client:
+            resp = client.get("/tags/autocomplete?q=TEST")
+            
+            self.assertEqual([tag['name'] for tag in resp.json], ["test_tag", "Testing"])
+            self.assertEqual(client.get("/tags/autocomplete?q=").json, [])
+            self.assertEqual(client.get("/tags/autocomplete?q=test%25").json, [])
             
     def test_updating_post(self):
         """Test updating post in database."""
@@ -149,6 +285,36 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(f'<h1>Test User</h1>', html)
             
+    def test_tagged_posts(self):
+        """Test listing posts with several tags."""
+        other = Tag(name="other_tag")
+        db.session.add(other)
+        db.session.commit()
+        with app.test_client() as client:
+            resp = client.get(f"/posts/tagged?tag={self.tag.id}&tag={other.id}&match=any")
+            html = resp.get_data(as_text=True)
+            
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(self.post.title, html)
+            
+            resp = client.get(f"/posts/tagged?tag={self.tag.id}&tag={other.id}")
+            self.assertIn("No posts have these tags.", resp.get_data(as_text=True))
+            self.assertEqual(client.get("/posts/tagged?tag=1&match=most").status_code, 400)
+            
+    def test_feeds(self):
+        """Test the global and per-tag feeds."""
+        with app.test_client() as client:
+            for url in ('/feed', f'/tags/{self.tag.id}/feed'):
+                resp = client.get(url)
+                html = resp.get_data(as_text=True)
+                
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(self.post.title, html)
+                self.assertIn('Test User', html)
+                
+            self.assertEqual(client.get('/feed?after=bogus').status_code, 400)
+            self.assertEqual(client.get('/tags/0/feed').status_code, 404)
+            
     def test_list_tags(self):
         """Test the route for all tags."""
         with app.test_client() as client:
@@ -216,4 +382,1047 @@ class UserViewsTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn("<h1>Tags</h1>", html)
-            self.assertNotIn(f'{self.tag.name}', html)
\ No newline at end of file
+            self.assertNotIn(f'{self.tag.name}', html)
+
+class AppFactoryTestCase(TestCase):
+    """Tests for building the app."""
+    
+    def setUp(self):
+        """Keep db bound to the test app after building throwaway apps."""
+        self.addCleanup(setattr, db, 'app', db.app)
+        self.addCleanup(db.session.remove)
+        db.session.remove()
+        
+    def test_create_app_does_not_connect(self):
+        """Test that building the app needs no database."""
+        dev_app = create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql://no-such-host/blogly'})
+        
+        self.assertIn('blogly', dev_app.blueprints)
+        self.assertNotIn('debugtoolbar', dev_app.blueprints)
+        
+    def test_debug_toolbar_in_debug_mode(self):
+        """Test that the debug toolbar is only wired up in debug mode."""
+        dev_app = create_app({'DEBUG': True})
+        
+        self.assertIn('debugtoolbar', dev_app.blueprints)
+        
+    def test_repair_counters_command(self):
+        """Test the command that recomputes post counters."""
+        result = app.test_cli_runner().invoke(args=['repair-counters'])
+        
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Repaired post counters.', result.output)
+        
+    def test_export_import_roundtrip(self):
+        """Test streaming a table out and back in, in both formats."""
+        runner = app.test_cli_runner(mix_stderr=False)
+        User.query.delete()
+        db.session.add_all([User(first_name="Bulk", last_name=f"User{i}") for i in range(3)])
+        db.session.commit()
+        
+        for fmt in ('ndjson', 'csv'):
+            exported = runner.invoke(args=['data', 'export', 'users', '--format', fmt])
+            self.assertEqual(exported.exit_code, 0)
+            self.assertIn('Exported 3 users rows', exported.stderr)
+            
+            User.query.delete()
+            db.session.commit()
+            
+            imported = runner.invoke(args=['data', 'import', 'users', '--format', fmt, '--batch-size', '2'],
+                                     input=exported.stdout)
+            self.assertEqual(imported.exit_code, 0, imported.output)
+            self.assertIn('Imported 3 users rows', imported.stderr)
+            self.assertEqual(sorted(u.full_name for u in User.query.all()),
+                             ["Bulk User0", "Bulk User1", "Bulk User2"])
+            
+    def test_create_db_command(self):
+        """Test the commands that create, migrate and check the schema."""
+        result = app.test_cli_runner().invoke(args=['create-db'])
+        
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Schema is up to date.', result.output)
+        
+        result = app.test_cli_runner().invoke(args=['db', 'check'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Schema matches the models.', result.output)
+
+        
+    def test_pool_options(self):
+        """Test that pool settings reach the engine and are reported."""
+        pool_app = create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql:///blogly_test',
+                               'DB_POOL_SIZE': 3, 'DB_MAX_OVERFLOW': 1,
+                               'POOL_STATS_ENDPOINT': True})
+        
+        with pool_app.test_client() as client:
+            client.get('/tags')
+            resp = client.get('/_pool-stats')
+            stats = resp.json['pool']
+            
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(stats['pool_class'], 'MeteredQueuePool')
+            self.assertEqual(stats['size'], 3)
+            self.assertGreaterEqual(stats['checkouts'], 1)
+            self.assertIn('wait_ms_max', stats)
+            
+    def test_pool_options_postgresql(self):
+        """Test that PostgreSQL sessions run in UTC, with the statement timeout when one is set."""
+        config = {**app.config, 'SQLALCHEMY_DATABASE_URI': 'postgresql:///utc_check'}
+        
+        self.assertEqual(engine_options(config)['connect_args'], {'options': '-c timezone=UTC'})
+        self.assertEqual(engine_options({**config, 'DB_STATEMENT_TIMEOUT_MS': 500})['connect_args'],
+                         {'options': '-c timezone=UTC -c statement_timeout=500'})
+        
+    def test_pool_options_sqlite(self):
+        """Test that a pooled SQLite file database can be used from other threads."""
+        config = {**app.config, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///blogly_test.db'}
+        options = engine_options(config)
+        
+        self.assertIs(options['poolclass'], MeteredQueuePool)
+        self.assertEqual(options['connect_args'], {'check_same_thread': False})
+        self.assertEqual(engine_options({**config, 'SQLALCHEMY_DATABASE_URI': 'sqlite://'}), {})
+            
+    def test_precompile_templates_command(self):
+        """Test compiling every template into the bytecode cache."""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cached_app = create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql:///blogly_test',
+                                     'JINJA_BYTECODE_CACHE_DIR': cache_dir})
+            result = cached_app.test_cli_runner().invoke(args=['precompile-templates'])
+            
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(len(os.listdir(cache_dir)), len(cached_app.jinja_env.list_templates()))
+            
+        result = app.test_cli_runner().invoke(args=['precompile-templates'])
+        self.assertNotEqual(result.exit_code, 0)
+        
+    def test_compression(self):
+        """Test that large text responses are gzipped for clients that accept it."""
+        User.query.delete()
+        db.session.add_all([User(first_name="Many", last_name=f"User{i}") for i in range(40)])
+        db.session.commit()
+        
+        with app.test_client() as client:
+            resp = client.get('/users', headers={'Accept-Encoding': 'gzip'})
+            
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            self.assertIn(b'Many User0', gzip.decompress(resp.data))
+            
+            self.assertNotIn('Content-Encoding', client.get('/users').headers)
+            small = client.get('/tags/autocomplete?q=x', headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', small.headers)
+            
+            resp = client.get('/users', headers={'Accept-Encoding': 'gzip, br'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'br')
+            self.assertIn(b'Many User0', brotli.decompress(resp.data))
+            
+    def test_pool_stats_endpoint_off_by_default(self):
+        """Test that pool statistics aren't exposed unless enabled."""
+        with app.test_client() as client:
+            resp = client.get('/_pool-stats')
+            
+            self.assertEqual(resp.status_code, 404)
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Tests for sending reads to a replica database."""
+    
+    def setUp(self):
+        """Build an app with a replica that holds a user the primary lacks."""
+        self.addCleanup(setattr, db, 'app', db.app)
+        self.replica_app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'postgresql:///blogly_test',
+            'SQLALCHEMY_REPLICA_URI': 'postgresql:///blogly_replica_test',
+            'TESTING': True,
+        })
+        db.session.remove()
+        
+        replica = db.get_engine(self.replica_app, bind='replica')
+        db.Model.metadata.create_all(replica)
+        with replica.begin() as conn:
+            conn.execute(User.__table__.delete())
+            conn.execute(User.__table__.insert(), {'first_name': 'Replica', 'last_name': 'Only',
+                                                   'image_url': 'http://example.com/a.png'})
+        
+    def tearDown(self):
+        """Don't leave a session bound to the replica app."""
+        db.session.remove()
+        
+    def test_get_reads_from_replica(self):
+        """Test that GET routes read from the replica."""
+        with self.replica_app.test_client() as client:
+            resp = client.get('/users')
+            html = resp.get_data(as_text=True)
+            
+            self.assertIn('Replica Only', html)
+            
+    def test_redirect_after_post_reads_primary(self):
+        """Test that the page after a write reads its own write from the primary."""
+        with self.replica_app.test_client() as client:
+            data = {"first-name": "Primary", "last-name": "Write", "image-url": ""}
+            resp = client.post("/users/new", data=data, follow_redirects=True)
+            html = resp.get_data(as_text=True)
+            
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<h1>Primary Write</h1>", html)
+            
+            resp = client.get('/users')
+            self.assertNotIn('Replica Only', resp.get_data(as_text=True))
+
+
+class PageCacheTestCase(TestCase):
+    """Tests for the rendered-page cache and its invalidation."""
+    
+    def setUp(self):
+        """Add a post with one tag and another unused tag."""
+        
+        User.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        
+        user = User(first_name="Cache", last_name="User")
+        tag = Tag(name="cached_tag")
+        other_tag = Tag(name="other_tag")
+        post = Post(title="Cached Post", content="Content", users=user, posts_tags=[PostTag(tags=tag)])
+        db.session.add_all([user, tag, other_tag, post])
+        db.session.commit()
+        
+        self.user_id = user.id
+        self.post_id = post.id
+        self.tag_id = tag.id
+        self.other_tag_id = other_tag.id
+        
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+        
+    def test_second_get_is_cached(self):
+        """Test that a repeat visit is served without touching the database."""
+        with app.test_client() as client:
+            first = client.get(f'/posts/{self.post_id}')
+            second = client.get(f'/posts/{self.post_id}')
+            
+            self.assertEqual(first.headers['X-Page-Cache'], 'MISS')
+            self.assertEqual(second.headers['X-Page-Cache'], 'HIT')
+            self.assertEqual(second.headers['X-DB-Query-Count'], '0')
+            self.assertEqual(first.data, second.data)
+            
+    def test_renaming_tag_evicts_pages_showing_it(self):
+        """Test that renaming a tag evicts its page and the posts showing it, only."""
+        with app.test_client() as client:
+            for url in (f'/tags/{self.tag_id}', f'/posts/{self.post_id}', f'/users/{self.user_id}'):
+                client.get(url)
+                
+            client.post(f'/tags/{self.tag_id}/edit', data={'name': 'renamed_tag'})
+            
+            for url in (f'/tags/{self.tag_id}', f'/posts/{self.post_id}'):
+                resp = client.get(url)
+                self.assertEqual(resp.headers['X-Page-Cache'], 'MISS')
+                self.assertIn('renamed_tag', resp.get_data(as_text=True))
+            self.assertEqual(client.get(f'/users/{self.user_id}').headers['X-Page-Cache'], 'HIT')
+            
+    def test_retagging_post_evicts_tag_pages(self):
+        """Test that moving a post between tags evicts both tag pages, only."""
+        with app.test_client() as client:
+            for url in (f'/tags/{self.tag_id}', f'/tags/{self.other_tag_id}', f'/users/{self.user_id}'):
+                client.get(url)
+                
+            data = {'title': 'Cached Post', 'content': 'Content', 'tags-checkbox': [self.other_tag_id]}
+            client.post(f'/posts/{self.post_id}/edit', data=data)
+            
+            self.assertNotIn('Cached Post', client.get(f'/tags/{self.tag_id}').get_data(as_text=True))
+            self.assertIn('Cached Post', client.get(f'/tags/{self.other_tag_id}').get_data(as_text=True))
+            self.assertEqual(client.get(f'/users/{self.user_id}').headers['X-Page-Cache'], 'HIT')
+            
+    def test_memory_cache_evicts_least_recently_used(self):
+        """Test that the in-process cache stays under its byte limit."""
+        cache = MemoryCache(max_bytes=10, ttl=60)
+        cache.set('/a', b'aaaa', {'a'}, cache.generation)
+        cache.set('/b', b'bbbb', {'b'}, cache.generation)
+        cache.get('/a')
+        cache.set('/c', b'cccc', {'c'}, cache.generation)
+        
+        self.assertEqual(cache.get('/a'), b'aaaa')
+        self.assertIsNone(cache.get('/b'))
+        self.assertEqual(cache.get('/c'), b'cccc')
+        
+        cache.invalidate({'a'})
+        self.assertIsNone(cache.get('/a'))
+        self.assertEqual(cache.get('/c'), b'cccc')
+
+
+class DeletionJobTestCase(TestCase):
+    """Tests for deleting users and tags with many posts in the background."""
+    
+    def setUp(self):
+        """Add a user with five posts, all with the same two tags."""
+        
+        User.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        
+        user = User(first_name="Prolific", last_name="User")
+        tags = [Tag(name=f"bulk_tag_{i}") for i in range(2)]
+        posts = [Post(title=f"Bulk Post {i}", content="Content", users=user,
+                      posts_tags=[PostTag(tags=tag) for tag in tags])
+                 for i in range(5)]
+        db.session.add_all([user, *tags, *posts])
+        db.session.commit()
+        
+        self.user_id = user.id
+        self.tag_ids = [tag.id for tag in tags]
+        
+        for key, value in {'ASYNC_DELETE_THRESHOLD': 3, 'ASYNC_DELETE_CHUNK_SIZE': 2}.items():
+            self.addCleanup(app.config.__setitem__, key, app.config[key])
+            app.config[key] = value
+        
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+        
+    def test_delete_prolific_user_in_background(self):
+        """Test that a user over the threshold is deleted in chunks by a job."""
+        with app.test_client() as client:
+            resp = client.post(f'/users/{self.user_id}/delete', headers={'Accept': 'application/json'})
+            self.assertEqual(resp.status_code, 202)
+            self.assertEqual(resp.json['total'], 5)
+            
+            app.extensions['deletions'].join(timeout=10)
+            
+            status = client.get(resp.headers['Location']).json
+            self.assertEqual(status['state'], 'done')
+            self.assertEqual(status['deleted'], 5)
+            
+        db.session.remove()
+        self.assertIsNone(User.query.get(self.user_id))
+        self.assertEqual(Post.query.count(), 0)
+        self.assertEqual(PostTag.query.count(), 0)
+        self.assertEqual([tag.post_count for tag in Tag.query.order_by(Tag.id)], [0, 0])
+        
+    def test_delete_popular_tag_in_background(self):
+        """Test that a tag over the threshold is untagged in chunks by a job."""
+        with app.test_client() as client:
+            resp = client.post(f'/tags/{self.tag_ids[0]}/delete', headers={'Accept': 'application/json'})
+            self.assertEqual(resp.status_code, 202)
+            
+            app.extensions['deletions'].join(timeout=10)
+            
+            self.assertEqual(client.get(resp.headers['Location']).json['state'], 'done')
+            
+        db.session.remove()
+        self.assertIsNone(Tag.query.get(self.tag_ids[0]))
+        self.assertEqual(Post.query.count(), 5)
+        self.assertEqual(PostTag.query.count(), 5)
+        
+    def test_delete_form_redirects(self):
+        """Test that the HTML delete form is redirected while the job runs."""
+        with app.test_client() as client:
+            resp = client.post(f'/tags/{self.tag_ids[0]}/delete',
+                               headers={'Accept': 'text/html,application/xhtml+xml,*/*;q=0.8'})
+            self.assertEqual(resp.status_code, 302)
+            self.assertTrue(resp.location.endswith('/tags'))
+            
+            app.extensions['deletions'].join(timeout=10)
+            
+        db.session.remove()
+        self.assertIsNone(Tag.query.get(self.tag_ids[0]))
+        
+    def test_delete_small_user_inline(self):
+        """Test that a user under the threshold is deleted during the request."""
+        app.config['ASYNC_DELETE_THRESHOLD'] = 10
+        with app.test_client() as client:
+            resp = client.post(f'/users/{self.user_id}/delete')
+            
+            self.assertEqual(resp.status_code, 302)
+            
+        db.session.remove()
+        self.assertEqual(Post.query.count(), 0)
+        self.assertEqual([tag.post_count for tag in Tag.query.order_by(Tag.id)], [0, 0])
+        
+    def test_deletes_leave_no_orphans(self):
+        """Test that deletes cascade through the foreign keys, which SQLite only enforces when told to."""
+        app.config['ASYNC_DELETE_THRESHOLD'] = 10
+        with app.test_client() as client:
+            client.post(f'/tags/{self.tag_ids[0]}/delete')
+            
+            db.session.remove()
+            self.assertEqual(PostTag.query.filter_by(tag_id=self.tag_ids[0]).count(), 0)
+            self.assertEqual(TagTimelineEntry.query.filter_by(tag_id=self.tag_ids[0]).count(), 0)
+            
+            client.post(f'/users/{self.user_id}/delete')
+            
+        db.session.remove()
+        self.assertEqual(Post.query.count(), 0)
+        self.assertEqual(PostTag.query.count(), 0)
+        self.assertEqual(TagTimelineEntry.query.count(), 0)
+
+
+class ApiTestCase(TestCase):
+    """Tests for the JSON API."""
+    
+    def setUp(self):
+        """Add a user with three tagged posts."""
+        
+        User.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        IdempotencyKey.query.delete()
+        
+        user = User(first_name="Api", last_name="User")
+        tag = Tag(name="api_tag")
+        posts = [Post(title=f"Api Post {i}", content="Content", users=user, posts_tags=[PostTag(tags=tag)])
+                 for i in range(3)]
+        db.session.add_all([user, tag, *posts])
+        db.session.commit()
+        
+        self.user_id = user.id
+        self.tag_id = tag.id
+        self.post_ids = [post.id for post in posts]
+        
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+        
+    def test_sparse_fieldsets(self):
+        """Test that ?fields limits the attributes returned."""
+        with app.test_client() as client:
+            resp = client.get(f'/api/v1/posts/{self.post_ids[0]}?fields=title,tag_ids')
+            
+            self.assertEqual(resp.json, {'id': self.post_ids[0], 'title': 'Api Post 0',
+                                         'tag_ids': [self.tag_id]})
+            
+            resp = client.get(f'/api/v1/users/{self.user_id}')
+            self.assertEqual(resp.json['post_count'], 3)
+            
+            resp = client.get('/api/v1/users?fields=password')
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json['error'], 'Bad Request')
+            
+    def test_keyset_pagination(self):
+        """Test walking a user's posts two at a time."""
+        with app.test_client() as client:
+            url = f'/api/v1/users/{self.user_id}/posts?fields=title&limit=2'
+            first = client.get(url).json
+            second = client.get(f"{url}&after={first['next_cursor']}").json
+            
+            self.assertEqual([p['id'] for p in first['data'] + second['data']], self.post_ids)
+            self.assertIsNone(second['next_cursor'])
+            self.assertEqual(client.get('/api/v1/users/0/posts').status_code, 404)
+            self.assertEqual(client.get('/api/v1/posts?after=bogus').status_code, 400)
+            for values in (["1"], [{}], [1, 2], [1.5]):
+                resp = client.get('/api/v1/posts', query_string={'after': encode_cursor(values)})
+                self.assertEqual(resp.status_code, 400, values)
+            
+    def test_conditional_get(self):
+        """Test that unchanged resources answer 304 from one query and changed ones don't."""
+        # SQLite's timestamps are whole seconds; start from an older one
+        db.session.execute(db.update(Tag).values(updated_at=datetime(2022, 1, 1, 12, 30)))
+        db.session.commit()
+        with app.test_client() as client:
+            url = f'/api/v1/tags/{self.tag_id}'
+            resp = client.get(url)
+            etag, last_modified = resp.headers['ETag'], resp.headers['Last-Modified']
+            self.assertEqual(last_modified, 'Sat, 01 Jan 2022 12:30:00 GMT')
+            
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual((resp.status_code, resp.headers['X-DB-Query-Count']), (304, '1'))
+            self.assertEqual(client.get(url, headers={'If-Modified-Since': last_modified}).status_code, 304)
+            
+            listing = client.get('/api/v1/tags')
+            resp = client.get('/api/v1/tags', headers={'If-None-Match': listing.headers['ETag']})
+            self.assertEqual((resp.status_code, resp.headers['X-DB-Query-Count']), (304, '1'))
+            
+            client.post(f'/posts/{self.post_ids[0]}/edit', data={'title': 'T', 'content': 'C'})
+            
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['post_count'], 2)
+            
+            # A deleted row moves no timestamp, but changes the page's count
+            extra = Tag(name="extra_tag")
+            db.session.add(extra)
+            db.session.commit()
+            listing = client.get('/api/v1/tags')
+            db.session.delete(extra)
+            db.session.commit()
+            resp = client.get('/api/v1/tags', headers={'If-None-Match': listing.headers['ETag']})
+            self.assertEqual(resp.status_code, 200)
+            
+    def test_tag_changes_move_post_updated_at(self):
+        """Test that adding or deleting a post's tags makes its Last-Modified newer."""
+        old = datetime(2022, 1, 1)
+        db.session.execute(db.update(Post).values(updated_at=old))
+        db.session.commit()
+        
+        # Through the flush hooks
+        other = Tag(name="other_tag", posts_tags=[PostTag(post_id=self.post_ids[0])])
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+        # Through purge_tag
+        with app.test_client() as client:
+            client.post(f'/tags/{self.tag_id}/delete')
+            
+            since = {'If-Modified-Since': 'Sat, 01 Jan 2022 00:00:00 GMT'}
+            resp = client.get(f'/api/v1/posts/{self.post_ids[0]}?fields=tag_ids', headers=since)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['tag_ids'], [other_id])
+            self.assertEqual(client.get(f'/api/v1/posts/{self.post_ids[1]}', headers=since).status_code, 200)
+        
+        db.session.execute(db.update(Post).values(updated_at=old))
+        db.session.commit()
+        db.session.delete(PostTag.query.get((self.post_ids[0], other_id)))
+        db.session.commit()
+        self.assertGreater(Post.query.get(self.post_ids[0]).updated_at, old)
+        self.assertEqual(Post.query.get(self.post_ids[1]).updated_at, old)
+
+    def test_batch_create_posts(self):
+        """Test creating several posts at once, with their tags and counters."""
+        batch = {'posts': [{'title': 'Batch 1', 'content': 'One', 'tag_ids': [self.tag_id]},
+                           {'title': 'Batch 2', 'content': 'Two'}]}
+        with app.test_client() as client:
+            resp = client.post(f'/api/v1/users/{self.user_id}/posts?fields=title,tag_ids', json=batch)
+            
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual([(p['title'], p['tag_ids']) for p in resp.json['data']],
+                             [('Batch 1', [self.tag_id]), ('Batch 2', [])])
+            self.assertEqual(User.query.get(self.user_id).post_count, 5)
+            self.assertEqual(Tag.query.get(self.tag_id).post_count, 4)
+            
+            bad = {'posts': [{'title': 'Bad', 'content': 'Tag', 'tag_ids': [0]}]}
+            self.assertEqual(client.post(f'/api/v1/users/{self.user_id}/posts', json=bad).status_code, 400)
+            self.assertEqual(client.post(f'/api/v1/users/{self.user_id}/posts', json={'posts': []})
+                             .status_code, 400)
+            self.assertEqual(client.post('/api/v1/users/0/posts', json=batch).status_code, 404)
+            self.assertEqual(Post.query.count(), 5)
+        
+    def test_idempotency_key(self):
+        """Test that a retried batch is replayed rather than written twice."""
+        url = f'/api/v1/users/{self.user_id}/posts'
+        batch = {'posts': [{'title': 'Once', 'content': 'Only once'}]}
+        headers = {'Idempotency-Key': 'retry-me'}
+        with app.test_client() as client:
+            first = client.post(url, json=batch, headers=headers)
+            retry = client.post(url, json=batch, headers=headers)
+            
+            self.assertEqual(retry.status_code, 201)
+            self.assertEqual(retry.json, first.json)
+            self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+            self.assertEqual(Post.query.filter_by(title='Once').count(), 1)
+            
+            other = client.post(url, json={'posts': [{'title': 'Other', 'content': 'C'}]}, headers=headers)
+            self.assertEqual(other.status_code, 422)
+            
+            # A failed request releases its key
+            failed = client.post(url, json={'posts': []}, headers={'Idempotency-Key': 'fails'})
+            self.assertEqual(failed.status_code, 400)
+            self.assertIsNone(IdempotencyKey.query.get('fails'))
+        
+    def test_purge_expired_keys(self):
+        """Test that expired keys are purged and can be reused."""
+        url = f'/api/v1/users/{self.user_id}/posts'
+        batch = {'posts': [{'title': 'Expiring', 'content': 'C'}]}
+        with app.test_client() as client:
+            client.post(url, json=batch, headers={'Idempotency-Key': 'old'})
+            client.post(url, json=batch, headers={'Idempotency-Key': 'new'})
+            IdempotencyKey.query.filter_by(key='old').update({'expires_at': datetime(2000, 1, 1)})
+            db.session.commit()
+            
+            result = app.test_cli_runner().invoke(args=['purge-idempotency-keys'])
+            self.assertIn("Deleted 1 expired", result.output)
+            self.assertEqual([k.key for k in IdempotencyKey.query.all()], ['new'])
+            
+            IdempotencyKey.query.filter_by(key='new').update({'expires_at': datetime(2000, 1, 1)})
+            db.session.commit()
+            resp = client.post(url, json=batch, headers={'Idempotency-Key': 'new'})
+            self.assertNotIn('Idempotent-Replayed', resp.headers)
+            self.assertEqual(Post.query.filter_by(title='Expiring').count(), 3)
+
+
+class AvatarTestCase(TestCase):
+    """Tests for avatar thumbnails, fetched from a local stand-in image host."""
+    
+    @classmethod
+    def setUpClass(cls):
+        """Serve a PNG at /avatar.png and count requests per path."""
+        cls.hits = Counter()
+        cls.checked_out = []
+        
+        class ImageHost(BaseHTTPRequestHandler):
+            def do_GET(self):
+                cls.hits[self.path] = cls.hits[self.path] + 1
+                cls.checked_out.append(db.get_engine(app).pool.checkedout())
+                if self.path != '/avatar.png':
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(PNG)))
+                self.end_headers()
+                self.wfile.write(PNG)
+            
+            def log_message(self, *args):
+                pass
+        
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHost)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.image_url = f"http://127.0.0.1:{cls.server.server_port}/avatar.png"
+        
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        
+    def setUp(self):
+        """Cache avatars in a fresh directory."""
+        
+        User.query.delete()
+        db.session.commit()
+        
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = cache_dir.name
+        self.hits.clear()
+        self.checked_out.clear()
+        
+        config = {'AVATAR_CACHE_DIR': self.cache_dir, 'AVATAR_ALLOW_PRIVATE_HOSTS': True}
+        for key, value in config.items():
+            self.addCleanup(app.config.__setitem__, key, app.config[key])
+            app.config[key] = value
+            
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        
+        db.session.rollback()
+        
+    def add_user(self, client, image_url):
+        data = {"first-name": "Avatar", "last-name": "User", "image-url": image_url}
+        client.post("/users/new", data=data)
+        return User.query.filter_by(first_name="Avatar").one()
+    
+    def test_avatar_cached_on_save(self):
+        """Test that a saved image is fetched once and served locally for a year."""
+        with app.test_client() as client:
+            user = self.add_user(client, self.image_url)
+            
+            self.assertIsNotNone(user.avatar_key)
+            self.assertEqual(self.hits['/avatar.png'], 1)
+            
+            html = client.get(f"/users/{user.id}").get_data(as_text=True)
+            self.assertNotIn(self.image_url, html)
+            digest, extension = user.avatar_key.split('.')
+            self.assertIn(f'/avatars/{digest}-256.{extension}', html)
+            
+            resp = client.get(f'/avatars/{digest}-256.{extension}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.mimetype.startswith('image/'))
+            self.assertEqual(resp.cache_control.max_age, 365 * 24 * 60 * 60)
+            self.assertTrue(resp.cache_control.immutable)
+            
+            # Saving the user again without a new picture fetches nothing
+            data = {"first-name": "Renamed", "last-name": "User", "image-url": self.image_url}
+            client.post(f"/users/{user.id}/edit", data=data)
+            self.assertEqual(self.hits['/avatar.png'], 1)
+            self.assertEqual(client.get(f'/avatars/{digest}-64.{extension}').status_code, 404)
+            
+    def test_failed_fetch_falls_back(self):
+        """Test that an image that can't be fetched is linked directly."""
+        with app.test_client() as client:
+            missing_url = self.image_url.replace('avatar.png', 'missing.png')
+            user = self.add_user(client, missing_url)
+            
+            self.assertIsNone(user.avatar_key)
+            self.assertIn(missing_url, client.get(f"/users/{user.id}").get_data(as_text=True))
+            
+    def test_private_hosts_refused(self):
+        """Test that local addresses aren't fetched unless allowed."""
+        app.config['AVATAR_ALLOW_PRIVATE_HOSTS'] = False
+        with app.app_context():
+            self.assertIsNone(save_avatar(self.image_url))
+            self.assertIsNone(save_avatar('file:///etc/passwd'))
+        self.assertEqual(sum(self.hits.values()), 0)
+        
+    def test_rebinding_host_refused(self):
+        """Test that a host resolving to a public address for the check, then a local one, isn't fetched."""
+        app.config['AVATAR_ALLOW_PRIVATE_HOSTS'] = False
+        port = self.server.server_port
+        answers = iter([[(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('93.184.216.34', port))]])
+        
+        def rebinding_getaddrinfo(host, *args, **kwargs):
+            return next(answers, [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))])
+        
+        with app.app_context(), mock.patch('socket.getaddrinfo', rebinding_getaddrinfo):
+            self.assertIsNone(save_avatar(f"http://rebind.example:{port}/avatar.png"))
+        self.assertEqual(sum(self.hits.values()), 0)
+        
+    def test_fetch_holds_no_connection(self):
+        """Test that no pooled connection is checked out while an image is fetched."""
+        missing_url = self.image_url.replace('avatar.png', 'missing.png')
+        with app.test_client() as client:
+            user_id = self.add_user(client, missing_url).id
+            db.session.commit()
+            data = {"first-name": "Avatar", "last-name": "User", "image-url": self.image_url}
+            client.post(f"/users/{user_id}/edit", data=data)
+            
+        self.assertIsNotNone(User.query.get(user_id).avatar_key)
+        self.assertEqual(self.checked_out, [0, 0])
+        
+    def test_evicted_avatar_rebuilt(self):
+        """Test that the LRU cap evicts thumbnails and a request rebuilds them."""
+        with app.test_client() as client:
+            user = self.add_user(client, self.image_url)
+            for name in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, name))
+                
+            filename = thumbnail_name(user.avatar_key, 512)
+            self.assertEqual(client.get(f'/avatars/{filename}').status_code, 200)
+            self.assertEqual(self.hits['/avatar.png'], 2)
+            
+        old, new = (os.path.join(self.cache_dir, name) for name in ('old', 'new'))
+        for path, mtime in ((old, 1), (new, 2)):
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+            os.utime(path, (mtime, mtime))
+        size = sum(os.path.getsize(os.path.join(self.cache_dir, name)) for name in os.listdir(self.cache_dir))
+        
+        self.assertEqual(prune(self.cache_dir, size - 1), 1)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+
+class AsyncModeTestCase(TestCase):
+    """Tests for the ASGI app serving read pages with the async engine."""
+    
+    def setUp(self):
+        """Add a user with a tagged post; wrap an app without a page cache."""
+        self.addCleanup(setattr, db, 'app', db.app)
+        self.addCleanup(db.session.remove)
+        
+        User.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        
+        user = User(first_name="Async", last_name="User")
+        tag = Tag(name="async_tag")
+        post = Post(title="Async Post", content="Content", users=user, posts_tags=[PostTag(tags=tag)])
+        db.session.add_all([user, tag, post])
+        db.session.commit()
+        
+        self.user_id, self.post_id, self.tag_id = user.id, post.id, tag.id
+        self.asgi_app = create_asgi_app({'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI'],
+                                         'PAGE_CACHE': None, 'TESTING': True})
+        # Pooled async connections belong to the loop that opened them
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.addCleanup(self.shutdown)
+        
+    def shutdown(self):
+        """Send the ASGI lifespan shutdown, which disposes the async engines."""
+        messages = iter([{'type': 'lifespan.shutdown'}])
+        
+        async def receive():
+            return next(messages)
+        
+        async def send(message):
+            pass
+        
+        self.loop.run_until_complete(self.asgi_app({'type': 'lifespan'}, receive, send))
+        
+    def request(self, method, path, query=b'', body=b'', headers=()):
+        """Send one request through the ASGI app; return (status, headers, body)."""
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+                 'headers': list(headers), 'http_version': '1.1', 'scheme': 'http',
+                 'server': ('localhost', 80), 'client': ('127.0.0.1', 50000)}
+        sent = []
+        
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        
+        async def send(message):
+            sent.append(message)
+        
+        self.loop.run_until_complete(self.asgi_app(scope, receive, send))
+        return sent[0]['status'], dict(sent[0]['headers']), sent[1]['body']
+    
+    def test_other_routes_go_to_flask(self):
+        """Test that writes and other pages are served by the Flask app."""
+        status, headers, _ = self.request('GET', '/')
+        self.assertEqual(status, 302)
+        self.assertTrue(headers[b'location'].endswith(b'/users'))
+        
+        form = b'first-name=Via&last-name=Asgi&image-url='
+        status, _, _ = self.request('POST', '/users/new', body=form, headers=[
+            (b'content-type', b'application/x-www-form-urlencoded'),
+            (b'content-length', str(len(form)).encode())])
+        self.assertEqual(status, 302)
+        self.assertEqual(User.query.filter_by(first_name="Via").count(), 1)
+        
+    @skipUnless(importlib.util.find_spec(ASYNC_DRIVER), f"{ASYNC_DRIVER} is not installed")
+    def test_async_pages_match_sync(self):
+        """Test that the async views render the same pages as the sync ones."""
+        pages = [('/users', b''), (f'/posts/{self.post_id}', b''), ('/tags', b''),
+                 ('/tags', b'sort=popular'), (f'/tags/{self.tag_id}', b'')]
+        with app.test_client() as client:
+            for path, query in pages:
+                status, _, body = self.request('GET', path, query)
+                self.assertEqual(status, 200)
+                self.assertEqual(body, client.get(f'{path}?{query.decode()}').get_data())
+                
+        self.assertEqual(self.request('GET', '/posts/0')[0], 404)
+        self.assertEqual(self.request('GET', '/users', b'after=bogus')[0], 400)
+        
+    @skipUnless(importlib.util.find_spec(ASYNC_DRIVER), f"{ASYNC_DRIVER} is not installed")
+    def test_async_pages_run_request_hooks(self):
+        """Test that the async views go through the app's before_request and after_request hooks."""
+        @self.asgi_app.flask_app.before_request
+        def maintenance():
+            if request.headers.get('X-Maintenance'):
+                return "Down for maintenance", 503
+        
+        status, headers, _ = self.request('GET', '/tags')
+        self.assertEqual(status, 200)
+        self.assertIn(b'x-db-query-count', headers)
+        
+        status, _, body = self.request('GET', '/tags', headers=[(b'x-maintenance', b'1')])
+        self.assertEqual((status, body), (503, b"Down for maintenance"))
+        
+    def test_head_has_no_body(self):
+        """Test that HEAD of an async page is answered by Flask, without a body."""
+        status, headers, body = self.request('HEAD', '/tags')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'')
+        self.assertNotEqual(headers[b'content-length'], b'0')
+
+
+class MigrationTestCase(TestCase):
+    """Tests for upgrading databases made by older versions of create-db."""
+
+    def setUp(self):
+        """Point db at an empty migrations test database, two rows per backfill batch."""
+        self.addCleanup(setattr, db, 'app', db.app)
+        self.migrations_app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'postgresql:///blogly_migrations_test',
+            'MIGRATION_BATCH_SIZE': 2,
+            'TESTING': True,
+        })
+        ctx = self.migrations_app.app_context()
+        ctx.push()
+        self.addCleanup(ctx.pop)
+        self.addCleanup(db.session.remove)
+
+        db.drop_all()
+
+    def create_baseline(self):
+        """Create the four tables as the first create-db did, with three users' posts."""
+        metadata = db.MetaData()
+        users = db.Table('users', metadata,
+                         db.Column('id', db.Integer, primary_key=True),
+                         db.Column('first_name', db.String(50), nullable=False),
+                         db.Column('last_name', db.String(50), nullable=False),
+                         db.Column('image_url', db.Text, nullable=False))
+        posts = db.Table('posts', metadata,
+                         db.Column('id', db.Integer, primary_key=True),
+                         db.Column('title', db.String(40), nullable=False),
+                         db.Column('content', db.Text, nullable=False),
+                         db.Column('created_at', db.DateTime, nullable=False),
+                         db.Column('user_id', db.Integer, db.ForeignKey('users.id', ondelete='cascade'),
+                                   nullable=False))
+        tags = db.Table('tags', metadata,
+                        db.Column('id', db.Integer, primary_key=True),
+                        db.Column('name', db.String(30), nullable=False, unique=True))
+        posts_tags = db.Table('posts_tags', metadata,
+                              db.Column('post_id', db.Integer, db.ForeignKey('posts.id', ondelete='cascade'),
+                                        primary_key=True),
+                              db.Column('tag_id', db.Integer, db.ForeignKey('tags.id', ondelete='cascade'),
+                                        primary_key=True))
+        metadata.create_all(db.engine)
+
+        with db.engine.begin() as conn:
+            conn.execute(users.insert(), [{'id': i, 'first_name': f"User{i}", 'last_name': "Old",
+                                           'image_url': 'http://example.com/a.png'} for i in (1, 2, 3)])
+            conn.execute(posts.insert(), [{'id': i, 'title': f"Post {i}", 'content': "Old content",
+                                           'created_at': datetime(2022, 1, i), 'user_id': 1 + i % 2}
+                                          for i in range(1, 6)])
+            conn.execute(tags.insert(), [{'id': 1, 'name': "old"}])
+            conn.execute(posts_tags.insert(), [{'post_id': i, 'tag_id': 1} for i in (1, 2, 3)])
+
+    def test_upgrade_baseline_database(self):
+        """Test that a baseline database gets every column, backfill and index."""
+        self.create_baseline()
+
+        self.assertEqual(upgrade(), [version for version, _ in MIGRATIONS])
+        self.assertEqual(check_schema(), [])
+        self.assertEqual(upgrade(), [])
+
+        counts = {user.id: (user.post_count, user.last_post_at) for user in User.query}
+        self.assertEqual(counts, {1: (2, datetime(2022, 1, 4)), 2: (3, datetime(2022, 1, 5)),
+                                  3: (0, None)})
+        tag = Tag.query.one()
+        self.assertEqual((tag.post_count, tag.last_post_at), (3, datetime(2022, 1, 3)))
+        self.assertEqual(Post.query.get(4).updated_at, datetime(2022, 1, 4))
+        self.assertEqual(Post.query.filter(Post.updated_at.is_(None)).count(), 0)
+        self.assertEqual(TagTimelineEntry.query.count(), 3)
+
+        # The migrated schema works like a new one
+        db.session.add(Post(title="New", content="New content", user_id=3,
+                            posts_tags=[PostTag(tag_id=tag.id)]))
+        db.session.commit()
+        self.assertEqual(User.query.get(3).post_count, 1)
+        self.assertEqual(Post.feed(tag_id=tag.id)[0][0].title, "New")
+
+    def test_search_vector_before_updated_at(self):
+        """Test that the search_vector migration backfills posts that have no updated_at yet."""
+        self.create_baseline()
+        m = Migrator(db.engine, self.migrations_app.config)
+        if not m.postgresql:
+            self.skipTest("search_vector is PostgreSQL only")
+
+        search_vector(m)
+        with db.engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql(
+                "SELECT count(*) FROM posts WHERE search_vector IS NULL").scalar(), 0)
+
+    def test_upgrade_resumes_timeline_fill(self):
+        """Test that rerunning the tag_timeline migration fills in entries an interrupted run missed."""
+        self.create_baseline()
+        upgrade()
+        with db.engine.begin() as conn:
+            conn.execute(db.delete(TagTimelineEntry).where(TagTimelineEntry.post_id > 1))
+            conn.execute(db.delete(SchemaMigration).where(SchemaMigration.version >= '0006'))
+
+        upgrade()
+        self.assertEqual(TagTimelineEntry.query.count(), 3)
+
+    def test_upgrade_rebuilds_differing_index(self):
+        """Test that an index defined differently from the models is replaced."""
+        self.create_baseline()
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("CREATE INDEX ix_users_last_name_first_name_id ON users (last_name, first_name)")
+
+        upgrade()
+        self.assertEqual(check_schema(), [])
+
+    def test_upgrade_empty_database(self):
+        """Test that an empty database gets the whole schema with every migration recorded."""
+        self.assertEqual(upgrade(), [version for version, _ in MIGRATIONS])
+        self.assertEqual(SchemaMigration.query.count(), len(MIGRATIONS))
+        self.assertEqual(check_schema(), [])
+
+    def test_check_schema_reports_drift(self):
+        """Test that check_schema lists what the live schema is missing or has extra."""
+        upgrade()
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("DROP INDEX ix_posts_created_at_id")
+            conn.exec_driver_sql("ALTER TABLE tags ADD COLUMN color VARCHAR(7)")
+            conn.exec_driver_sql("DROP INDEX ix_posts_user_id_created_at")
+            conn.exec_driver_sql("CREATE INDEX ix_posts_user_id_created_at ON posts (user_id)")
+            conn.execute(db.delete(SchemaMigration).where(SchemaMigration.version == MIGRATIONS[-1][0]))
+
+        self.assertEqual(check_schema(), ["Unexpected column tags.color",
+                                          "Missing index ix_posts_created_at_id",
+                                          "Index ix_posts_user_id_created_at differs from the models: "
+                                          "CREATE INDEX ix_posts_user_id_created_at ON posts (user_id)",
+                                          f"Migration {MIGRATIONS[-1][0]} not applied"])
+
+
+class QueryCountTestCase(TestCase):
+    """Pin the number of SQL statements each route issues, so N+1 regressions fail."""
+    
+    def setUp(self):
+        """Add a user with several posts, each sharing the same tags."""
+        
+        User.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        
+        user = User(first_name="Count", last_name="User")
+        tags = [Tag(name=f"count_tag_{i}") for i in range(3)]
+        posts = [Post(title=f"Count Post {i}", content="Content", users=user,
+                      posts_tags=[PostTag(tags=tag) for tag in tags])
+                 for i in range(3)]
+        db.session.add_all([user, *tags, *posts])
+        db.session.commit()
+        
+        self.user_id = user.id
+        self.post_id = posts[0].id
+        self.tag_id = tags[0].id
+        
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+        
+    @contextmanager
+    def assertNumQueries(self, expected):
+        """Assert the block issues exactly `expected` SQL statements."""
+        # Start from an empty identity map so nothing is served from memory
+        db.session.remove()
+        statements = []
+        
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        
+        engine = db.get_engine(app)
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            yield
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        
+        self.assertEqual(len(statements), expected, "\n\n".join(statements))
+        
+    def test_user_routes(self):
+        """Test statement counts for the user routes."""
+        user_data = {"first-name": "New", "last-name": "Name", "image-url": "http://example.com/a.png"}
+        with app.test_client() as client:
+            with self.assertNumQueries(1):
+                client.get('/users')
+            with self.assertNumQueries(2):
+                client.get(f'/users/{self.user_id}')
+            with self.assertNumQueries(1):
+                client.get(f'/users/{self.user_id}/edit')
+            with self.assertNumQueries(1):
+                client.get(f'/users/{self.user_id}/posts/new')
+            with self.assertNumQueries(2):
+                client.post('/users/new', data=user_data)
+            with self.assertNumQueries(2):
+                client.post(f'/users/{self.user_id}/edit', data=user_data)
+            with self.assertNumQueries(7):
+                client.post(f'/users/{self.user_id}/posts/new',
+                            data={'title': 'T', 'content': 'C', 'tags-checkbox': [self.tag_id]})
+            with self.assertNumQueries(4):
+                client.post(f'/users/{self.user_id}/delete')
+                
+    def test_post_routes(self):
+        """Test statement counts for the post routes."""
+        with app.test_client() as client:
+            with self.assertNumQueries(3):
+                client.get(f'/posts/{self.post_id}')
+            with self.assertNumQueries(2):
+                client.get(f'/posts/{self.post_id}/edit')
+            with self.assertNumQueries(6):
+                client.post(f'/posts/{self.post_id}/edit',
+                            data={'title': 'T', 'content': 'C', 'tags-checkbox': [self.tag_id]})
+            with self.assertNumQueries(6):
+                client.post(f'/posts/{self.post_id}/delete')
+                
+    def test_tag_routes(self):
+        """Test statement counts for the tag routes."""
+        with app.test_client() as client:
+            with self.assertNumQueries(1):
+                client.get('/tags')
+            with self.assertNumQueries(2):
+                client.get(f'/tags/{self.tag_id}')
+            with self.assertNumQueries(0):
+                client.get('/tags/new')
+            with self.assertNumQueries(1):
+                client.get(f'/tags/{self.tag_id}/edit')
+            with self.assertNumQueries(2):
+                client.post('/tags/new', data={'name': 'count_tag_new'})
+            with self.assertNumQueries(2):
+                client.post(f'/tags/{self.tag_id}/edit', data={'name': 'count_tag_renamed'})
+            # Lookup, its posts, their updated_at, delete
+            with self.assertNumQueries(4):
+                client.post(f'/tags/{self.tag_id}/delete')
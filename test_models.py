@@ -1,14 +1,15 @@
+from datetime import timedelta
 from unittest import TestCase
 
-from app import app
-from models import db, User
+from app import create_app
+from migrations import upgrade
+from models import db, rebuild_timeline, repair_post_counters, User, Post, Tag, PostTag, TagTimelineEntry
 
-# Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly_test'
-app.config['SQLALCHEMY_ECHO'] = False
+# Use test database
+app = create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql:///blogly_test'})
 
 db.drop_all()
-db.create_all()
+upgrade()
 
 class UserModelTestCase(TestCase):
     """Tests for model for Users."""
@@ -23,4 +24,184 @@ class UserModelTestCase(TestCase):
         
     def test_full_name(self):
         user = User(first_name = "Test", last_name = "User")
-        self.assertEqual(user.full_name, "Test User")
\ No newline at end of file
+        self.assertEqual(user.full_name, "Test User")
+        
+    def test_keyset_page(self):
+        db.session.add_all([User(first_name="A", last_name="Zed"),
+                            User(first_name="B", last_name="Able"),
+                            User(first_name="A", last_name="Able")])
+        db.session.commit()
+        
+        users, next_cursor = User.keyset_page(per_page=2)
+        self.assertEqual([u.full_name for u in users], ["A Able", "B Able"])
+        
+        users, next_cursor = User.keyset_page(after=next_cursor, per_page=2)
+        self.assertEqual([u.full_name for u in users], ["A Zed"])
+        self.assertIsNone(next_cursor)
+
+
+
+class PostModelTestCase(TestCase):
+    """Tests for model for Posts."""
+    
+    def setUp(self):
+        """Add a post and a few tags."""
+        User.query.delete()
+        Tag.query.delete()
+        
+        user = User(first_name="Test", last_name="User")
+        self.tags = [Tag(name=f"sync_{i}") for i in range(3)]
+        self.post = Post(title="Title", content="Content", users=user)
+        db.session.add_all([user, self.post, *self.tags])
+        db.session.commit()
+        
+    def tearDown(self):
+        """Clean up any failed transactions."""
+        db.session.rollback()
+        
+    def test_sync_tags(self):
+        t0, t1, t2 = (t.id for t in self.tags)
+        
+        self.post.sync_tags([t0, t1])
+        db.session.commit()
+        self.assertEqual({t.id for t in self.post.tags}, {t0, t1})
+        
+        self.post.sync_tags([t1, t2, -1])
+        db.session.commit()
+        self.assertEqual({t.id for t in self.post.tags}, {t1, t2})
+        
+        self.post.sync_tags([])
+        db.session.commit()
+        self.assertEqual(PostTag.query.filter_by(post_id=self.post.id).count(), 0)
+
+        
+    def test_search(self):
+        user = self.post.users
+        once = Post(title="Apple", content="banana", users=user)
+        twice = Post(title="Apple apple", content="cherry apple", users=user)
+        db.session.add_all([once, twice, Post(title="Cherry", content="only", users=user)])
+        db.session.commit()
+        
+        posts, next_cursor = Post.search("apple", per_page=1)
+        self.assertEqual([p.id for p in posts], [twice.id])
+        
+        posts, next_cursor = Post.search("apple", after=next_cursor, per_page=1)
+        self.assertEqual([p.id for p in posts], [once.id])
+        self.assertIsNone(next_cursor)
+        
+        posts, _ = Post.search("apple cherry")
+        self.assertEqual([p.id for p in posts], [twice.id])
+
+        
+    def test_with_tags_and_related(self):
+        t0, t1, t2 = (t.id for t in self.tags)
+        user = self.post.users
+        both = Post(title="Both", content="Content", users=user)
+        only_t1 = Post(title="Only t1", content="Content", users=user)
+        db.session.add_all([both, only_t1])
+        self.post.sync_tags([t0, t1, t2])
+        both.sync_tags([t0, t1])
+        only_t1.sync_tags([t1])
+        db.session.commit()
+        
+        posts, _ = Post.with_tags([t0, t1])
+        self.assertEqual([p.id for p in posts], [both.id, self.post.id])
+        
+        posts, next_cursor = Post.with_tags([t0, t2], match='any', per_page=1)
+        self.assertEqual([p.id for p in posts], [self.post.id])
+        posts, next_cursor = Post.with_tags([t0, t2], match='any', after=next_cursor, per_page=1)
+        self.assertEqual([p.id for p in posts], [both.id])
+        self.assertIsNone(next_cursor)
+        
+        self.assertEqual([(p.id, shared) for p, shared in self.post.related()],
+                         [(both.id, 2), (only_t1.id, 1)])
+        self.assertRaises(ValueError, Post.with_tags, [t0], match='most')
+        
+    def test_feed(self):
+        t0, t1, _ = (t.id for t in self.tags)
+        user = self.post.users
+        newer = [Post(title=f"Newer {i}", content="Content", users=user,
+                      created_at=self.post.created_at + timedelta(minutes=i + 1)) for i in range(3)]
+        db.session.add_all(newer)
+        db.session.flush()
+        for post in [self.post, *newer]:
+            post.sync_tags([t0])
+        newer[1].sync_tags([t1])
+        db.session.add(PostTag(post_id=self.post.id, tag_id=t1))
+        db.session.commit()
+        
+        posts, next_cursor = Post.feed(per_page=3)
+        self.assertEqual([p.title for p in posts], ["Newer 2", "Newer 1", "Newer 0"])
+        posts, next_cursor = Post.feed(after=next_cursor, per_page=3)
+        self.assertEqual([p.id for p in posts], [self.post.id])
+        self.assertIsNone(next_cursor)
+        
+        for use_timeline in (True, False):
+            posts, _ = Post.feed(tag_id=t0, use_timeline=use_timeline)
+            self.assertEqual([p.title for p in posts], ["Newer 2", "Newer 0", "Title"])
+            posts, _ = Post.feed(tag_id=t1, use_timeline=use_timeline)
+            self.assertEqual([p.title for p in posts], ["Newer 1", "Title"])
+        
+        db.session.delete(newer[0])
+        db.session.commit()
+        entries = {(e.tag_id, e.post_id) for e in TagTimelineEntry.query}
+        rebuild_timeline()
+        db.session.commit()
+        self.assertEqual(entries, {(e.tag_id, e.post_id) for e in TagTimelineEntry.query})
+        self.assertEqual(len(entries), 4)
+        
+    def test_post_counters(self):
+        user = self.post.users
+        t0, t1, t2 = self.tags
+        self.post.sync_tags([t0.id, t1.id])
+        other = Post(title="Other", content="Content", users=user, posts_tags=[PostTag(tags=t0)])
+        db.session.add(other)
+        db.session.commit()
+        
+        self.assertEqual(user.post_count, 2)
+        self.assertEqual(user.last_post_at, max(self.post.created_at, other.created_at))
+        self.assertEqual([t.post_count for t in self.tags], [2, 1, 0])
+        self.assertIsNone(t2.last_post_at)
+        
+        self.post.sync_tags([t1.id, t2.id])
+        db.session.delete(other)
+        db.session.commit()
+        
+        self.assertEqual(user.post_count, 1)
+        self.assertEqual(user.last_post_at, self.post.created_at)
+        self.assertEqual([t.post_count for t in self.tags], [0, 1, 1])
+        self.assertIsNone(t0.last_post_at)
+        
+    def test_post_counters_after_cascade(self):
+        user = self.post.users
+        self.post.sync_tags([self.tags[0].id])
+        other = User(first_name="Other", last_name="User")
+        db.session.add(Post(title="Other", content="Content", users=other,
+                            posts_tags=[PostTag(tags=self.tags[0])]))
+        db.session.commit()
+        self.assertEqual(self.tags[0].post_count, 2)
+        
+        # Neither has its children loaded, so the database cascades
+        db.session.expire_all()
+        db.session.delete(self.post)
+        db.session.delete(other)
+        db.session.commit()
+        
+        self.assertEqual(user.post_count, 0)
+        self.assertEqual(self.tags[0].post_count, 0)
+        self.assertEqual(PostTag.query.count(), 0)
+        
+    def test_repair_post_counters(self):
+        user = self.post.users
+        self.post.sync_tags([self.tags[0].id])
+        db.session.commit()
+        Tag.query.update({Tag.post_count: 7, Tag.last_post_at: None})
+        User.query.update({User.post_count: 7})
+        db.session.commit()
+        
+        repair_post_counters()
+        db.session.commit()
+        
+        self.assertEqual(user.post_count, 1)
+        self.assertEqual([t.post_count for t in self.tags], [1, 0, 0])
+        self.assertEqual(self.tags[0].last_post_at, self.post.created_at)